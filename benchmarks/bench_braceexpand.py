@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of braceexpand against the regex based implementation it replaced.
+
+    python benchmarks/bench_braceexpand.py
+'''
+from __future__ import print_function
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from braceexpand import count_braces, expand_braces  # noqa: E402
+
+BRACES_RE = re.compile("\{(.*?)\}", re.DOTALL)
+
+
+def legacy_expand_braces(text):
+    braces = BRACES_RE.findall(text)
+    if len(braces) == 0:
+        yield text
+        return
+
+    brace = braces[0]
+    options = brace.split('|')
+    for option in options:
+        replaced = BRACES_RE.sub(option, text, count=1)
+        for sub_opt in legacy_expand_braces(replaced):
+            yield sub_opt
+
+
+CASES = [
+    ('plain', 'what is the weather in tel aviv tomorrow'),
+    ('two groups', 'flights from {TLV|JFK|SFO} to {LHR|CDG|BER} tomorrow'),
+    ('six groups', 'x' * 200 + '{a|b|c}' * 6),
+    ('ten groups', '{0|1}' * 10 + ' and some text after the groups ' * 10),
+]
+
+
+def main(repeat=5):
+    print('{:<12} {:>8} {:>12} {:>12} {:>8}'.format('case', 'count', 'legacy ms', 'new ms', 'speedup'))
+    for name, text in CASES:
+        assert list(expand_braces(text)) == list(legacy_expand_braces(text))
+        number = max(1, 2000 // count_braces(text))
+        legacy = min(timeit.repeat(lambda: list(legacy_expand_braces(text)),
+                                   number=number, repeat=repeat)) / number
+        new = min(timeit.repeat(lambda: list(expand_braces(text)),
+                                number=number, repeat=repeat)) / number
+        print('{:<12} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+            name, count_braces(text), legacy * 1000, new * 1000, legacy / new))
+
+
+if __name__ == '__main__':
+    main()
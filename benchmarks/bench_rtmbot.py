@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+'''
+Load test of the whole bot against a local stand-in for Slack (benchmarks/fakeslack.py):
+synthetic event streams are replayed over a real websocket into a real RtmBot running
+the example plugins, or crunchablebot talking to a stubbed Crunchable, and every reply
+is matched with the event it answers.
+
+    python benchmarks/bench_rtmbot.py                       # every scenario
+    python benchmarks/bench_rtmbot.py storm --events 5000 --rate 0
+    python benchmarks/bench_rtmbot.py reconnect --set LOOP=poll
+
+Reports events/s, the p50/p99/max latency from sending an event to receiving its reply,
+replies lost and the peak memory of the process. Every scenario runs in a fresh process.
+'''
+from __future__ import print_function
+import gevent.monkey; gevent.monkey.patch_all()  # noqa: E702
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks', 'stubs'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from slackclient import SlackClient  # noqa: E402
+from rtmbot import RtmBot  # noqa: E402
+from fakeslack import FakeSlack, LocalRequester, USER_ID  # noqa: E402
+
+EXAMPLE_PLUGINS = [os.path.join(ROOT, 'doc', 'example-plugins', name)
+                   for name in ('repeat.py', 'todo.py', 'counter.py', 'canary.py')]
+CRUNCHABLE_PLUGINS = [os.path.join(ROOT, 'plugins', name)
+                      for name in ('crunchablebot.py', 'tasks.json')]
+
+SCENARIOS = {
+    # plain messages as fast as the bot takes them, every one answered by repeat
+    'storm': dict(plugins=EXAMPLE_PLUGINS, events=2000, rate=0, reply='from repeat1',
+                  text='hello bench-{}'),
+    # mostly presence changes no plugin handles, with a message every 20 events
+    'presence': dict(plugins=EXAMPLE_PLUGINS, events=5000, rate=0, reply='from repeat1',
+                     text='hello bench-{}', presence=19),
+    # a steady stream, with Slack dropping the websocket every 200 events
+    'reconnect': dict(plugins=EXAMPLE_PLUGINS, events=1000, rate=500, reply='from repeat1',
+                      text='hello bench-{}', drop_every=200),
+    # known crunchablebot tasks, each one a round trip to the (stubbed) Crunchable API
+    'crunchable': dict(plugins=CRUNCHABLE_PLUGINS, events=200, rate=100,
+                       reply="Here's your response", text='checkflights bench-{}'),
+}
+TOKEN_RE = re.compile(r'bench-(\d+)')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def make_events(scenario, channels):
+    '''Yields (event, token) pairs, token is None for events without a reply'''
+    presence = scenario.get('presence', 0)
+    for i in range(scenario['events']):
+        if presence and i % (presence + 1):
+            yield {'type': 'presence_change', 'user': USER_ID, 'presence': 'away'}, None
+            continue
+        yield {'type': 'message', 'channel': channels[i % len(channels)], 'user': USER_ID,
+               'text': scenario['text'].format(i), 'ts': '{:.6f}'.format(time.time())}, i
+
+
+def bot_config(base, overrides):
+    config = {
+        'SLACK_TOKEN': 'xoxb-bench',
+        'BASE_PATH': base,
+        'LOGFILE': 'rtmbot.log',
+        'LOOP': 'event',
+        'OUTPUT_QUEUE': True,
+        # measure the bot, not Slack's rate limits
+        'OUTPUT_RATE': 100000,
+        'OUTPUT_BURST': 100000,
+        'OUTPUT_CHANNEL_RATE': 100000,
+        'OUTPUT_CHANNEL_BURST': 100000,
+        'RECONNECT_BASE_DELAY': 0.05,
+        'RECONNECT_MAX_DELAY': 0.5,
+        'crunchablebot': {'CRUNCHABLE_TOKEN': 'bench', 'CRUNCHABLE_POLL_INTERVAL': 0.05},
+    }
+    for override in overrides:
+        key, _, value = override.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def run_scenario(name, args):
+    scenario = dict(SCENARIOS[name])
+    for key in ('events', 'rate'):
+        if getattr(args, key) is not None:
+            scenario[key] = getattr(args, key)
+
+    base = tempfile.mkdtemp(prefix='rtmbot-bench-')
+    os.makedirs(os.path.join(base, 'plugins'))
+    for path in scenario['plugins']:
+        shutil.copy(path, os.path.join(base, 'plugins'))
+    # the plugins keep their files relative to the working directory
+    os.chdir(base)
+
+    sent = {}
+    latencies = []
+    last_reply = [None]
+
+    def on_reply(event, received_at):
+        if scenario['reply'] not in event.get('text', ''):
+            return
+        # the output queue coalesces the replies to a channel into one message
+        for token in TOKEN_RE.findall(event['text']):
+            started = sent.pop(int(token), None)
+            if started is not None:
+                latencies.append(received_at - started)
+                last_reply[0] = received_at
+
+    slack = FakeSlack(channels=args.channels, on_reply=on_reply).start()
+    os.environ['CRUNCHABLE_URL'] = slack.api_url + '/crunchable'
+    bot = RtmBot(bot_config(base, args.set))
+    bot.connection.slack_client = SlackClient(bot.token)
+    bot.connection.slack_client.server.api_requester = LocalRequester(slack.api_url)
+    bot_greenlet = gevent.spawn(bot.start)
+    slack.connected.wait(10)
+    # let the bot take in hello and its own user info
+    gevent.sleep(0.5)
+
+    measured = 0
+    reconnect_times = []
+    start = time.time()
+    interval = 1.0 / scenario['rate'] if scenario['rate'] else 0
+    for i, (event, token) in enumerate(make_events(scenario, slack.channel_ids)):
+        if scenario.get('drop_every') and i and i % scenario['drop_every'] == 0:
+            dropped = time.time()
+            slack.disconnect()
+            slack.connected.wait(10)
+            reconnect_times.append(time.time() - dropped)
+        if interval:
+            gevent.sleep(max(0, start + i * interval - time.time()))
+        elif i % 100 == 0:
+            gevent.sleep(0)
+        if token is not None:
+            sent[token] = time.time()
+            measured += 1
+        slack.send(event)
+
+    deadline = time.time() + args.timeout
+    while sent and time.time() < deadline:
+        gevent.sleep(0.01)
+    # from the first event sent to the last reply received
+    duration = (last_reply[0] or time.time()) - start
+    bot_greenlet.kill(block=False)
+
+    return {
+        'scenario': name,
+        'events': scenario['events'],
+        'events_per_s': scenario['events'] / duration,
+        'replies': len(latencies),
+        'lost': measured - len(latencies),
+        'duration': duration,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies or [0]) * 1000,
+        'reconnects': slack.connects - 1,
+        'reconnect_ms': sum(reconnect_times) / len(reconnect_times) * 1000 if reconnect_times else 0,
+        # kilobytes on linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def print_report(results):
+    print('{:<11} {:>7} {:>9} {:>8} {:>8} {:>8} {:>5} {:>6} {:>8}'.format(
+        'scenario', 'events', 'events/s', 'p50 ms', 'p99 ms', 'max ms', 'lost', 'reconn', 'rss MB'))
+    for result in results:
+        print('{scenario:<11} {events:>7} {events_per_s:>9.0f} {p50_ms:>8.1f} {p99_ms:>8.1f} '
+              '{max_ms:>8.1f} {lost:>5} {reconnects:>6} {max_rss_mb:>8.1f}'.format(**result))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + sorted(SCENARIOS),
+                        help='scenarios to run, all of them by default')
+    parser.add_argument('--events', type=int, help='events per scenario')
+    parser.add_argument('--rate', type=float, help='events per second, 0 for as fast as possible')
+    parser.add_argument('--channels', type=int, default=10, help='channels the events are spread over')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the replies')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override a bot config value, e.g. --set LOOP=poll')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios = args.scenarios or sorted(SCENARIOS)
+    if args.single:
+        print(json.dumps(run_scenario(scenarios[0], args)))
+        sys.stdout.flush()
+        # the bot and the fake servers don't know how to stop
+        os._exit(0)
+    results = []
+    for name in scenarios:
+        command = [sys.executable, os.path.abspath(__file__), name, '--single'] + [
+            arg for arg in sys.argv[1:] if arg not in scenarios and arg != '--json']
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+'''
+A local stand-in for Slack, for the benchmarks: an RTM websocket server and a Web API
+(plus the few Crunchable endpoints crunchablebot uses) on 127.0.0.1, built on the
+standard library so it runs offline. Meant to run under gevent, like the bot.
+'''
+from __future__ import print_function, unicode_literals
+import base64
+import hashlib
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+BOT_ID = 'UBOT'
+USER_ID = 'U0000001'
+
+
+def encode_frame(payload, opcode=0x1):
+    '''A final, unmasked server frame'''
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 1 << 16:
+        header.append(126)
+        header.extend(struct.pack('!H', length))
+    else:
+        header.append(127)
+        header.extend(struct.pack('!Q', length))
+    return bytes(header) + payload
+
+
+class WebSocketClient(object):
+    '''The server side of one websocket connection'''
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise EOFError()
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def handshake(self):
+        while b'\r\n\r\n' not in self.buffer:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise EOFError()
+            self.buffer += chunk
+        request, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        key = None
+        for line in request.decode('latin-1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest())
+        self.sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                          b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def recv(self):
+        '''Returns the (opcode, payload) of the next frame'''
+        first, second = bytearray(self.read(2))
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        mask = bytearray(self.read(4)) if second & 0x80 else None
+        payload = bytearray(self.read(length))
+        if mask:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return first & 0x0f, bytes(payload)
+
+    def send(self, event):
+        self.send_frame(json.dumps(event).encode('utf-8'))
+
+    def send_frame(self, payload, opcode=0x1):
+        with self.lock:
+            self.sock.sendall(encode_frame(payload, opcode))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_frame(b'', 0x8)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class FakeSlack(object):
+    '''
+        Serves rtm.start/rtm.connect, the Web API methods rtmbot uses and the RTM
+        websocket for `channels` DM channels. Replies the bot sends are passed to
+        `on_reply(event, received_at)`.
+    '''
+    def __init__(self, channels=10, on_reply=None):
+        self.channel_ids = ['D{:07d}'.format(i) for i in range(channels)]
+        self.on_reply = on_reply or (lambda event, received_at: None)
+        self.client = None
+        self.connected = threading.Event()
+        self.connects = 0
+        self.task_ids = itertools.count(1)
+        self.tasks = {}
+        self.uploads = 0
+
+        self.websocket_server = socket.socket()
+        self.websocket_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.websocket_server.bind(('127.0.0.1', 0))
+        self.websocket_server.listen(16)
+        self.ws_url = 'ws://127.0.0.1:{}/'.format(self.websocket_server.getsockname()[1])
+
+        self.api = ApiServer(self)
+        self.api_url = 'http://127.0.0.1:{}'.format(self.api.server_address[1])
+
+    def start(self):
+        for target in (self.accept, self.api.serve_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def accept(self):
+        while True:
+            sock, _ = self.websocket_server.accept()
+            client = WebSocketClient(sock)
+            thread = threading.Thread(target=self.serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, client):
+        try:
+            client.handshake()
+        except (EOFError, socket.error):
+            return
+        self.client = client
+        self.connects += 1
+        client.send({'type': 'hello'})
+        self.connected.set()
+        try:
+            while True:
+                opcode, payload = client.recv()
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    client.send_frame(payload, 0xa)
+                    continue
+                if opcode != 0x1:
+                    continue
+                event = json.loads(payload.decode('utf-8'))
+                if event.get('type') == 'ping':
+                    client.send({'type': 'pong', 'reply_to': event.get('id')})
+                elif event.get('type') == 'message':
+                    client.send({'ok': True, 'reply_to': event.get('id'), 'ts': '{:.6f}'.format(time.time()),
+                                 'text': event.get('text')})
+                    self.on_reply(event, time.time())
+        except (EOFError, socket.error, ValueError):
+            pass
+        finally:
+            self.disconnect(client)
+
+    def disconnect(self, client=None):
+        '''Drops the websocket, the way Slack sometimes does'''
+        client = client or self.client
+        if client is None:
+            return
+        if client is self.client:
+            self.client = None
+            self.connected.clear()
+        client.close()
+
+    def send(self, event):
+        '''Sends an event to the bot, waiting for it to be connected'''
+        while True:
+            self.connected.wait()
+            client = self.client
+            try:
+                client.send(event)
+                return
+            except (AttributeError, socket.error):
+                # dropped in between, wait for the reconnect
+                self.connected.clear()
+
+    def login_data(self):
+        return {
+            'ok': True,
+            'url': self.ws_url,
+            'self': {'id': BOT_ID, 'name': 'benchbot'},
+            'team': {'id': 'T0000001', 'domain': 'bench'},
+            'channels': [],
+            'groups': [],
+            'ims': [{'id': channel_id, 'user': USER_ID} for channel_id in self.channel_ids],
+            'users': [{'id': USER_ID, 'name': 'bench'}, {'id': BOT_ID, 'name': 'benchbot'}],
+        }
+
+    def api_call(self, method, params):
+        if method == 'rtm.start':
+            return self.login_data()
+        if method == 'rtm.connect':
+            data = self.login_data()
+            return dict((key, data[key]) for key in ('ok', 'url', 'self', 'team'))
+        if method == 'auth.test':
+            return {'ok': True, 'user': 'benchbot', 'user_id': BOT_ID, 'team_id': 'T0000001'}
+        if method == 'im.open':
+            return {'ok': True, 'channel': {'id': self.channel_ids[0]}}
+        if method == 'users.info':
+            return {'ok': True, 'user': {'id': params.get('user'), 'name': 'bench'}}
+        if method == 'conversations.info':
+            return {'ok': True, 'channel': {'id': params.get('channel'), 'name': params.get('channel')}}
+        if method == 'files.upload':
+            self.uploads += 1
+            return {'ok': True, 'file': {}}
+        return {'ok': False, 'error': 'unknown_method'}
+
+    def crunchable_request(self, kind, data):
+        task_id = '{}'.format(next(self.task_ids))
+        if kind == 'multiple_choice':
+            response = [data['choices'][-1]]
+        else:
+            response = 'an answer to {}'.format(data.get('attachments'))
+        self.tasks[task_id] = {'id': task_id, 'status': 'complete', 'response': response,
+                               'attachments': data.get('attachments', [])}
+        return {'id': task_id}
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, slack):
+        self.slack = slack
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ApiHandler)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, body, status=200):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        slack = self.server.slack
+        if self.path.startswith('/api/'):
+            params = dict((key, values[0]) for key, values in parse_qs(body).items())
+            self.reply(slack.api_call(self.path[len('/api/'):], params))
+        elif self.path.startswith('/crunchable/requests/'):
+            self.reply(slack.crunchable_request(self.path.rsplit('/', 1)[1], json.loads(body)))
+        else:
+            self.reply({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        if self.path.startswith('/crunchable/tasks/'):
+            task = self.server.slack.tasks.get(self.path.rsplit('/', 1)[1].split('?')[0])
+            if task is not None:
+                return self.reply(task)
+        self.reply({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalRequester(object):
+    '''Stands in for slackclient's SlackRequest, which only talks https to slack.com'''
+    def __init__(self, api_url):
+        import requests
+        self.api_url = api_url
+        self.session = requests.Session()
+
+    def do(self, token, request='?', post_data=None, domain=None):
+        return self.session.post('{}/api/{}'.format(self.api_url, request),
+                                 data=dict(post_data or {}, token=token))
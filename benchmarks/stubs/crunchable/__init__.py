@@ -0,0 +1,6 @@
+'''
+A stand-in for the crunchable client, for the benchmarks: the same interface as far as
+crunchablebot uses it, talking to the fake Crunchable API of benchmarks/fakeslack.py at
+CRUNCHABLE_URL.
+'''
+from .crunchable import Crunchable  # noqa: F401
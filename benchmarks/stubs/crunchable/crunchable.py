@@ -0,0 +1,40 @@
+import json
+import os
+
+import requests
+
+
+class BadStatus(Exception):
+    pass
+
+
+class Crunchable(object):
+    def __init__(self, token):
+        self.token = token
+        self.base_url = os.environ.get('CRUNCHABLE_URL', 'http://127.0.0.1/crunchable')
+        self.headers = {'Authorization': 'Token {}'.format(token),
+                        'Content-Type': 'application/json'}
+
+    def _get_json(self, url):
+        response = requests.get(url, headers=self.headers)
+        if response.status_code != 200:
+            raise BadStatus(response.status_code)
+        return response.json()
+
+    def _post(self, url, data={}):
+        response = requests.post(url, data=json.dumps(data), headers=self.headers)
+        if response.status_code != 200:
+            raise BadStatus(response.status_code)
+        return response.json()
+
+    def request_free_text(self, **kwargs):
+        return self._post('{}/requests/free_text'.format(self.base_url), kwargs)
+
+    def request_multiple_choice(self, **kwargs):
+        return self._post('{}/requests/multiple_choice'.format(self.base_url), kwargs)
+
+    def get_task(self, task_id, block=0):
+        return self._get_json('{}/tasks/{}'.format(self.base_url, task_id))
+
+    def wait_for_task(self, task_id):
+        return self.get_task(task_id, block=120)
@@ -1,18 +1,103 @@
+import itertools
 import re
 
-BRACES_RE = re.compile("\{(.*?)\}", re.DOTALL)
-def expand_braces(text):
-    braces = BRACES_RE.findall(text)
-    if len(braces) == 0:
-        yield text
-        return
+# escaped special characters, the special characters, and everything in between
+TOKENS_RE = re.compile(r'(\\[{}|\\]|[{}|])')
+ESCAPES = frozenset(['\\{', '\\}', '\\|', '\\\\'])
+
+
+class BraceTemplate(object):
+    '''
+    A text with brace groups, e.g. "flights from {TLV|JFK} to {LHR|CDG}", parsed once
+    into literal segments and groups of alternatives. Groups can be nested
+    ("{a|b{c|d}}") and braces or pipes escaped with a backslash. A brace without a
+    match is kept as is.
+
+    Iterating yields every combination, first group varying slowest, without
+    recursing per group, and `count` is the number of combinations, known up front.
+    There's no len(): the count easily goes past what len() can return.
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.segments = parse(text)
+        self.count = count_segments(self.segments)
+
+    def __iter__(self):
+        return expand_segments(self.segments)
+
+
+def tokenize(text):
+    '''Splits text into literal runs, escapes and the special characters themselves'''
+    return [token for token in TOKENS_RE.split(text) if token]
+
 
-    brace = braces[0]
-    options = brace.split('|')
-    for option in options:
-        replaced = BRACES_RE.sub(option, text, count=1)
-        for sub_opt in expand_braces(replaced):
-            yield sub_opt
+def matching_braces(tokens):
+    '''Returns the indexes of the brace tokens which have a match'''
+    matched = set()
+    opened = []
+    for i, token in enumerate(tokens):
+        if token == '{':
+            opened.append(i)
+        elif token == '}' and opened:
+            matched.add(opened.pop())
+            matched.add(i)
+    return matched
 
 
+def parse(text):
+    '''
+    Parses text into a list of segments, each one either a literal string or a group:
+    a list of alternatives, each of them a list of segments again.
+    '''
+    if '{' not in text and '\\' not in text:
+        return [text] if text else []
+    tokens = tokenize(text)
+    braces = matching_braces(tokens)
+    # the innermost open group is on top, the text itself acts as a group of one
+    groups = [[[]]]
+    for i, token in enumerate(tokens):
+        if token == '{' and i in braces:
+            groups.append([[]])
+        elif token == '}' and i in braces:
+            group = groups.pop()
+            groups[-1][-1].append(group)
+        elif token == '|' and len(groups) > 1:
+            groups[-1].append([])
+        else:
+            if token in ESCAPES:
+                token = token[1]
+            alternative = groups[-1][-1]
+            if alternative and not isinstance(alternative[-1], list):
+                alternative[-1] += token
+            else:
+                alternative.append(token)
+    return groups[0][0]
+
+
+def count_segments(segments):
+    count = 1
+    for segment in segments:
+        if isinstance(segment, list):
+            count *= sum(count_segments(alternative) for alternative in segment)
+    return count
+
+
+def expand_segments(segments):
+    options = []
+    for segment in segments:
+        if isinstance(segment, list):
+            # a group's own options are needed once per combination, expand them once
+            options.append([text for alternative in segment
+                            for text in expand_segments(alternative)])
+        else:
+            options.append((segment,))
+    for combination in itertools.product(*options):
+        yield ''.join(combination)
+
+
+def expand_braces(text):
+    return iter(BraceTemplate(text))
+
 
+def count_braces(text):
+    return BraceTemplate(text).count
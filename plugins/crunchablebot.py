@@ -5,61 +5,139 @@ from __future__ import unicode_literals
 import os
 import json
 import gevent
+import gevent.event
+import gevent.pool
+import requests
+import requests.adapters
 from crunchable import Crunchable
-from braceexpand import expand_braces
+from crunchable.crunchable import BadStatus
+from braceexpand import BraceTemplate
 import logging
 from threading import Lock
-from contextlib import contextmanager
 import datetime
+import time
+import itertools
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    # python 2
+    from inspect import getargspec
 lock = Lock()
 
 
+# waits for the answers on greenlets, AsyncRtmBot refuses to load it
+REQUIRES_GEVENT = True
+
 outputs = []
-crontabs = []
+# every shard worker has a journal of its own to sync
+crontable = [[1, 'sync_state', {'every_shard': True}]]
 user_name = None
 user_id = None
 
 FILE = "plugins/tasks.json"
 
-def get_state_file():
-    global config
-    return config.get('CRUNCHABLE_STATE', 'plugins/state.json')
-
-@contextmanager
-def get_state():
-    filename = get_state_file()
-    with lock:
-        try:
-            state = json.loads(open(filename, 'rb').read())
-        except IOError:
-            state = {}
-        if 'pending' not in state:
-            state['pending'] = {}
-        yield state
-        open(filename, 'wb').write(json.dumps(state))
+class PendingStore(object):
+    """
+    Pending crunchable tasks, kept in memory and journaled to an append-only log of
+    json lines: ["add", id, channel, user, identifier] or ["pop", id].
+    Every record is flushed right away but only fsync'ed by sync() (run from the
+    crontable), which also compacts the log once it's mostly popped tasks.
+    A torn line at the end of the log (a crash mid-write) is skipped on replay.
+    """
+    COMPACT_MIN_RECORDS = 1000
+
+    def __init__(self, filename, legacy_filename=None):
+        self.filename = filename
+        self.pending = {}
+        self.records = 0
+        self.dirty = False
+        if os.path.isfile(filename):
+            self.replay()
+        elif legacy_filename and os.path.isfile(legacy_filename):
+            # state.json written by older versions of this plugin
+            self.pending = json.loads(open(legacy_filename, 'r').read()).get('pending', {})
+        self.journal = None
+        self.compact()
+
+    def replay(self):
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warn('skipping corrupt line in {}: {!r}'.format(self.filename, line))
+                    continue
+                if record[0] == 'add':
+                    self.pending[record[1]] = record[2:]
+                elif record[0] == 'pop':
+                    self.pending.pop(record[1], None)
+
+    def write(self, record):
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        self.records += 1
+        self.dirty = True
+
+    def add(self, id, channel, user, identifier):
+        with lock:
+            self.pending[id] = [channel, user, identifier]
+            self.write(['add', id, channel, user, identifier])
+
+    def pop(self, id):
+        with lock:
+            if self.pending.pop(id, None) is None:
+                logging.warn('tried to pop missing id: {}'.format(id))
+                return
+            self.write(['pop', id])
+
+    def items(self):
+        with lock:
+            return list(self.pending.items())
+
+    def sync(self):
+        with lock:
+            if self.records > max(self.COMPACT_MIN_RECORDS, 2 * len(self.pending)):
+                self.compact()
+            elif self.dirty:
+                os.fsync(self.journal.fileno())
+                self.dirty = False
+
+    def compact(self):
+        """Rewrites the log with only the live tasks, atomically replacing the old one"""
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            for id, (channel, user, identifier) in self.pending.items():
+                f.write(json.dumps(['add', id, channel, user, identifier]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.filename)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.filename, 'a')
+        self.records = len(self.pending)
+        self.dirty = False
+
+    def close(self):
+        with lock:
+            os.fsync(self.journal.fileno())
+            self.journal.close()
+
+pending_store = None
 
 def store_pending(id, channel, user, identifier):
-    with get_state() as state:
-        state['pending'][id] = [channel, user, identifier]
+    pending_store.add(id, channel, user, identifier)
 
 def pop_pending(id):
-    with get_state() as state:
-        try:
-            state['pending'].pop(id)
-        except KeyError:
-            logging.warn('tried to pop missing id: {}'.format(id))
+    pending_store.pop(id)
 
-def read_state():
-    with get_state() as state:
-        return state
+def sync_state():
+    pending_store.sync()
 
 def respond(channel, text):
-    global outputs
-    outputs.append([channel, text])
+    outbox.put(channel, text)
 
 def send_file(channel, content, filetype, filename):
-    global outputs
-    outputs.append([channel, 'FILE', content, filetype, filename])
+    outbox.put(channel, 'FILE', content, filetype, filename)
 
 def respond_to_user(channel, user, text):
     if channel.startswith('D'): #private chat
@@ -71,7 +149,7 @@ def dm_to_user(channel, user, text):
     if channel.startswith('D'): #private chat
         respond(channel, text)
     else:
-        outputs.append([channel, 'DM', user, text])
+        outbox.put(channel, 'DM', user, text)
 
 def head(text):
     try:
@@ -80,22 +158,198 @@ def head(text):
     except ValueError:
         return text, None
 
+class TaskCatalog(object):
+    """
+    The known tasks, read from tasks.json once and kept in memory with a case
+    insensitive index. The file is only read again when its mtime changes (checked
+    at most every CHECK_INTERVAL seconds), writes replace it atomically.
+    """
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tasks = {}
+        self.lowercase = {}
+        self.mtime = None
+        self.checked = 0
+        if not os.path.isfile(filename):
+            self.save()
+        self.load()
+
+    def load(self):
+        self.mtime = os.stat(self.filename).st_mtime
+        self.tasks = json.loads(open(self.filename, 'r').read())
+        self.lowercase = {identifier.lower(): identifier for identifier in self.tasks}
+
+    def refresh(self):
+        now = time.time()
+        if now - self.checked < self.CHECK_INTERVAL:
+            return
+        self.checked = now
+        if os.stat(self.filename).st_mtime != self.mtime:
+            logging.info('{} changed on disk, reloading'.format(self.filename))
+            self.load()
+
+    def get(self):
+        self.refresh()
+        return self.tasks
+
+    def find(self, identifier):
+        """Returns the identifier as it's stored, or None for unknown tasks"""
+        self.refresh()
+        return self.lowercase.get(identifier.lower())
+
+    def add(self, identifier, task):
+        with lock:
+            self.refresh()
+            self.tasks[identifier] = task
+            self.lowercase[identifier.lower()] = identifier
+            self.save()
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.tasks, indent=2))
+        os.rename(tmp, self.filename)
+        self.mtime = os.stat(self.filename).st_mtime
+
+catalog = None
+
 def get_tasks():
-    return json.loads(open(FILE, 'rb').read())
-def save_tasks(tasks):
-    with open(FILE, 'wb') as f:
-        f.write(json.dumps(tasks, indent=2))
-if not os.path.isfile(FILE):
-    save_tasks({})
+    return catalog.get()
+
 def add_new_task(identifier, task):
-    tasks = get_tasks()
-    tasks[identifier] = task
-    save_tasks(tasks)
+    catalog.add(identifier, task)
+
+def has_transport(cls):
+    """
+    Whether the crunchable client still does its HTTP calls through _get_json(url) and
+    _post(url, data) with its headers, the private methods PooledCrunchable replaces
+    """
+    for name, args in (('_get_json', ['self', 'url']), ('_post', ['self', 'url', 'data'])):
+        function = getattr(cls, name, None)
+        if function is None or getargspec(function).args != args:
+            return False
+    return True
+
+class PooledCrunchable(Crunchable):
+    """
+    A Crunchable client sharing keep-alive connections from a requests session, and
+    waiting for tasks through a single TaskPoller instead of one long poll per task.
+    The session is only used when the installed crunchable library has the transport
+    methods it replaces, otherwise requests go through the library unchanged.
+    """
+    def __init__(self, token, pool_size=10, poll_interval=2, max_errors=10, poll_block=60,
+                 **kwargs):
+        super(PooledCrunchable, self).__init__(token, **kwargs)
+        self.session = None
+        if has_transport(Crunchable) and hasattr(self, 'headers'):
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        else:
+            logging.warning('unsupported crunchable version, not pooling its connections')
+        self.poller = TaskPoller(self, pool_size, poll_interval, max_errors, poll_block)
+
+    def _get_json(self, url):
+        if self.session is None:
+            return super(PooledCrunchable, self)._get_json(url)
+        response = self.session.get(url, headers=self.headers)
+        if response.status_code != 200:
+            raise BadStatus(response.status_code)
+        return response.json()
+
+    def _post(self, url, data={}):
+        if self.session is None:
+            return super(PooledCrunchable, self)._post(url, data)
+        filtered_data = {k: v for k, v in data.items() if v is not None}
+        response = self.session.post(url, data=json.dumps(filtered_data), headers=self.headers)
+        if response.status_code != 200:
+            raise BadStatus(response.status_code)
+        return response.json()
+
+    def wait_for_task(self, task_id):
+        return self.poller.wait(task_id)
+
+class PollingFailed(Exception):
+    pass
+
+class PollingStopped(Exception):
+    pass
+
+class TaskPoller(object):
+    """
+    Waits for all pending tasks from one polling greenlet: in rounds `interval` apart it
+    long polls each pending task for up to `block` seconds, over at most `concurrency`
+    pooled connections, and wakes up the greenlets waiting for the tasks which are done.
+    Requests are bounded by the pool, about concurrency / block per second however many
+    tasks are pending, at the cost of a task done late in a round being noticed when its
+    turn comes. A task whose checks fail `max_errors` times in a row is given up on, its
+    waiters get PollingFailed.
+    """
+    def __init__(self, client, concurrency, interval, max_errors=10, block=60):
+        self.client = client
+        self.pool = gevent.pool.Pool(concurrency)
+        self.interval = interval
+        self.max_errors = max_errors
+        self.block = block
+        self.waiting = {}
+        self.errors = {}
+        self.greenlet = None
+
+    def wait(self, task_id):
+        result = self.waiting.get(task_id)
+        if result is None:
+            result = self.waiting[task_id] = gevent.event.AsyncResult()
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        return result.get()
+
+    def check(self, task_id):
+        try:
+            task = self.client.get_task(task_id, block=self.block)
+        except Exception as e:
+            logging.warning('Error while polling task {}: {}'.format(task_id, e))
+            errors = self.errors[task_id] = self.errors.get(task_id, 0) + 1
+            if errors >= self.max_errors:
+                logging.error('Giving up on task {} after {} errors'.format(task_id, errors))
+                del self.errors[task_id]
+                self.waiting.pop(task_id).set_exception(PollingFailed(task_id))
+            return
+        self.errors.pop(task_id, None)
+        if task['status'] in ['complete', 'flagged']:
+            self.waiting.pop(task_id).set(task)
+
+    def stop(self):
+        """Stops polling, the tasks' waiters get PollingStopped"""
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.pool.kill()
+        waiting, self.waiting = self.waiting, {}
+        for task_id, result in waiting.items():
+            result.set_exception(PollingStopped(task_id))
+
+    def run(self):
+        try:
+            while self.waiting:
+                for _ in self.pool.imap_unordered(self.check, list(self.waiting)):
+                    pass
+                if self.waiting:
+                    gevent.sleep(self.interval)
+        finally:
+            self.greenlet = None
+
+client = None
 
 def get_crunchable_client():
-    global config
-    token = config['CRUNCHABLE_TOKEN']
-    client = Crunchable(token)
+    global client
+    if client is None:
+        client = PooledCrunchable(config['CRUNCHABLE_TOKEN'],
+                                  pool_size=config.get('CRUNCHABLE_POOL_SIZE', 10),
+                                  poll_interval=config.get('CRUNCHABLE_POLL_INTERVAL', 2),
+                                  max_errors=config.get('CRUNCHABLE_POLL_MAX_ERRORS', 10),
+                                  poll_block=config.get('CRUNCHABLE_POLL_BLOCK', 60))
     return client
 
 def send_task(task, attachments):
@@ -105,7 +359,15 @@ def send_task(task, attachments):
     return response['response']
 
 def wait_for_task(channel, user, client, task_id, identifier):
-    response = client.wait_for_task(task_id)
+    try:
+        response = client.wait_for_task(task_id)
+    except PollingStopped:
+        # the plugin is going away, the task stays pending for whoever recovers it
+        return None
+    except PollingFailed:
+        respond_to_user(channel, user, "Sorry, I couldn't get the response to your {} request".format(identifier))
+        pop_pending(task_id)
+        return None
     if response['status'] == 'complete':
         answer = response.get('response', '')
     else:
@@ -116,27 +378,83 @@ def wait_for_task(channel, user, client, task_id, identifier):
     return (identifier, response['attachments'][0], answer)
 
 def send_tasks(channel, user, identifier, task, attachments):
+    max_fanout = config.get('CRUNCHABLE_MAX_FANOUT', 50)
+    # brace templates know their size up front, otherwise never enumerate more than we'd accept
+    if isinstance(attachments, BraceTemplate):
+        # can be far past sys.maxsize, which len() refuses
+        count = attachments.count
+    elif isinstance(attachments, (list, tuple)):
+        count = len(attachments)
+    else:
+        attachments = list(itertools.islice(attachments, max_fanout + 1))
+        count = len(attachments)
+    if count > max_fanout:
+        respond_to_user(channel, user, "Sorry, that's {} requests, I can only take {} at once. Can you narrow it down?".format(count, max_fanout))
+        return
+    attachments = list(attachments)
     client = get_crunchable_client()
-    requests = [client.request_free_text(attachments=[att], **task) for att in attachments]
-    [store_pending(req['id'], channel, user, identifier) for req in requests]
-    asyncs = [gevent.spawn(wait_for_task, channel, user, client, req['id'], identifier) for req in requests]
-    if len(asyncs) > 1:
-        responses = gevent.joinall(asyncs)
-        lines = [','.join(response.value) for response in responses]
-        content = '\n'.join(lines)
-        respond_to_user(channel, user, 'And to summarize:')
-        send_file(channel, content, 'csv', 'crunchable-responses-{}.csv'.format(datetime.datetime.now().isoformat()))
+
+    def send_and_wait(attachment):
+        try:
+            request = client.request_free_text(attachments=[attachment], **task)
+            store_pending(request['id'], channel, user, identifier)
+            return wait_for_task(channel, user, client, request['id'], identifier)
+        except Exception:
+            logging.exception('failed sending task {} {}'.format(identifier, attachment))
+
+    if len(attachments) == 1:
+        send_and_wait(attachments[0])
+        return
+    total = len(attachments)
+    # every answer is posted anyway, only bigger batches get a progress report
+    progress_step = total // 4 if total >= 10 else total
+    # bounds how many requests are submitted and waited for at the same time
+    pool = gevent.pool.Pool(config.get('CRUNCHABLE_CONCURRENCY', 10))
+    filename = 'crunchable-responses-{}'.format(datetime.datetime.now().isoformat())
+    lines = []
+    # the summary is streamed: each progress report comes with the answers since the last one
+    reported = 0
+    for done, result in enumerate(pool.imap_unordered(send_and_wait, attachments), 1):
+        if result is not None:
+            lines.append(','.join(result))
+        if done < total and done % progress_step == 0:
+            if len(lines) == reported:
+                respond_to_user(channel, user, 'Got {} out of {} answers so far...'.format(done, total))
+                continue
+            respond_to_user(channel, user, 'Got {} out of {} answers so far, here they are:'.format(done, total))
+            send_file(channel, '\n'.join(lines[reported:]), 'csv', '{}-part-{}.csv'.format(filename, done // progress_step))
+            reported = len(lines)
+    respond_to_user(channel, user, 'And to summarize:')
+    send_file(channel, '\n'.join(lines), 'csv', '{}.csv'.format(filename))
 
 def recover_state():
-    state = read_state()
-    pending = state.get('pending', {})
     client = get_crunchable_client()
-    for (id, [channel, user, identifier]) in pending.iteritems():
+    for (id, [channel, user, identifier]) in pending_store.items():
         gevent.spawn(wait_for_task, channel, user, client, id, identifier)
 
 def setup():
+    global pending_store, catalog
+    catalog = TaskCatalog(FILE)
+    journal = config.get('CRUNCHABLE_JOURNAL', 'plugins/state.journal')
+    legacy = config.get('CRUNCHABLE_STATE', 'plugins/state.json')
+    shard = config.get('SHARD')
+    if shard:
+        # with SHARDS every worker journals, and recovers, only the tasks it sent
+        journal = '{}.{}'.format(journal, shard)
+        legacy = None
+    pending_store = PendingStore(journal, legacy_filename=legacy)
     recover_state()
 
+def teardown():
+    """
+    Stops waiting for the pending tasks before the plugin is reloaded or unloaded,
+    they stay in the journal and the next setup() recovers them
+    """
+    if client is not None:
+        client.poller.stop()
+    if pending_store is not None:
+        pending_store.close()
+
 SOMETHING_ELSE = 'Nothing fits'
 NOT_A_REQUEST = 'Irrelevant/Nonsense'
 
@@ -151,9 +469,9 @@ RECOGNIZE_TASK = dict(
 def crunchable_recognize_task(text):
     client = get_crunchable_client()
     tasks = get_tasks()
-    attachments = ['**Request:** {}'.format(text)] #  + ['{}: {}'.format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.iteritems())]
+    attachments = ['**Request:** {}'.format(text)] #  + ['{}: {}'.format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.items())]
     # choices = sorted(tasks.keys()) + [SOMETHING_ELSE, NOT_A_REQUEST]
-    choices = ['{}: {}'.format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.iteritems())] + [SOMETHING_ELSE, NOT_A_REQUEST]
+    choices = ['{}: {}'.format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.items())] + [SOMETHING_ELSE, NOT_A_REQUEST]
     request = client.request_multiple_choice(choices=choices, attachments=attachments, **RECOGNIZE_TASK)
     response = client.wait_for_task(request['id'])
     [choice] = response['response']
@@ -168,7 +486,7 @@ AUTOLEARN_TASK = dict(
 def crunchable_autolearn_task(channel, user, text):
     client = get_crunchable_client()
     tasks = get_tasks()
-    attachments = ['**Request:** ' + text] + ["**Example:**\nIdentifier: {}\nInstruction: {}".format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.iteritems())]
+    attachments = ['**Request:** ' + text] + ["**Example:**\nIdentifier: {}\nInstruction: {}".format(identifier, task['instruction']) for (identifier, task) in sorted(tasks.items())]
     request = client.request_free_text(attachments=attachments, **AUTOLEARN_TASK)
     response = client.wait_for_task(request['id'])['response']
     identifier = response['identifier'].strip()
@@ -211,20 +529,23 @@ def handle_unrecognized_commmand(channel, user, text):
 
 def trigger_known_instruction(channel, user, task, text, identifier):
     respond_to_user(channel, user, "Please wait while I look for someone to answer you...")
-    send_tasks(channel, user, identifier, task, attachments=expand_braces(text))
+    send_tasks(channel, user, identifier, task, attachments=BraceTemplate(text))
 
-def trigger_internal_fetch(channel, user, text, slack_client):
+def trigger_internal_fetch(channel, user, text, slack_client, directory):
     users_to_fetch = text.split()
     respond_to_user(channel, user, "Sure, I'll fetch him for you! hang tight!")
     client = get_crunchable_client()
 
-    username = slack_client.api_call('users.info', user=user)['user']['name']
+    user_info = directory.user(user)
+    if user_info is None:
+        user_info = slack_client.api_call('users.info', user=user)['user']
+    username = user_info['name']
     for user in users_to_fetch:
         client.request_multiple_choice(instruction="Please contact {} on Slack. Thanks!".format(username), choices=["Sure!", "OK!"], min_answers=1, max_answers=1, choices_type="text", tags=[user], priority=10)
 
 def show_help_messsage(channel, tasks):
     respond(channel, "Here's what I already know how to do:")
-    for identifier, task in tasks.iteritems():
+    for identifier, task in tasks.items():
         respond(channel, "{} - {}".format(identifier, task['instruction']))
     respond(channel, "But you can easily teach me new stuff! simply use:")
     show_teach_instruction(channel)
@@ -233,7 +554,7 @@ def show_teach_instruction(channel):
     respond(channel, "@crunchable-bot: teach <keyword> '<detailed instruction>'")
     respond(channel, "For example: @crunchable-bot: teach gettimezone 'Search google for the timezone of the given city'")    
 
-def process_message(data):
+def process_message(data, context):
     channel = data["channel"]
     logging.info('crunchable sees {}'.format(data))
     if 'text' not in data:
@@ -284,12 +605,10 @@ def process_message(data):
             return
         if lidentifier == 'fetch':
             if config.get('internal', False):
-                return gevent.spawn(trigger_internal_fetch, channel, user, rest, data['__slack_client'])
+                return gevent.spawn(trigger_internal_fetch, channel, user, rest, context.slack_client, context.directory)
             else:
                 return respond_to_user(channel, user, "I'm not sure what you want me to do...")
-        lowercase_to_originalcase = {task_id.lower(): task_id for task_id in tasks}
-        if lidentifier in lowercase_to_originalcase:
-            identifier = lowercase_to_originalcase[lidentifier]
+        identifier = catalog.find(identifier) or identifier
         if identifier in tasks:
             logging.info("{} recognized as task".format(identifier))
             return gevent.spawn(trigger_known_instruction, channel, user, tasks[identifier], rest, identifier)
@@ -307,9 +626,3 @@ def process_user_info(data):
         user_name = data['user']
     if 'user_id' in data:
         user_id = data['user_id']
-
-def catch_all(data):
-    return # disabled for now
-    global config
-    print(config)
-    print("[ALL]", data)
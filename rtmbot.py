@@ -1,11 +1,10 @@
 #!/usr/bin/env python
-import gevent.monkey; gevent.monkey.patch_all()
+import logging
 import sys
+import time
 from argparse import ArgumentParser
 
 import yaml
-from rtmbot import RtmBot
-import logging
 
 def parse_args():
     parser = ArgumentParser()
@@ -20,8 +19,19 @@ def parse_args():
 # load args with config path
 args = parse_args()
 config = yaml.load(open(args.config or 'rtmbot.conf', 'r'))
+if config.get('ASYNC', False):
+    from rtmbot.aio import AsyncRtmBot as RtmBot
+else:
+    # patches the standard library, this has to happen before anything else imports it
+    import gevent.monkey; gevent.monkey.patch_all()
+    from rtmbot import RtmBot
+
+from rtmbot.connection import Backoff  # noqa: E402, after the monkey patching
+
 bot = RtmBot(config)
+backoff = Backoff()
 while True:
+    started = time.time()
     try:
         logging.info('starting bot')
         bot.start()
@@ -29,4 +39,8 @@ while True:
         sys.exit(0)
     except Exception as e:
         logging.exception("Something wrong happened, restarting...") 
+    # don't hammer Slack when the bot keeps crashing right after starting
+    if time.time() - started > 60:
+        backoff.reset()
+    time.sleep(backoff.next_delay())
 
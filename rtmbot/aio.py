@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+'''
+    RtmBot on an asyncio event loop, for python 3.5 and later. Not imported by the
+    rtmbot package, so the rest of it keeps working on python 2:
+
+        from rtmbot.aio import AsyncRtmBot
+'''
+from __future__ import unicode_literals
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import OutputList, Plugin, RtmBot, job_options
+from .scheduler import Job, monotonic
+
+
+def is_async(function):
+    return asyncio.iscoroutinefunction(function)
+
+
+def watch(future, on_failure):
+    '''Hands the exception of the future, once done, to on_failure'''
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            on_failure(future.exception())
+    future.add_done_callback(done)
+    return future
+
+
+class AsyncJob(Job):
+    '''
+        A job of an AsyncPlugin: a coroutine function runs as a task on the event loop,
+        a plain function on the plugin's executor. A run still going when the next one
+        is due is skipped, like a background job.
+    '''
+    def __init__(self, interval, function, debug, executor=None, **options):
+        super(AsyncJob, self).__init__(interval, function, debug, **options)
+        self.executor = executor
+        self.future = None
+        # optional, called with the exception a run raised in debug mode
+        self.on_failure = None
+
+    def run(self):
+        if self.future is not None and not self.future.done():
+            logging.warning("Skipping job still running: {}".format(self.function))
+            return
+        if is_async(self.function):
+            self.future = asyncio.ensure_future(self.execute_async())
+        else:
+            self.future = asyncio.get_event_loop().run_in_executor(self.executor, self.execute)
+        watch(self.future, self.failed)
+
+    def failed(self, exception):
+        if self.on_failure is not None:
+            self.on_failure(exception)
+
+    async def execute_async(self):
+        start = monotonic()
+        failed = False
+        try:
+            await self.function()
+        except Exception:
+            failed = True
+            if self.debug is True:
+                raise
+            logging.exception("Problem in job check: {}".format(self.function))
+        finally:
+            if self.observe is not None:
+                self.observe(self, monotonic() - start, failed)
+        self.lastrun = time.time()
+
+
+class AsyncPlugin(Plugin):
+    '''
+        A plugin of an AsyncRtmBot. Handlers, jobs and setup() defined with `async def`
+        run as tasks on the event loop. The plugin's plain functions run off the loop on
+        a thread of its own, one at a time and in order as they would on RtmBot, or on
+        the plugin's EXECUTOR when it has one. A plugin relying on gevent says so with
+        REQUIRES_GEVENT = True, and is refused.
+    '''
+    def __init__(self, name, *args, **kwargs):
+        self.sync_executor = ThreadPoolExecutor(1)
+        # the running tasks, asyncio only keeps weak references to them
+        self.tasks = set()
+        super(AsyncPlugin, self).__init__(name, *args, **kwargs)
+
+    def prepare_module(self, setup=True):
+        if getattr(self.module, 'REQUIRES_GEVENT', False):
+            # its greenlets would never run, the plugin would just never answer
+            raise ValueError('plugin {} requires gevent, run it without ASYNC'.format(self.name))
+        if self.waker is not None:
+            self.module.outputs = OutputList(getattr(self.module, 'outputs', []), self.waker)
+        function = getattr(self.module, 'setup', None)
+        if is_async(function):
+            # a task doesn't hold up loading the other plugins, it starts right away
+            self.spawn(function())
+        elif setup and function is not None:
+            function()
+
+    def setup_function(self):
+        function = super(AsyncPlugin, self).setup_function()
+        return None if is_async(function) else function
+
+    def make_job(self, entry):
+        interval, function = entry[:2]
+        options = job_options(entry)
+        job = AsyncJob(interval, getattr(self.module, function), self.debug,
+                       executor=self.sync_executor, **options)
+        job.options = options
+        job.observe = self.observe_job
+        job.profiler = self.profiler
+        job.on_failure = self.failed
+        return job
+
+    def call(self, handler, data, context=None):
+        args = (data, context) if handler in self.context_handlers else (data,)
+        if is_async(handler):
+            self.spawn(self.invoke_async(handler, *args))
+        elif self.executor is not None:
+            self.submit(handler, *args)
+        else:
+            watch(asyncio.get_event_loop().run_in_executor(
+                self.sync_executor, self.invoke, handler, *args), self.failed)
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return watch(task, self.failed)
+
+    async def invoke_async(self, handler, data, *args):
+        start = monotonic()
+        failed = False
+        try:
+            await handler(data, *args)
+        except Exception:
+            failed = True
+            if self.debug is True:
+                raise
+            logging.exception("problem in module {} {} {}".format(
+                self.name, getattr(handler, '__name__', handler), data))
+        finally:
+            self.observe_handler(handler, monotonic() - start, failed)
+
+
+class AsyncRtmBot(RtmBot):
+    '''
+        RtmBot on an asyncio event loop instead of gevent, with plugins loaded as
+        AsyncPlugins. The bot's own blocking calls (connecting, the Web API, sending
+        outputs) run on a thread pool, so the loop only ever waits on its sockets.
+
+        Takes the same config as RtmBot, plus:
+            - BLOCKING_WORKERS (optional: defaults to 4) threads for the blocking calls
+        LOOP is always event, SHARDS is not supported and neither is a plugin EXECUTOR of
+        gevent, whose greenlets would never run without gevent's loop.
+    '''
+    def __init__(self, config):
+        if (config.get('SHARDS') or 1) > 1:
+            raise ValueError('SHARDS is not supported by AsyncRtmBot')
+        super(AsyncRtmBot, self).__init__(dict(config, LOOP='event'))
+        self.blocking = ThreadPoolExecutor(self.config.get('BLOCKING_WORKERS', 4))
+        self.event_loop = None
+        self.wakeup = None
+
+    def make_plugin(self, name, plugin_config, path, setup=True):
+        if plugin_config.get('EXECUTOR') == 'gevent':
+            raise ValueError('EXECUTOR gevent is not supported by AsyncRtmBot, plugin {}'.format(
+                name))
+        plugin = AsyncPlugin(name, plugin_config, waker=self.waker, path=path,
+                             metrics=self.metrics, profiler=self.profiler, setup=setup)
+        plugin.on_failure = self.fail
+        return plugin
+
+    def unload_plugin(self, plugin):
+        super(AsyncRtmBot, self).unload_plugin(plugin)
+        for task in list(plugin.tasks):
+            task.cancel()
+        plugin.sync_executor.shutdown(wait=False)
+
+    def fail(self, exception):
+        super(AsyncRtmBot, self).fail(exception)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _start(self):
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        try:
+            self.event_loop.run_until_complete(self.run())
+        finally:
+            self.event_loop.close()
+            self.event_loop = self.wakeup = None
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.event_loop.add_reader(self.waker.fileno(), self.wakeup.set)
+        self.start_metrics_server()
+        if self.profiler is not None:
+            self.profiler.start()
+        await self.blocking_call(self.connect)
+        # start() runs again after a crash, the plugins are still there
+        if not self.plugins_loaded:
+            self.load_plugins()
+        for connection in self.connections:
+            if connection.connected:
+                await self.user_info(connection)
+        while True:
+            await self.tick()
+
+    async def tick(self, max_reads=100):
+        self.check_failure()
+        self.waker.drain()
+        await self.reconnect_due()
+        self.read(max_reads)
+        self.crons()
+        await self.blocking_call(self.output)
+        self.autoping()
+        await self.wait(self._next_timeout())
+
+    def blocking_call(self, function, *args):
+        return self.event_loop.run_in_executor(self.blocking, function, *args)
+
+    async def reconnect_due(self):
+        # read() would reconnect too, but on the loop
+        for connection in self.connections:
+            if not connection.connected and connection.retry_due():
+                if await self.blocking_call(connection.reconnect):
+                    await self.user_info(connection)
+
+    async def user_info(self, connection):
+        user_info = await self.blocking_call(connection.slack_client.api_call, 'auth.test')
+        user_info['type'] = 'user_info'
+        self.input(user_info, connection)
+
+    async def wait(self, timeout):
+        sockets = []
+        for connection in self.connections:
+            if connection.connected:
+                sock = connection.slack_client.server.websocket.sock
+                if hasattr(sock, 'pending') and sock.pending():
+                    # the ssl layer already holds decrypted data, the loop won't see it
+                    return
+                sockets.append(sock)
+        for sock in sockets:
+            self.event_loop.add_reader(sock, self.wakeup.set)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for sock in sockets:
+                self.event_loop.remove_reader(sock)
+            self.wakeup.clear()
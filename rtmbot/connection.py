@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import itertools
+import json
+import logging
+import random
+import threading
+from collections import OrderedDict
+
+from slackclient import SlackClient
+from websocket import ABNF
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from .scheduler import monotonic
+from .directory import ChannelIndex, Directory
+
+if ujson is not None:
+    def dumps(value):
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+else:
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+class IdAllocator(object):
+    '''Message ids, unique across the threads and greenlets sending'''
+    def __init__(self, start=1):
+        self.ids = itertools.count(start)
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.ids)
+
+    # python 2
+    next = __next__
+
+# ids of the messages and pings sent over the websocket
+counter = IdAllocator()
+
+
+class RtmConnectError(Exception):
+    pass
+
+
+class Backoff(object):
+    '''
+        Jittered exponential backoff: the n-th delay is picked at random between 0 and
+        min(cap, base * 2 ** n), so bots disconnected together don't retry together.
+    '''
+    def __init__(self, base=1, cap=60):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class EventContext(object):
+    '''
+        Where an event came from, given to the handlers which take a second argument:
+
+            def process_message(data, context):
+                user = context.directory.user(data['user'])
+    '''
+    __slots__ = ('connection',)
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def slack_client(self):
+        return self.connection.slack_client
+
+    @property
+    def directory(self):
+        return self.connection.directory
+
+    @property
+    def workspace(self):
+        '''The id of the workspace'''
+        return self.connection.team_id
+
+
+class Connection(object):
+    '''
+        One RTM connection: the SlackClient, the directory of its workspace and the
+        liveness of its websocket. Pings carry an id and a connection whose oldest ping
+        went unanswered for `ping_timeout` seconds is considered dead. A lost connection
+        is retried with jittered exponential backoff, without blocking the main loop.
+
+        Events are written to a buffer which flush() sends in one go. Messages carry an
+        id, and ack() matches Slack's replies to them with when and by whom they were sent.
+
+        With RTM_CONNECT set it connects with rtm.connect, which skips the snapshot of
+        every channel and user rtm.start returns, and channels and users are fetched
+        one by one the first time they are needed instead.
+    '''
+    def __init__(self, token, config=None, clock=monotonic):
+        if config is None:
+            config = {}
+        self.token = token
+        self.clock = clock
+        self.slack_client = None
+        self.channel_index = None
+        # the id of the workspace, known once connected
+        self.team_id = None
+        # the bot's latest user_info event, replayed to plugins activated later on
+        self.user_info = None
+        # the OutboundQueue of the workspace, when outputs are queued
+        self.outbound = None
+        self.directory = Directory(config.get('DM_CACHE_TTL', 3600))
+        self.lightweight = config.get('RTM_CONNECT', False)
+        if self.lightweight:
+            self.directory.fetch_channel = self.fetch_channel
+            self.directory.fetch_user = self.fetch_user
+        self.ping_interval = config.get('PING_INTERVAL', 3)
+        self.ping_timeout = config.get('PING_TIMEOUT', 10)
+        self.backoff = Backoff(config.get('RECONNECT_BASE_DELAY', 1),
+                               config.get('RECONNECT_MAX_DELAY', 60))
+        # monotonic time of the next connection attempt, None while connected
+        self.retry_at = None
+        self.last_ping = 0
+        # ping id -> monotonic time it was sent
+        self.pings = {}
+        self.reconnects = 0
+        self.disconnects = 0
+        # (payload, message id, origin) of the frames written since the last flush
+        self.frames = []
+        # how many frames the last flush got out, all of them unless it failed
+        self.flushed = 0
+        # the start of the JSON of a message to a channel, by channel id
+        self.message_prefixes = {}
+        # message id -> (monotonic time it was sent, plugin it came from), until Slack acks it
+        self.unacked = OrderedDict()
+        self.ack_timeout = config.get('ACK_TIMEOUT', 30)
+        self.context = EventContext(self)
+
+    @property
+    def connected(self):
+        return self.slack_client is not None and self.retry_at is None
+
+    def connect(self):
+        '''Connects, or reconnects, to the RTM API; raises RtmConnectError on failure'''
+        if self.slack_client is None:
+            self.slack_client = SlackClient(self.token)
+            logging.info(self.slack_client)
+        server = self.slack_client.server
+        try:
+            if self.lightweight:
+                self.rtm_connect_lightweight(server)
+            else:
+                # a full rtm.start, the directory has to catch up on what happened meanwhile
+                server.rtm_connect()
+        except Exception as e:
+            raise RtmConnectError(e)
+        login_data = server.login_data or {}
+        self.team_id = login_data.get('team', {}).get('id')
+        self.directory.load(login_data)
+        self.retry_at = None
+        self.pings = {}
+        self.last_ping = self.clock()
+        self.backoff.reset()
+
+    def rtm_connect_lightweight(self, server):
+        reply = self.slack_client.api_call('rtm.connect')
+        if not reply.get('ok'):
+            raise RtmConnectError(reply.get('error'))
+        server.login_data = reply
+        server.domain = reply['team']['domain']
+        server.username = reply['self']['name']
+        server.connect_slack_websocket(reply['url'])
+
+    def fetch_channel(self, channel_id):
+        reply = self.slack_client.api_call('conversations.info', channel=channel_id)
+        return self._fetched(reply, 'channel')
+
+    def fetch_user(self, user_id):
+        reply = self.slack_client.api_call('users.info', user=user_id)
+        return self._fetched(reply, 'user')
+
+    @staticmethod
+    def _fetched(reply, key):
+        if reply.get('ok'):
+            return reply[key]
+        if reply.get('error', '').endswith('_not_found'):
+            return None
+        # rate limited or the like, worth asking again later
+        raise LookupError(reply.get('error'))
+
+    def lost(self, reason):
+        '''Drops the websocket and schedules the next connection attempt'''
+        logging.warning('connection lost: {}'.format(reason))
+        self.disconnects += 1
+        server = self.slack_client.server if self.slack_client is not None else None
+        if server is not None and server.websocket is not None:
+            try:
+                server.websocket.close()
+            except Exception:
+                pass
+        self.pings = {}
+        self.frames = []
+        delay = self.backoff.next_delay()
+        self.retry_at = self.clock() + delay
+        logging.info('reconnecting in {:.1f}s'.format(delay))
+
+    def retry_due(self):
+        return self.retry_at is not None and self.clock() >= self.retry_at
+
+    def reconnect(self):
+        '''Makes one connection attempt, returns True when it succeeded'''
+        self.reconnects += 1
+        try:
+            self.connect()
+        except RtmConnectError as e:
+            self.lost(e)
+            return False
+        logging.info('reconnected after {} attempt(s)'.format(self.reconnects))
+        self.reconnects = 0
+        return True
+
+    def autoping(self):
+        '''Pings every `ping_interval` seconds, returns False once the connection is dead'''
+        now = self.clock()
+        if self.pings and now - min(self.pings.values()) > self.ping_timeout:
+            return False
+        if now >= self.last_ping + self.ping_interval:
+            ping_id = next(counter)
+            self.send({'id': ping_id, 'type': 'ping'})
+            self.flush()
+            self.pings[ping_id] = now
+            self.last_ping = now
+        return True
+
+    def pong(self, reply_to):
+        self.pings.pop(reply_to, None)
+
+    def next_ping(self):
+        '''Returns the monotonic time of the next ping'''
+        return self.last_ping + self.ping_interval
+
+    def send(self, message):
+        '''Writes an event, it goes out with the next flush'''
+        self.frames.append((dumps(message), None, None))
+
+    def send_message(self, channel_id, text, origin=None):
+        '''Writes a message, returns its id; Slack's reply to it goes to ack()'''
+        prefix = self.message_prefixes.get(channel_id)
+        if prefix is None:
+            prefix = '{{"type":"message","channel":{},"text":'.format(dumps(channel_id))
+            self.message_prefixes[channel_id] = prefix
+        message_id = next(counter)
+        self.frames.append(
+            ('{}{},"id":{}}}'.format(prefix, dumps(text), message_id), message_id, origin))
+        return message_id
+
+    def flush(self):
+        '''
+            Sends the frames written since the last flush, in one socket write. Messages
+            wait for Slack's ack once sent. When the write fails, `flushed` tells how many
+            frames got out before it did.
+        '''
+        frames, self.frames = self.frames, []
+        self.flushed = 0
+        if not frames:
+            return 0
+        # straight to the websocket: slackclient's send_to_websocket swallows errors and
+        # reconnects on its own, without any backoff
+        websocket = self.slack_client.server.websocket
+        try:
+            if len(frames) == 1:
+                websocket.send(frames[0][0])
+                self.flushed = 1
+            else:
+                self.write_frames(websocket, [frame[0] for frame in frames])
+        finally:
+            now = self.clock()
+            for _, message_id, origin in frames[:self.flushed]:
+                if message_id is not None:
+                    self.unacked[message_id] = (now, origin)
+        return len(frames)
+
+    def write_frames(self, websocket, payloads):
+        '''What WebSocket.send_frame does, for several frames, counting those written'''
+        encoded = [self.encode_frame(websocket, payload) for payload in payloads]
+        data = b''.join(encoded)
+        ends = []
+        for frame in encoded:
+            ends.append((ends[-1] if ends else 0) + len(frame))
+        written = 0
+        with websocket.lock:
+            try:
+                while written < len(data):
+                    written += websocket._send(data[written:])
+            finally:
+                self.flushed = sum(1 for end in ends if end <= written)
+
+    @staticmethod
+    def encode_frame(websocket, payload):
+        frame = ABNF.create_frame(payload, ABNF.OPCODE_TEXT)
+        if websocket.get_mask_key:
+            frame.get_mask_key = websocket.get_mask_key
+        return frame.format()
+
+    def ack(self, reply):
+        '''Matches Slack's reply to a message sent, returns its (origin, seconds) or None'''
+        sent = self.unacked.pop(reply.get('reply_to'), None)
+        if sent is None:
+            return None
+        return sent[1], self.clock() - sent[0]
+
+    def expire_acks(self):
+        '''Gives up on the messages unacked for `ack_timeout` seconds, returns their origins'''
+        expired = []
+        deadline = self.clock() - self.ack_timeout
+        while self.unacked:
+            message_id, (sent_at, origin) = next(iter(self.unacked.items()))
+            if sent_at > deadline:
+                break
+            del self.unacked[message_id]
+            expired.append(origin)
+        return expired
+
+    def find_channel(self, key):
+        channels = self.slack_client.server.channels
+        if self.channel_index is None or self.channel_index.channels is not channels:
+            self.channel_index = ChannelIndex(channels)
+        # the directory follows renames, slackclient's channel names never change
+        channel = self.channel_index.find(self.directory.channel_id(key) or key)
+        if channel is None and self.lightweight:
+            info = self.directory.channel(key)
+            if info is not None:
+                self.slack_client.server.attach_channel(
+                    info.get('name', info['id']), info['id'], info.get('members'))
+                channel = self.channel_index.find(info['id'])
+        return channel
+
+    def open_dm_channel(self, user):
+        dm_channel_request = self.slack_client.api_call('im.open', user=user)
+        dm_channel_id = dm_channel_request['channel']['id']
+        self.directory.ims.set(user, dm_channel_id)
+        return dm_channel_id
@@ -1,23 +1,146 @@
 #!/usr/bin/env python
 from __future__ import unicode_literals
 import sys
-import glob
 import os
 import time
 import logging
-import json
-import itertools
+import select
+import errno
+import socket
+import ssl
+import fcntl
+import inspect
+import threading
+from collections import deque
 
-from slackclient import SlackClient
-from websocket import WebSocketConnectionClosedException
+from websocket import WebSocketException
+
+from .scheduler import Job, Scheduler, monotonic, string_types
+from .executors import make_executor
+from .outbound import OutboundQueue, Output, SPECIAL_OUTPUTS
+from .watcher import PluginWatcher
+from .connection import Connection, RtmConnectError
+from .sharding import ShardPool
+from .metrics import MetricsServer, Registry
+from .profiling import Profiler
+from .manifest import PluginManifest, plugin_name
+
+try:
+    from importlib import reload as reload_module
+except ImportError:
+    # python 2
+    reload_module = reload  # noqa: F821
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    # python 2
+    from inspect import getargspec
 
 sys.dont_write_bytecode = True
 
-counter = itertools.count(1)
+# errors of a websocket which is gone, the connection is re-established after them. A
+# write which would block counts too, it may have left half a frame on the socket
+try:
+    CONNECTION_ERRORS = (WebSocketException, ssl.SSLError, socket.timeout, ConnectionError,
+                         BlockingIOError)
+except NameError:
+    # python 2, where every socket error is a socket.error
+    CONNECTION_ERRORS = (WebSocketException, socket.error)
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# how events used to carry their context, still set for the plugins reading them
+EVENT_KEYS = ('__slack_client', '__directory', '__workspace')
+
+
+class Waker(object):
+    '''
+        A self-pipe the event loop selects on alongside the websocket, so that
+        output enqueued outside of the loop (from a greenlet or a thread) wakes
+        it up immediately instead of waiting for the next timeout.
+    '''
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._armed = False
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        if self._armed:
+            return
+        self._armed = True
+        try:
+            os.write(self._write_fd, b'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        # disarm once the pipe is empty, disarming first lets a wake() racing with the
+        # read write a byte we swallow and leave the waker armed, dropping later wakes.
+        # A wake() skipped meanwhile is harmless, the loop collects output after draining
+        self._armed = False
+
+
+class OutputList(list):
+    '''
+        Drop-in replacement for a plugin's `outputs` list which wakes the event
+        loop whenever something is appended to it.
+    '''
+    def __init__(self, items=(), waker=None):
+        super(OutputList, self).__init__(items)
+        self.waker = waker
+
+    def append(self, item):
+        super(OutputList, self).append(item)
+        self.waker.wake()
+
+    def extend(self, items):
+        super(OutputList, self).extend(items)
+        self.waker.wake()
+
+    def insert(self, index, item):
+        super(OutputList, self).insert(index, item)
+        self.waker.wake()
+
+
+class Outbox(object):
+    '''
+        A thread and greenlet safe output queue, injected into every plugin as `outbox`.
+        Plugins can use it instead of appending to their `outputs` list:
+
+            outbox.put("C12345667", "hello world")
+    '''
+    def __init__(self, waker=None):
+        self.queue = deque()
+        self.waker = waker
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, *output):
+        self.queue.append(list(output))
+        if self.waker is not None:
+            self.waker.wake()
+
+    def drain(self):
+        items = []
+        # popleft is atomic, anything put while we drain is either taken now or next time
+        try:
+            while True:
+                items.append(self.queue.popleft())
+        except IndexError:
+            return items
 
-def channel_send_message(channel, message):
-    global counter
-    return channel.server.websocket.send(json.dumps({'id': counter.next(), 'type': 'message', 'text': message, 'channel': channel.id}))
 
 class RtmBot(object):
     def __init__(self, config):
@@ -25,12 +148,57 @@ class RtmBot(object):
             Params:
                 - config (dict):
                     - SLACK_TOKEN: your authentication token from Slack
+                    - SLACK_TOKENS (optional) tokens of more workspaces to serve from
+                        this bot, every plugin sees the events of all of them
                     - BASE_PATH (optional: defaults to execution directory) RtmBot will
                         look in this directory for plugins.
                     - LOGFILE (optional: defaults to rtmbot.log) The filename for logs, will
                         be stored inside the BASE_PATH directory
                     - DEBUG (optional: defaults to False) with debug enabled, RtmBot will
                         break on errors
+                    - LOOP (optional: defaults to 'poll') 'poll' reads the websocket every
+                        100ms, 'event' blocks on the websocket and only wakes up for incoming
+                        events, due cron jobs, pings or plugin output
+                    - LOOP_MAX_WAIT (optional: defaults to 1.0) the longest the 'event' loop
+                        will sleep, in seconds
+                    - OUTPUT_QUEUE (optional: defaults to False) send outputs through a rate
+                        limited queue instead of sleeping between messages, tuned with
+                        OUTPUT_RATE, OUTPUT_BURST (whole bot), OUTPUT_CHANNEL_RATE,
+                        OUTPUT_CHANNEL_BURST (per channel) and OUTPUT_COALESCE (longest
+                        message consecutive messages are merged into)
+                    - DM_CACHE_TTL (optional: defaults to 3600) seconds a user's direct
+                        message channel is cached for
+                    - DM_OPEN_CONCURRENCY (optional: defaults to 8) how many DM channels
+                        missing from the cache are opened at the same time
+                    - PING_INTERVAL (optional: defaults to 3) seconds between pings
+                    - PING_TIMEOUT (optional: defaults to 10) seconds a ping may go without
+                        a pong before the connection is considered dead
+                    - RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY (optional: default to 1
+                        and 60) bounds of the jittered exponential backoff between
+                        reconnection attempts
+                    - RTM_CONNECT (optional: defaults to False) connect with rtm.connect
+                        instead of rtm.start and fetch channels and users when first
+                        needed, for faster (re)connects in large workspaces
+                    - PLUGIN_RELOAD (optional: defaults to False) watch the plugins and
+                        reload them in place when they change, every PLUGIN_RELOAD_INTERVAL
+                        seconds (defaults to 1)
+                    - PLUGIN_SETUP_TIMEOUT (optional: defaults to 10) seconds the bot waits
+                        for the plugins' setup(), run in parallel, before connecting. The
+                        plugins still setting up are activated once they're done
+                    - SHARDS (optional: defaults to 1) run the plugins in this many worker
+                        processes, events are spread over them by channel
+                    - ACK_TIMEOUT (optional: defaults to 30) seconds to wait for Slack to
+                        confirm a message before counting it as a timed out delivery
+                    - UNSENT_LIMIT (optional: defaults to 1000) outputs kept while their
+                        workspace is unreachable, the oldest are dropped past it
+                    - METRICS_PORT (optional) serve the bot's metrics on
+                        http://METRICS_HOST:METRICS_PORT/metrics, METRICS_HOST defaults to
+                        127.0.0.1
+                    - PROFILE (optional: defaults to False) time plugin handlers and jobs
+                        and log the stack of those running over PROFILE_THRESHOLD seconds
+                        (defaults to 0.5). PROFILE_SIGNAL (defaults to SIGUSR2) starts and
+                        stops a profiling session, written to PROFILE_DIR (defaults to
+                        BASE_PATH)
         '''
         # set the config object
         self.config = config
@@ -53,41 +221,266 @@ class RtmBot(object):
         logging.info('Initialized in: {}'.format(self.directory))
         self.debug = self.config.get('DEBUG', False)
 
+        # select the main loop implementation
+        self.loop = self.config.get('LOOP', 'poll')
+        if self.loop not in ('poll', 'event'):
+            raise ValueError('unknown LOOP: {}'.format(self.loop))
+        self.loop_max_wait = self.config.get('LOOP_MAX_WAIT', 1.0)
+        self.waker = Waker() if self.loop == 'event' else None
+
+        # the outbound queue replaces the sleep between consecutive outputs
+        self.output_queue = self.config.get('OUTPUT_QUEUE', False)
+
         # initialize stateful fields
-        self.last_ping = 0
+        tokens = self.config.get('SLACK_TOKENS') or [self.token]
+        if self.token is None:
+            self.token = tokens[0]
+        elif self.token not in tokens:
+            tokens = [self.token] + list(tokens)
+        self.connections = [self.make_connection(token) for token in tokens]
+        # the first connection, single workspace code can keep ignoring the others
+        self.connection = self.connections[0]
+        # channel id -> the connection events from that channel came in on
+        self.routes = {}
         self.bot_plugins = []
-        self.slack_client = None
+        self.plugins_loaded = False
+        self.setup_timeout = self.config.get('PLUGIN_SETUP_TIMEOUT', 10)
+        # plugins whose setup() finished since the bot last looked
+        self.setups_done = deque()
+        # event type -> paths of the plugins activated by the first event of that type
+        self.lazy_plugins = {}
+        # plugin activated by an event and still setting up -> the events it would have
+        # handled meanwhile, (function name, data, connection), handed to it once it's up
+        self.activating = {}
+        # whether the plugins' timed jobs run in this process
+        self.run_jobs = True
+        # the index of this worker process with SHARDS, passed on to the plugins
+        self.shard = None
+        self.shards = None
+        if (self.config.get('SHARDS') or 1) > 1:
+            self.shards = ShardPool(self.config['SHARDS'], self.config)
+        # outputs a lost connection failed to send, they go first once it is back. The
+        # oldest are dropped past UNSENT_LIMIT, a workspace may be down for a long time
+        self.unsent = deque(maxlen=self.config.get('UNSENT_LIMIT', 1000))
+        self.scheduler = Scheduler()
+        self.plugin_watcher = None
+        # the exception a plugin raised in debug mode off the main loop, raised by it
+        self.failure = None
+        # maps process_* function names to the (plugin, handler) pairs interested in them
+        self.dispatch = {}
+        # bumped whenever the plugins' handlers change, a shard worker then reports them
+        self.dispatch_version = 0
+        self.metrics = Registry()
+        self.metrics_server = None
+        self.register_metrics()
+        self.profiler = None
+        if self.config.get('PROFILE', False):
+            self.profiler = Profiler(
+                threshold=self.config.get('PROFILE_THRESHOLD', 0.5),
+                directory=self.config.get('PROFILE_DIR', self.directory),
+                signal_name=self.config.get('PROFILE_SIGNAL', 'SIGUSR2'))
 
     def _dbg(self, debug_string):
         if self.debug:
             logging.info(debug_string)
 
+    def register_metrics(self):
+        metrics = self.metrics
+        self.events_total = metrics.counter(
+            'rtmbot_events_total', 'RTM events received', ['type'])
+        self.send_seconds = metrics.histogram(
+            'rtmbot_send_seconds', 'Time spent sending outputs', ['kind'])
+        metrics.gauge('rtmbot_output_queue_depth', 'Outputs waiting to be sent',
+                      function=lambda: len(self.unsent) + sum(
+                          len(connection.outbound) for connection in self.connections
+                          if connection.outbound is not None))
+        self.unsent_dropped = metrics.counter(
+            'rtmbot_unsent_dropped_total', 'Outputs dropped waiting for a connection')
+        metrics.gauge('rtmbot_connected', 'Connections to Slack which are up',
+                      function=lambda: sum(1 for c in self.connections if c.connected))
+        metrics.counter('rtmbot_disconnects_total', 'Connections to Slack lost',
+                        function=lambda: sum(c.disconnects for c in self.connections))
+        metrics.gauge('rtmbot_executor_backlog', 'Plugin calls waiting for a worker', ['plugin'],
+                      function=lambda: dict(((plugin.name,), plugin.executor.queue.qsize())
+                                            for plugin in self.bot_plugins
+                                            if plugin.executor is not None))
+        self.deliveries = metrics.counter(
+            'rtmbot_deliveries_total', 'Messages sent, by what Slack answered',
+            ['plugin', 'result'])
+        self.ack_seconds = metrics.histogram(
+            'rtmbot_ack_seconds', 'Time from sending a message to Slack confirming it', ['plugin'])
+        metrics.gauge('rtmbot_unacked_messages', 'Messages sent which Slack has yet to confirm',
+                      function=lambda: sum(len(c.unacked) for c in self.connections))
+        metrics.counter('rtmbot_executor_dropped_total', 'Plugin calls dropped by a full queue',
+                        ['plugin'],
+                        function=lambda: dict(((plugin.name,), plugin.executor.dropped)
+                                              for plugin in self.bot_plugins
+                                              if plugin.executor is not None))
+
+    def start_metrics_server(self):
+        if self.metrics_server is not None or not self.config.get('METRICS_PORT'):
+            return
+        try:
+            self.metrics_server = MetricsServer(
+                self.metrics, self.config.get('METRICS_HOST', '127.0.0.1'),
+                self.config['METRICS_PORT']).start()
+        except Exception:
+            logging.exception('failed starting the metrics server')
+
+    def make_connection(self, token):
+        connection = Connection(token, self.config)
+        if self.output_queue:
+            # Slack's rate limits are per workspace, so is the queue
+            connection.outbound = OutboundQueue(
+                rate=self.config.get('OUTPUT_RATE', 10),
+                burst=self.config.get('OUTPUT_BURST', 20),
+                channel_rate=self.config.get('OUTPUT_CHANNEL_RATE', 1),
+                channel_burst=self.config.get('OUTPUT_CHANNEL_BURST', 3),
+                coalesce_limit=self.config.get('OUTPUT_COALESCE', 4000))
+        return connection
+
+    @property
+    def slack_client(self):
+        return self.connection.slack_client
+
+    @slack_client.setter
+    def slack_client(self, slack_client):
+        self.connection.slack_client = slack_client
+
+    @property
+    def slack_directory(self):
+        return self.connection.directory
+
+    @property
+    def outbound(self):
+        return self.connection.outbound
+
     def connect(self):
-        """Convenience method that creates Server instance"""
-        self.slack_client = SlackClient(self.token)
-        logging.info(self.slack_client)
-        self.slack_client.rtm_connect()
+        """Connects to every workspace, the ones failing to are retried from the loop"""
+        def connect(connection):
+            try:
+                connection.connect()
+            except RtmConnectError as e:
+                logging.error('could not connect: {}'.format(e))
+                connection.lost(e)
+        if len(self.connections) == 1:
+            connect(self.connection)
+            return
+        threads = [threading.Thread(target=connect, args=(connection,))
+                   for connection in self.connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
     def _start(self):
+        self.start_metrics_server()
+        if self.profiler is not None:
+            self.profiler.start()
         self.connect()
-        self.load_plugins()
-        self.get_user_info()
+        # start() runs again after a crash, the plugins are still there
+        if not self.plugins_loaded:
+            if self.shards is not None:
+                # before connecting, the workers have no use for the sockets
+                self.shards.start()
+                self.plugins_loaded = True
+            else:
+                self.load_plugins()
+        for connection in self.connections:
+            if connection.connected:
+                self.get_user_info(connection)
         while True:
+            if self.loop == 'event':
+                self._event_tick()
+            else:
+                self._poll_tick()
+
+    def _poll_tick(self):
+        self.check_failure()
+        self.read(max_reads=1)
+        self.crons()
+        self.output()
+        self.autoping()
+        time.sleep(.1)
+
+    def _event_tick(self, max_reads=100):
+        self.check_failure()
+        self.waker.drain()
+        # rtm_read only returns a single frame at a time, keep reading until the
+        # socket is drained (bounded, so a message storm can't starve the crons)
+        self.read(max_reads)
+        self.crons()
+        self.output()
+        self.autoping()
+        self._wait(self._next_timeout())
+
+    def read(self, max_reads):
+        for connection in self.connections:
+            if not connection.connected:
+                if connection.retry_due() and connection.reconnect():
+                    self.get_user_info(connection)
+                continue
             try:
-                for reply in self.slack_client.rtm_read():
-                    self.input(reply)
-                self.crons()
-                self.output()
-                self.autoping()
-                time.sleep(.1)
-            except WebSocketConnectionClosedException as e:
-                logging.exception("websocket connection was closed: {}".format(e))
-                self.slack_client.rtm_connect()
-   
-    def get_user_info(self):
-        user_info = self.slack_client.api_call('auth.test')
+                for _ in range(max_reads):
+                    replies = connection.slack_client.rtm_read()
+                    if not replies:
+                        break
+                    for reply in replies:
+                        self.input(reply, connection)
+            except CONNECTION_ERRORS as e:
+                if getattr(e, 'errno', None) in WOULD_BLOCK:
+                    # a plain ws:// socket raises instead of returning nothing to read
+                    continue
+                connection.lost(e)
+
+    def _next_timeout(self):
+        deadlines = [self.scheduler.next_deadline()]
+        for connection in self.connections:
+            if connection.connected:
+                deadlines.append(connection.next_ping())
+                if connection.outbound is not None:
+                    deadlines.append(connection.outbound.next_ready())
+            else:
+                deadlines.append(connection.retry_at)
+        timeout = self.loop_max_wait
+        for deadline in deadlines:
+            if deadline is not None:
+                timeout = min(timeout, deadline - monotonic())
+        return max(0, timeout)
+
+    def _wait(self, timeout):
+        readers = [self.waker]
+        for connection in self.connections:
+            if connection.connected:
+                sock = connection.slack_client.server.websocket.sock
+                if hasattr(sock, 'pending') and sock.pending():
+                    # the ssl layer already holds decrypted data, select won't see it
+                    return
+                readers.append(sock)
+        if self.shards is not None:
+            readers.extend(self.shards.readers)
+        try:
+            select.select(readers, [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def fail(self, exception):
+        '''Stops the main loop with the exception, from any thread'''
+        self.failure = exception
+        if self.waker is not None:
+            self.waker.wake()
+
+    def check_failure(self):
+        if self.failure is not None:
+            failure, self.failure = self.failure, None
+            raise failure
+
+    def get_user_info(self, connection=None):
+        connection = connection or self.connection
+        user_info = connection.slack_client.api_call('auth.test')
         user_info['type'] = 'user_info'
-        self.input(user_info)
+        self.input(user_info, connection)
 
     def start(self):
         if 'DAEMON' in self.config:
@@ -98,122 +491,802 @@ class RtmBot(object):
         self._start()
 
     def autoping(self):
-        # hardcode the interval to 3 seconds
-        now = int(time.time())
-        if now > self.last_ping + 3:
-            self.slack_client.server.ping()
-            self.last_ping = now
+        for connection in self.connections:
+            for origin in connection.expire_acks():
+                self.deliveries.inc(plugin=origin or 'unknown', result='timeout')
+            if not connection.connected:
+                continue
+            try:
+                alive = connection.autoping()
+            except CONNECTION_ERRORS as e:
+                connection.lost(e)
+                continue
+            if not alive:
+                connection.lost('no pong in {}s'.format(connection.ping_timeout))
 
-    def input(self, data):
+    def input(self, data, connection=None):
         if "type" in data:
-            data['__slack_client'] = self.slack_client
+            connection = connection or self.connection
+            self.events_total.inc(type=data["type"])
+            if data["type"] == "pong":
+                connection.pong(data.get("reply_to"))
+            elif data["type"] == "user_info":
+                connection.user_info = data
+            try:
+                directory_changed = connection.directory.update(data)
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                # a payload not shaped like the docs say mustn't take the bot down
+                logging.warning('could not apply {} event to the directory: {!r}'.format(
+                    data["type"], e))
+                directory_changed = False
+            if len(self.connections) > 1 and isinstance(data.get("channel"), string_types):
+                self.routes[data["channel"]] = connection
+            if self.shards is not None:
+                self.shards.dispatch(data, self.connections.index(connection),
+                                     connection.team_id, directory_changed)
+                return
             function_name = "process_" + data["type"]
-            self._dbg("got {}".format(function_name))
-            for plugin in self.bot_plugins:
-                plugin.register_jobs()
-                plugin.do(function_name, data)
+            if self.debug:
+                self._dbg("got {}".format(function_name))
+            handlers = self.dispatch.get(function_name)
+            if handlers is None:
+                if data["type"] in self.lazy_plugins:
+                    self.activate_lazy_plugins(data["type"])
+                handlers = self.dispatch[function_name] = self.resolve_dispatch(function_name)
+            if self.activating:
+                self.hold_events(function_name, data, connection)
+            if not handlers:
+                # no plugin wants it, most events of a big workspace end here
+                return
+            if any(plugin.event_keys for plugin, _ in handlers):
+                data['__slack_client'] = connection.slack_client
+                data['__directory'] = connection.directory
+                data['__workspace'] = connection.team_id
+            for plugin, handler in handlers:
+                plugin.call(handler, data, connection.context)
+        elif "reply_to" in data:
+            self.acked(data, connection or self.connection)
 
-    def output(self):
+    def acked(self, reply, connection):
+        '''Records Slack's reply to a message the bot sent'''
+        acked = connection.ack(reply)
+        if acked is None:
+            return
+        origin, seconds = acked
+        origin = origin or 'unknown'
+        if reply.get('ok', True):
+            self.deliveries.inc(plugin=origin, result='ok')
+            self.ack_seconds.observe(seconds, plugin=origin)
+        else:
+            self.deliveries.inc(plugin=origin, result='error')
+            logging.warning('Slack rejected a message from {}: {}'.format(
+                origin, reply.get('error')))
+
+    def resolve_dispatch(self, function_name):
+        '''
+            Returns the (plugin, handler) pairs to call for an event, in plugin order and
+            with each plugin's catch_all after its own handler, like Plugin.do. Plugins
+            filtering out the event type are left out.
+        '''
+        handlers = []
+        event_type = function_name[len('process_'):]
         for plugin in self.bot_plugins:
-            limiter = False
-            for output in plugin.do_output():
-                channel = self.slack_client.server.channels.find(output[0])
-                if channel is not None and output[1] is not None:
-                    if limiter:
-                        time.sleep(.1)
-                        limiter = False
-                    if output[1] == 'TYPING':
-                        channel.server.send_to_websocket({"type": "typing", "channel": channel.id})
-                    elif output[1] == 'DM':
-                        try:
-                            user, text = output[2:]
-                            dm_channel_request = self.slack_client.api_call('im.open', user=user)
-                            dm_channel_id = dm_channel_request['channel']['id']
-                            dm_channel = self.slack_client.server.channels.find(dm_channel_id)
-                            channel_send_message(dm_channel, text)
-                        except Exception as e:
-                            logging.error('error sending DM: {}'.format(e))
-                    elif output[1] == 'FILE':
-                        try:
-                            content, filetype, filename = output[2:]
-                            self.slack_client.server.api_call('files.upload', content=content, filetype=filetype, filename=filename, channels=[channel.id])                            
-                        except Exception as e:
-                            logging.error('error sending DM: {}'.format(e))
-                    else:
-                        channel_send_message(channel, output[1])
-                    limiter = True
+            if not plugin.accepts(event_type):
+                continue
+            if function_name in plugin.handlers:
+                handlers.append((plugin, plugin.handlers[function_name]))
+            if plugin.catch_all is not None:
+                handlers.append((plugin, plugin.catch_all))
+        return handlers
+
+    def rebuild_dispatch(self):
+        '''Drops the dispatch table, call this whenever a plugin's handlers change'''
+        self.dispatch = {}
+        self.dispatch_version += 1
+
+    def wanted_events(self):
+        '''
+            The event types some plugin handles or is activated by, None when a catch_all
+            without EVENTS takes them all.
+        '''
+        wanted = set(self.lazy_plugins)
+        for plugin in self.bot_plugins:
+            event_types = set(name[len('process_'):] for name in plugin.handlers)
+            if plugin.catch_all is not None:
+                if plugin.events is None:
+                    return None
+                event_types.update(plugin.events)
+            wanted.update(event_type for event_type in event_types if plugin.accepts(event_type))
+        return wanted
+
+    def output(self):
+        if self.unsent:
+            outputs = list(self.unsent)
+            self.unsent.clear()
+            self.send_outputs(outputs)
+        if self.output_queue:
+            self.collect_output(OutboundQueue.REPLY)
+            for connection in self.connections:
+                if connection.connected:
+                    self.send_outputs(connection.outbound.pop_ready())
+            return
+        for outputs in self.pending_outputs():
+            self.send_outputs(outputs, limit=True)
+
+    def pending_outputs(self):
+        '''Returns the outputs produced since the last call, one list per plugin or batch'''
+        if self.shards is not None:
+            return self.shards.collect()
+        return [plugin.do_output() for plugin in self.bot_plugins]
+
+    def send_outputs(self, outputs, limit=False):
+        '''
+            Sends outputs in order, sleeping between messages when `limit` is set. Outputs
+            for a workspace whose connection is down are kept until it is back.
+
+            Messages are written to their connection and flushed together, in one socket
+            write per connection, unless the limit or a file upload comes in between.
+        '''
+        self.prefetch_dm_channels(outputs)
+        limiter = False
+        # (connection, output) written but not flushed yet
+        written = []
+        for output in outputs:
+            connection = self.route(output[0])
+            if not connection.connected:
+                self.keep_unsent([output])
+                continue
+            if limiter:
+                self.flush(written)
+                time.sleep(.1)
+                limiter = False
+            elif output[1] == 'FILE':
+                # uploads go over HTTP, the messages before them have to go out first
+                self.flush(written)
+            start = monotonic()
+            frames = len(connection.frames)
+            try:
+                if self.send_output(output, connection):
+                    limiter = limit
+                if len(connection.frames) > frames:
+                    written.append((connection, output))
+            except CONNECTION_ERRORS as e:
+                self.keep_unsent([output])
+                connection.lost(e)
+            kind = output[1] if output[1] in SPECIAL_OUTPUTS else 'message'
+            self.send_seconds.observe(monotonic() - start, kind=kind)
+        self.flush(written)
+
+    def flush(self, written):
+        '''Flushes the connections outputs were written to, keeping the outputs when that fails'''
+        for connection in set(connection for connection, _ in written):
+            if not connection.connected:
+                # lost meanwhile, along with what was written
+                self.keep_unsent(output for output_connection, output in written
+                                 if output_connection is connection)
+                continue
+            start = monotonic()
+            try:
+                connection.flush()
+            except CONNECTION_ERRORS as e:
+                # one frame per output, those which got out aren't sent again
+                outputs = [output for output_connection, output in written
+                           if output_connection is connection]
+                self.keep_unsent(outputs[connection.flushed:])
+                connection.lost(e)
+            self.send_seconds.observe(monotonic() - start, kind='flush')
+        del written[:]
+
+    def keep_unsent(self, outputs):
+        '''Keeps outputs until their connection is back, dropping the oldest when full'''
+        dropped = 0
+        for output in outputs:
+            if len(self.unsent) == self.unsent.maxlen:
+                dropped += 1
+            self.unsent.append(output)
+        if dropped:
+            self.unsent_dropped.inc(dropped)
+            logging.warning('dropped {} unsent outputs, over UNSENT_LIMIT'.format(dropped))
+
+    def collect_output(self, priority):
+        for outputs in self.pending_outputs():
+            for output in outputs:
+                self.route(output[0]).outbound.put(output, priority)
+
+    def route(self, key):
+        '''Returns the connection of the workspace a channel id or name belongs to'''
+        if len(self.connections) == 1:
+            return self.connection
+        connection = self.routes.get(key)
+        if connection is not None:
+            return connection
+        for connection in self.connections:
+            if connection.directory.channel_id(key) is not None:
+                return connection
+        return self.connection
+
+    def find_channel(self, key):
+        return self.route(key).find_channel(key)
+
+    def open_dm_channel(self, user, connection=None):
+        return (connection or self.connection).open_dm_channel(user)
+
+    def prefetch_dm_channels(self, outputs):
+        '''
+            Opens the DM channels missing from the cache ahead of sending, at most
+            DM_OPEN_CONCURRENCY at a time
+        '''
+        missing = set()
+        for output in outputs:
+            if len(output) > 2 and output[1] == 'DM':
+                connection = self.route(output[0])
+                if connection.connected and connection.directory.ims.get(output[2]) is None:
+                    missing.add((output[2], connection))
+        if len(missing) < 2:
+            return
+        missing = list(missing)
+
+        def open_dm_channels():
+            while missing:
+                try:
+                    user, connection = missing.pop()
+                except IndexError:
+                    return
+                try:
+                    self.open_dm_channel(user, connection)
+                except Exception as e:
+                    logging.error('error opening DM with {}: {}'.format(user, e))
+        workers = min(self.config.get('DM_OPEN_CONCURRENCY', 8), len(missing))
+        threads = [threading.Thread(target=open_dm_channels) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def send_output(self, output, connection=None):
+        connection = connection or self.route(output[0])
+        channel = connection.find_channel(output[0])
+        if channel is None or output[1] is None:
+            return False
+        if output[1] == 'TYPING':
+            connection.send({"type": "typing", "channel": channel.id})
+        elif output[1] == 'DM':
+            try:
+                user, text = output[2:]
+                dm_channel_id = (connection.directory.ims.get(user) or
+                                 self.open_dm_channel(user, connection))
+                connection.send_message(dm_channel_id, text, getattr(output, 'origin', None))
+            except CONNECTION_ERRORS:
+                # kept and sent again once the connection is back
+                raise
+            except Exception as e:
+                logging.error('error sending DM: {}'.format(e))
+        elif output[1] == 'FILE':
+            try:
+                content, filetype, filename = output[2:]
+                connection.slack_client.server.api_call('files.upload', content=content,
+                                                        filetype=filetype, filename=filename,
+                                                        channels=[channel.id])
+            except CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                logging.error('error sending file: {}'.format(e))
+        else:
+            connection.send_message(channel.id, output[1], getattr(output, 'origin', None))
+        return True
 
     def crons(self):
+        if self.setups_done:
+            self.activate_set_up()
+        if self.output_queue:
+            # outputs produced before the jobs run are replies, they go first
+            self.collect_output(OutboundQueue.REPLY)
         for plugin in self.bot_plugins:
-            plugin.do_jobs()
+            for job in plugin.register_jobs():
+                if self.runs(job):
+                    self.scheduler.add(job)
+        self.scheduler.run_pending()
+        if self.output_queue:
+            self.collect_output(OutboundQueue.CRON)
+
+    def plugin_patterns(self):
+        return [self.directory + '/plugins/*.py', self.directory + '/plugins/*/*.py']
 
     def load_plugins(self):
-        for plugin in glob.glob(self.directory + '/plugins/*'):
-            sys.path.insert(0, plugin)
-            sys.path.insert(0, self.directory + '/plugins/')
-        for plugin in glob.glob(self.directory + '/plugins/*.py') + \
-                glob.glob(self.directory + '/plugins/*/*.py'):
-            logging.info(plugin)
-            name = plugin.split('/')[-1][:-3]
-            if name in self.config:
-                logging.info("config found for: " + name)
-            plugin_config = self.config.get(name, {})
-            plugin_config['DEBUG'] = self.debug
-            self.bot_plugins.append(Plugin(name, plugin_config))
+        '''
+            Imports the plugins found in the manifest and runs their setup() in parallel.
+            Plugins with ACTIVATE_ON in their config are only loaded on the first event
+            of one of those types.
+        '''
+        start = monotonic()
+        manifest = PluginManifest(self.plugin_patterns())
+        manifest.install()
+        plugins = []
+        for name, path in manifest.plugins:
+            activate_on = self.config.get(name, {}).get('ACTIVATE_ON')
+            if activate_on:
+                for event_type in activate_on:
+                    self.lazy_plugins.setdefault(event_type, []).append(path)
+                continue
+            plugins.append(self.load_plugin(path, setup=False))
+        self.setup_plugins(plugins)
+        self.plugins_loaded = True
+        logging.info('loaded {} plugins in {:.2f}s'.format(len(plugins), monotonic() - start))
+        if self.config.get('PLUGIN_RELOAD', False) and self.plugin_watcher is None:
+            self.plugin_watcher = PluginWatcher(self.plugin_patterns())
+            self.scheduler.add(Job(self.config.get('PLUGIN_RELOAD_INTERVAL', 1),
+                                   self.check_plugins, self.debug))
+
+    def load_plugin(self, path, setup=True):
+        '''
+            Imports a plugin and, with setup, sets it up and activates it. Otherwise it's
+            left for setup_plugins.
+        '''
+        logging.info(path)
+        name = plugin_name(path)
+        if name in self.config:
+            logging.info("config found for: " + name)
+        plugin_config = self.config.get(name, {})
+        plugin_config['DEBUG'] = self.debug
+        if self.shard is not None:
+            plugin_config['SHARD'] = self.shard
+        plugin = self.make_plugin(name, plugin_config, path, setup)
+        if setup:
+            self.activate_plugin(plugin)
+        return plugin
+
+    def make_plugin(self, name, plugin_config, path, setup=True):
+        plugin = Plugin(name, plugin_config, waker=self.waker, path=path, metrics=self.metrics,
+                        profiler=self.profiler, setup=setup)
+        plugin.on_failure = self.fail
+        return plugin
+
+    def runs(self, job):
+        '''Whether the job runs in this process, with SHARDS most only run in the first'''
+        return self.run_jobs or job.every_shard
+
+    def activate_plugin(self, plugin):
+        for job in plugin.jobs:
+            if self.runs(job):
+                self.scheduler.add(job)
+        self.bot_plugins.append(plugin)
+        self.rebuild_dispatch()
+
+    def setup_plugins(self, plugins):
+        '''
+            Runs the plugins' setup() on threads of their own and activates the plugins,
+            in order, as far as their setup is done within PLUGIN_SETUP_TIMEOUT seconds.
+            The others are activated by crons() once they're done.
+        '''
+        threads = []
+        done = set()
+        for plugin in plugins:
+            thread = self.start_setup(plugin)
+            if thread is None:
+                done.add(plugin)
+            else:
+                threads.append(thread)
+        deadline = monotonic() + self.setup_timeout
+        for thread in threads:
+            thread.join(max(0, deadline - monotonic()))
+        failed = {}
+        while self.setups_done:
+            plugin, error = self.setups_done.popleft()
+            done.add(plugin)
+            if error is not None:
+                failed[plugin] = error
+        for plugin in plugins:
+            if plugin in failed:
+                self.setup_failed(plugin, failed[plugin])
+            elif plugin in done:
+                self.activate_plugin(plugin)
+            else:
+                logging.warning('plugin {} still setting up after {}s, it starts once done'.format(
+                    plugin.name, self.setup_timeout))
+
+    def start_setup(self, plugin):
+        '''
+            Starts the plugin's setup() on a thread of its own and returns it, or None
+            when the plugin has no setup(). Under gevent the thread is a greenlet of the
+            bot's loop, so the greenlets setup() spawns run there too.
+        '''
+        setup = plugin.setup_function()
+        if setup is None:
+            return None
+        thread = threading.Thread(target=self.run_setup, args=(plugin, setup),
+                                  name='setup-{}'.format(plugin.name))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run_setup(self, plugin, setup):
+        error = None
+        try:
+            setup()
+        except Exception as e:
+            error = e
+        self.setups_done.append((plugin, error))
+        if self.waker is not None:
+            self.waker.wake()
+
+    def activate_set_up(self):
+        '''Activates the plugins whose setup() finished after the bot started'''
+        while self.setups_done:
+            plugin, error = self.setups_done.popleft()
+            held = self.activating.pop(plugin, None)
+            if error is not None:
+                self.setup_failed(plugin, error)
+            else:
+                logging.info('plugin {} is set up'.format(plugin.name))
+                self.activate_plugin(plugin)
+                if held is not None:
+                    self.replay_events(plugin, held)
+
+    def setup_failed(self, plugin, error):
+        if self.debug:
+            raise error
+        logging.error('setup of plugin {} failed, not loading it: {!r}'.format(plugin.name, error))
+        if plugin.executor is not None:
+            plugin.executor.shutdown()
+        sys.modules.pop(plugin.name, None)
+
+    def activate_lazy_plugins(self, event_type):
+        '''
+            Imports the plugins waiting for the first event of this type and starts their
+            setup(). They're activated by crons() once it's done, and get the events they
+            would have handled meanwhile, this one included.
+        '''
+        paths = self.lazy_plugins.pop(event_type)
+        for other in list(self.lazy_plugins):
+            self.lazy_plugins[other] = [
+                path for path in self.lazy_plugins[other] if path not in paths]
+            if not self.lazy_plugins[other]:
+                del self.lazy_plugins[other]
+        for path in paths:
+            logging.info('activating plugin {} on its first {} event'.format(path, event_type))
+            try:
+                plugin = self.load_plugin(path, setup=False)
+            except Exception:
+                if self.debug:
+                    raise
+                logging.exception('failed loading plugin {}'.format(path))
+                continue
+            held = self.activating[plugin] = []
+            # it missed the bot's own info, which plugins get at startup
+            for connection in self.connections:
+                if connection.user_info is not None:
+                    held.append(('process_user_info', dict(connection.user_info), connection))
+            if self.start_setup(plugin) is None:
+                self.setups_done.append((plugin, None))
+
+    def hold_events(self, function_name, data, connection):
+        '''Keeps an event for the plugins activated by an event but still setting up'''
+        event_type = function_name[len('process_'):]
+        for plugin, held in self.activating.items():
+            if plugin.accepts(event_type) and (
+                    function_name in plugin.handlers or plugin.catch_all is not None):
+                held.append((function_name, data, connection))
+
+    def replay_events(self, plugin, held):
+        for function_name, data, connection in held:
+            if plugin.event_keys:
+                data = dict(data)
+                data['__slack_client'] = connection.slack_client
+                data['__directory'] = connection.directory
+                data['__workspace'] = connection.team_id
+            plugin.do(function_name, data, connection.context)
+
+    def check_plugins(self):
+        '''Reloads, loads and unloads plugins whose files changed'''
+        added, changed, removed = self.plugin_watcher.check()
+        by_path = dict((plugin.path, plugin) for plugin in self.bot_plugins)
+        for path in changed:
+            if path in by_path:
+                self.reload_plugin(by_path[path])
+        for path in added:
+            if os.path.dirname(path) not in sys.path:
+                sys.path.insert(0, os.path.dirname(path))
+            try:
+                self.load_plugin(path)
+            except Exception:
+                logging.exception('failed loading new plugin {}'.format(path))
+        for path in removed:
+            if path in by_path:
+                self.unload_plugin(by_path[path])
+        if added or changed or removed:
+            self.rebuild_dispatch()
+
+    def reload_plugin(self, plugin):
+        logging.info('reloading plugin {}'.format(plugin.name))
+        try:
+            added, removed = plugin.reload()
+        except Exception:
+            logging.exception('failed reloading plugin {}, kept the old version'.format(
+                plugin.name))
+            return
+        for job in removed:
+            if self.runs(job):
+                self.scheduler.remove(job)
+        for job in added:
+            if self.runs(job):
+                self.scheduler.add(job)
+
+    def unload_plugin(self, plugin):
+        logging.info('unloading plugin {}'.format(plugin.name))
+        self.bot_plugins.remove(plugin)
+        try:
+            plugin.teardown()
+        except Exception:
+            logging.exception('failed tearing down plugin {}'.format(plugin.name))
+        for job in plugin.jobs:
+            self.scheduler.remove(job)
+        if plugin.executor is not None:
+            plugin.executor.shutdown()
+        sys.modules.pop(plugin.name, None)
 
 
 class Plugin(object):
 
-    def __init__(self, name, plugin_config=None):
+    def __init__(self, name, plugin_config=None, waker=None, path=None, metrics=None,
+                 profiler=None, setup=True):
         '''
         A plugin in initialized with:
             - name (str)
             - plugin config (dict) - (from the yaml config)
                 Values in config:
                 - DEBUG (bool) - this will be overridden if debug is set in config for this plugin
+                - EXECUTOR, WORKERS, QUEUE_SIZE, QUEUE_POLICY, TIMEOUT - how the plugin's
+                    handlers are run, see rtmbot.executors.make_executor
+                - EVENTS, IGNORE_EVENTS (list) - the event types the plugin gets, or doesn't,
+                    these can also be set in the plugin's module
+                - SHARD (int) - set by the bot with SHARDS, the index of the worker process
+                    running this copy of the plugin. Plugins keeping state in files use
+                    it so the copies don't share them
+                - ACTIVATE_ON (list) - event types, when set the bot only loads the
+                    plugin on the first event of one of them
+                - EVENT_KEYS (bool) - whether the plugin gets __slack_client, __directory
+                    and __workspace in the event dict, by default when its source uses them
+            - waker (Waker) - optional, when given the plugin's outputs wake the event loop
+            - path (str) - optional, the file the plugin was loaded from
+            - metrics (Registry) - optional, where the plugin's handler and job timings
+                are recorded, injected into the plugin as `metrics`
+            - profiler (Profiler) - optional, times and watches the handlers and jobs
+            - setup (bool) - optional, whether to run the module's setup() right away,
+                else it's for the caller to run setup_function()
         '''
         if plugin_config is None:
             plugin_config = {}
+        if metrics is None:
+            metrics = Registry()
         self.name = name
+        self.path = path
+        self.waker = waker
         self.jobs = []
+        # optional, called with the exception a call raised off the main loop in debug mode
+        self.on_failure = None
+        self.profiler = profiler
+        self.metrics = metrics
+        self.handler_seconds = metrics.histogram(
+            'rtmbot_handler_seconds', 'Time spent in plugin handlers', ['plugin', 'handler'])
+        self.handler_errors = metrics.counter(
+            'rtmbot_handler_errors_total', 'Plugin handlers which raised', ['plugin', 'handler'])
+        self.job_seconds = metrics.histogram(
+            'rtmbot_job_seconds', 'Time spent in plugin jobs', ['plugin', 'job'])
+        self.job_errors = metrics.counter(
+            'rtmbot_job_errors_total', 'Plugin jobs which raised', ['plugin', 'job'])
         self.module = __import__(name)
         self.module.config = plugin_config
+        self.module.metrics = metrics
         self.debug = self.module.config.get('DEBUG', False)
         self.register_jobs()
+        self.resolve_handlers()
         self.outputs = []
-        if 'setup' in dir(self.module):
+        self.outbox = self.module.outbox = Outbox(waker)
+        self.prepare_module(setup)
+        self.executor = self.make_executor()
+
+    def make_executor(self):
+        executor = make_executor(self.name, self.module, self.module.config)
+        if executor is not None:
+            if executor.remote:
+                # invoke can't time calls in another process, the executor does
+                executor.observe = self.observe_handler
+            executor.on_failure = self.failed
+        return executor
+
+    def submit(self, handler, *args):
+        '''Hands a call to the executor, to run through invoke unless it's remote'''
+        if self.executor.remote:
+            self.executor.submit(handler, *args)
+        else:
+            self.executor.submit(self.invoke, handler, *args)
+
+    def failed(self, exception):
+        if self.on_failure is not None:
+            self.on_failure(exception)
+        else:
+            logging.error('problem in module {}: {!r}'.format(self.name, exception))
+
+    def observe_handler(self, handler, elapsed, failed):
+        name = getattr(handler, '__name__', '{}'.format(handler))
+        self.handler_seconds.observe(elapsed, plugin=self.name, handler=name)
+        if failed:
+            self.handler_errors.inc(plugin=self.name, handler=name)
+
+    def observe_job(self, job, elapsed, failed):
+        name = getattr(job.function, '__name__', '{}'.format(job.function))
+        self.job_seconds.observe(elapsed, plugin=self.name, job=name)
+        if failed:
+            self.job_errors.inc(plugin=self.name, job=name)
+
+    def prepare_module(self, setup=True):
+        if self.waker is not None:
+            self.module.outputs = OutputList(getattr(self.module, 'outputs', []), self.waker)
+        if setup and self.setup_function() is not None:
             self.module.setup()
 
+    def setup_function(self):
+        '''The module's setup(), or None when it has nothing to set up'''
+        setup = getattr(self.module, 'setup', None)
+        return setup if callable(setup) else None
+
+    def reload(self):
+        '''
+            Reloads the plugin's module in place. Pending outputs carry over, and so do
+            the schedules of jobs still in the new crontable with the same options. When
+            the new code fails to import or set up, the old module is restored and the
+            error raised.
+            setup() runs again: a module defining teardown() has it called first, to stop
+            what the old setup() started, otherwise setup() has to cope with running twice.
+            Returns the (added, removed) jobs.
+        '''
+        outputs = self.do_output()
+        namespace = dict(vars(self.module))
+        torn_down = self.teardown()
+        try:
+            # config and outbox survive, reloading only overwrites what the module defines
+            reload_module(self.module)
+            self.prepare_module()
+        except Exception:
+            self.module.__dict__.clear()
+            self.module.__dict__.update(namespace)
+            sys.modules[self.name] = self.module
+            self.module.outputs.extend(outputs)
+            if torn_down:
+                try:
+                    self.prepare_module()
+                except Exception:
+                    logging.exception('failed setting up plugin {} again'.format(self.name))
+            raise
+        self.module.outputs.extend(outputs)
+        self.resolve_handlers()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = self.make_executor()
+        return self.migrate_jobs()
+
+    def teardown(self):
+        '''Calls the module's teardown(), returns whether it has one'''
+        teardown = getattr(self.module, 'teardown', None)
+        if not callable(teardown):
+            return False
+        teardown()
+        return True
+
+    def migrate_jobs(self):
+        previous = dict(((job.interval, getattr(job.function, '__name__', None)), job)
+                        for job in self.jobs)
+        crontable = getattr(self.module, 'crontable', None) or []
+        self.module.crontable = []
+        self.jobs = []
+        added = []
+        for entry in crontable:
+            job = previous.get((entry[0], entry[1]))
+            if job is not None and job.options == job_options(entry):
+                del previous[(entry[0], entry[1])]
+            else:
+                job = None
+            if job is None:
+                job = self.make_job(entry)
+                added.append(job)
+            else:
+                job.function = getattr(self.module, entry[1])
+            self.jobs.append(job)
+        return added, list(previous.values())
+
     def register_jobs(self):
-        if 'crontable' in dir(self.module):
-            for interval, function in self.module.crontable:
-                self.jobs.append(Job(interval, eval("self.module." + function), self.debug))
-            if self.module.crontable:
-                logging.info('crontab: {}'.format(self.module.crontable))
+        '''Turns new crontable entries into jobs, returns the jobs created'''
+        jobs = []
+        crontable = getattr(self.module, 'crontable', None)
+        if crontable:
+            jobs = [self.make_job(entry) for entry in crontable]
+            logging.info('crontab: {}'.format(crontable))
+            self.jobs.extend(jobs)
+        if crontable is None or crontable:
             self.module.crontable = []
+        return jobs
+
+    def make_job(self, entry):
+        interval, function = entry[:2]
+        options = job_options(entry)
+        job = Job(interval, getattr(self.module, function), self.debug, **options)
+        job.options = options
+        job.observe = self.observe_job
+        job.profiler = self.profiler
+        return job
+
+    def resolve_handlers(self):
+        '''
+            Looks up the plugin's process_* and catch_all functions and its event filters
+            once, at load time. The filters are EVENTS (the only event types the plugin
+            gets) and IGNORE_EVENTS, from the plugin's config or else its module.
+        '''
+        self.handlers = {}
+        for attr, value in vars(self.module).items():
+            if attr.startswith('process_') and callable(value):
+                self.handlers[attr] = value
+        catch_all = getattr(self.module, 'catch_all', None)
+        self.catch_all = catch_all if callable(catch_all) else None
+        # the handlers taking the event's context as a second argument
+        self.context_handlers = set(
+            handler for handler in list(self.handlers.values()) + [self.catch_all]
+            if handler is not None and takes_context(handler))
+        config = self.module.config
+        events = config.get('EVENTS', getattr(self.module, 'EVENTS', None))
+        self.events = set(events) if events is not None else None
+        self.ignore_events = set(
+            config.get('IGNORE_EVENTS', getattr(self.module, 'IGNORE_EVENTS', None)) or ())
+        self.event_keys = config.get('EVENT_KEYS', self.reads_event_keys())
+
+    def reads_event_keys(self):
+        '''Whether the plugin reads the context from the event dict, as it used to be given'''
+        try:
+            source = inspect.getsource(self.module)
+        except (IOError, OSError, TypeError):
+            # can't tell, play safe
+            return True
+        return any(key in source for key in EVENT_KEYS)
+
+    def accepts(self, event_type):
+        if self.events is not None and event_type not in self.events:
+            return False
+        return event_type not in self.ignore_events
+
+    def call(self, handler, data, context=None):
+        args = (data, context) if handler in self.context_handlers else (data,)
+        if self.executor is not None:
+            self.submit(handler, *args)
         else:
-            self.module.crontable = []
+            self.invoke(handler, *args)
 
-    def do(self, function_name, data):
-        if function_name in dir(self.module):
-            if self.debug is True:
-                # this makes the plugin fail with stack trace in debug mode
-                eval("self.module." + function_name)(data)
+    def invoke(self, handler, data, *args):
+        start = monotonic()
+        # also a failure when an executor's timeout interrupts the call
+        failed = True
+        try:
+            if self.profiler is not None:
+                self.profiler.run('{}.{}'.format(
+                    self.name, getattr(handler, '__name__', handler)), handler, data, *args)
             else:
-                # otherwise we log the exception and carry on
-                try:
-                    eval("self.module." + function_name)(data)
-                except Exception:
-                    logging.exception("problem in module {} {}".format(function_name, data))
-        if "catch_all" in dir(self.module):
+                handler(data, *args)
+            failed = False
+        except Exception:
             if self.debug is True:
                 # this makes the plugin fail with stack trace in debug mode
-                self.module.catch_all(data)
-            else:
-                try:
-                    self.module.catch_all(data)
-                except Exception:
-                    logging.exception("problem in catch all: {} {}".format(self.module, data))
+                raise
+            # otherwise we log the exception and carry on
+            logging.exception("problem in module {} {} {}".format(
+                self.name, getattr(handler, '__name__', handler), data))
+        finally:
+            self.observe_handler(handler, monotonic() - start, failed)
+
+    def do(self, function_name, data, context=None):
+        if not self.accepts(function_name[len('process_'):]):
+            return
+        if function_name in self.handlers:
+            self.call(self.handlers[function_name], data, context)
+        if self.catch_all is not None:
+            self.call(self.catch_all, data, context)
 
     def do_jobs(self):
         for job in self.jobs:
@@ -221,44 +1294,34 @@ class Plugin(object):
 
     def do_output(self):
         output = []
-        while True:
-            if 'outputs' in dir(self.module):
-                if len(self.module.outputs) > 0:
-                    o = self.module.outputs.pop(0)
-                    logging.info("output from {}: {}".format(self.module, o))
-                    output.append(o)
-                else:
-                    break
-            else:
-                self.module.outputs = []
-        return output
+        outputs = getattr(self.module, 'outputs', None)
+        if outputs is None:
+            self.module.outputs = []
+        elif outputs:
+            # take a snapshot of the list, outputs appended meanwhile are left for next time
+            count = len(outputs)
+            output = outputs[:count]
+            del outputs[:count]
+        if self.outbox:
+            output.extend(self.outbox.drain())
+        if output:
+            logging.debug("output from %s: %s", self.name, output)
+        return [Output(item, self.name) for item in output]
 
 
-class Job(object):
-    def __init__(self, interval, function, debug):
-        self.function = function
-        self.interval = interval
-        self.lastrun = 0
-        self.debug = debug
+def job_options(entry):
+    '''The options of a crontable entry: [interval, function name, {options}]'''
+    return dict(entry[2]) if len(entry) > 2 else {}
 
-    def __str__(self):
-        return "{} {} {}".format(self.function, self.interval, self.lastrun)
 
-    def __repr__(self):
-        return self.__str__()
-
-    def check(self):
-        if self.lastrun + self.interval < time.time():
-            if self.debug is True:
-                # this makes the plugin fail with stack trace in debug mode
-                self.function()
-            else:
-                # otherwise we log the exception and carry on
-                try:
-                    self.function()
-                except Exception:
-                    logging.exception("Problem in job check: {}".format(self.function))
-            self.lastrun = time.time()
+def takes_context(handler):
+    '''Whether a handler takes the event's context as a second argument'''
+    try:
+        spec = getargspec(handler)
+    except TypeError:
+        return False
+    args = spec.args[1:] if inspect.ismethod(handler) else spec.args
+    return len(args) >= 2
 
 
 class UnknownChannel(Exception):
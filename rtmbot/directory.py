@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import logging
+
+from .scheduler import monotonic
+
+
+def is_id(key):
+    '''Tells Slack ids (C024BE91L, U023BECGF, ...) from names'''
+    return len(key) > 1 and key[0] in 'CDGUW' and key.isupper() and key.isalnum()
+
+
+class ChannelIndex(object):
+    '''
+        A dict index over the slackclient server's channel SearchList, which only ever
+        grows by appending, so new channels are indexed incrementally on a miss. It
+        matches the keys Channel.__eq__ does, so a miss never needs a linear search.
+    '''
+    def __init__(self, channels):
+        self.channels = channels
+        self.index = {}
+        self.indexed = 0
+
+    def find(self, key):
+        channel = self.index.get(key)
+        if channel is None and self.indexed != len(self.channels):
+            self.reindex()
+            channel = self.index.get(key)
+        return channel
+
+    def reindex(self):
+        for channel in self.channels[self.indexed:]:
+            self.index.setdefault(channel.id, channel)
+            self.index.setdefault(channel.name, channel)
+            self.index.setdefault('#' + channel.name, channel)
+            if channel.name.startswith('#'):
+                self.index.setdefault(channel.name[1:], channel)
+        self.indexed = len(self.channels)
+
+
+class IMCache(object):
+    '''Maps users to the id of their direct message channel with the bot'''
+    def __init__(self, ttl=3600, clock=monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.ims = {}
+
+    def __len__(self):
+        return len(self.ims)
+
+    def get(self, user):
+        entry = self.ims.get(user)
+        if entry is None:
+            return None
+        channel_id, expires = entry
+        if expires < self.clock():
+            del self.ims[user]
+            return None
+        return channel_id
+
+    def set(self, user, channel_id):
+        self.ims[user] = (channel_id, self.clock() + self.ttl)
+
+    def load(self, ims):
+        '''Fills the cache from the `ims` of an rtm.start payload'''
+        for im in ims:
+            if 'user' in im and 'id' in im:
+                self.set(im['user'], im['id'])
+
+    def discard_channel(self, channel_id):
+        for user, (cached_id, _) in list(self.ims.items()):
+            if cached_id == channel_id:
+                del self.ims[user]
+
+
+class Directory(object):
+    '''
+        The bot's own view of the workspace: channels, groups, IMs and users by id and by
+        name. It is loaded from the rtm.start payload and then kept up to date from RTM
+        events, so plugins can look things up without Web API calls or linear scans.
+
+        When connected without the rtm.start payload, `fetch_channel` and `fetch_user`
+        are set to functions fetching a single channel or user by id, and lookups of
+        ids the directory doesn't know yet go through them once.
+    '''
+    def __init__(self, im_ttl=3600):
+        self.channels = {}
+        self.channel_names = {}
+        self.users = {}
+        self.user_names = {}
+        self.ims = IMCache(im_ttl)
+        self.fetch_channel = None
+        self.fetch_user = None
+        # ids the fetch functions found nothing for, so they are only asked once
+        self.missing = set()
+
+    def load(self, login_data):
+        for channel in login_data.get('channels', []) + login_data.get('groups', []):
+            self.add_channel(channel)
+        for im in login_data.get('ims', []):
+            self.add_channel(im)
+        self.ims.load(login_data.get('ims', []))
+        for user in login_data.get('users', []):
+            self.add_user(user)
+
+    def add_channel(self, channel):
+        previous = self.channels.get(channel['id'])
+        if previous is not None and previous.get('name') != channel.get('name'):
+            self.channel_names.pop(previous.get('name'), None)
+        self.channels[channel['id']] = channel
+        if 'name' in channel:
+            self.channel_names[channel['name']] = channel['id']
+
+    def remove_channel(self, channel_id):
+        channel = self.channels.pop(channel_id, None)
+        if channel is not None and 'name' in channel:
+            self.channel_names.pop(channel['name'], None)
+
+    def add_user(self, user):
+        previous = self.users.get(user['id'])
+        if previous is not None and previous.get('name') != user.get('name'):
+            self.user_names.pop(previous.get('name'), None)
+        self.users[user['id']] = user
+        if 'name' in user:
+            self.user_names[user['name']] = user['id']
+
+    def channel_id(self, key):
+        '''Resolves a channel id, name or #name to the channel's id'''
+        if key in self.channels:
+            return key
+        return self.channel_names.get(key[1:] if key.startswith('#') else key)
+
+    def channel(self, key):
+        channel = self.channels.get(self.channel_id(key))
+        if channel is None and self.fetch_channel is not None:
+            channel = self._fetch(self.fetch_channel, key, self.add_channel)
+        return channel
+
+    def user(self, key):
+        '''Returns the user for a user id or name'''
+        user = self.users.get(key) or self.users.get(self.user_names.get(key))
+        if user is None and self.fetch_user is not None:
+            user = self._fetch(self.fetch_user, key, self.add_user)
+        return user
+
+    def _fetch(self, fetch, key, add):
+        # only ids can be fetched, names are only known once seen
+        if key in self.missing or not is_id(key):
+            return None
+        try:
+            found = fetch(key)
+        except Exception as e:
+            logging.warning('failed fetching {}: {}'.format(key, e))
+            return None
+        if found is None:
+            self.missing.add(key)
+            return None
+        add(found)
+        return found
+
+    def update(self, event):
+        '''Applies an RTM event, returns True when it changed the directory'''
+        event_type = event.get('type')
+        if event_type in ('channel_created', 'channel_joined', 'channel_rename',
+                          'group_joined', 'group_rename'):
+            channel = dict(self.channels.get(event['channel']['id'], {}), **event['channel'])
+            self.add_channel(channel)
+        elif event_type in ('channel_deleted', 'group_left', 'group_deleted'):
+            self.remove_channel(event['channel'])
+        elif event_type == 'im_created':
+            self.add_channel(event['channel'])
+            self.ims.set(event['user'], event['channel']['id'])
+        elif event_type == 'im_close':
+            self.ims.discard_channel(event['channel'])
+        elif event_type in ('user_change', 'team_join'):
+            self.add_user(event['user'])
+        else:
+            return False
+        return True
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import sys
+import time
+import logging
+import threading
+import signal
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .connection import EventContext
+
+POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+
+class QueueExecutor(object):
+    '''
+        Runs plugin calls on a fixed number of workers fed from a bounded queue. When the
+        queue is full the policy decides what happens to a new call:
+            - block - wait for room, which pushes back on the main loop
+            - drop_new - drop the new call
+            - drop_oldest - drop the oldest queued call to make room
+        remote executors run calls in other processes, where the plugin can't time them.
+        In debug mode the exception a call raised is handed to on_failure, which stops
+        the bot like a failing inline handler would.
+    '''
+    remote = False
+
+    def __init__(self, name, workers=4, queue_size=100, policy='block', timeout=None,
+                 debug=False):
+        if policy not in POLICIES:
+            raise ValueError('unknown QUEUE_POLICY: {}'.format(policy))
+        self.name = name
+        self.policy = policy
+        self.timeout = timeout
+        self.debug = debug
+        self.dropped = 0
+        # optional, called with the function, the seconds a call took and whether it failed
+        self.observe = None
+        # optional, called with the exception a call raised in debug mode
+        self.on_failure = None
+        self.queue = self.make_queue(queue_size)
+        self.workers = [self.spawn(self.work) for _ in range(workers)]
+
+    def make_queue(self, size):
+        return queue.Queue(size)
+
+    def spawn(self, function):
+        thread = threading.Thread(target=function, name='plugin-{}'.format(self.name))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def submit(self, function, *args):
+        item = (function, args)
+        if self.policy == 'block':
+            return self.queue.put(item)
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        if self.policy == 'drop_oldest':
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(item)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+        logging.warning('queue for plugin {} is full, dropped a call ({} so far)'.format(
+            self.name, self.dropped))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            function, args = item
+            self.run(function, args)
+
+    def run(self, function, args):
+        start = time.time()
+        failed = False
+        try:
+            function(*args)
+        except Exception as e:
+            failed = True
+            logging.exception('problem in plugin {} worker'.format(self.name))
+            self.failed(e)
+        elapsed = time.time() - start
+        self.observed(function, elapsed, failed)
+        if self.timeout is not None and elapsed > self.timeout:
+            # threads can't be interrupted, the best we can do is to report it
+            logging.warning('plugin {} call took {:.2f}s, over its {}s timeout'.format(
+                self.name, elapsed, self.timeout))
+
+    def observed(self, function, elapsed, failed):
+        if self.observe is not None:
+            self.observe(function, elapsed, failed)
+
+    def failed(self, exception):
+        if self.debug and self.on_failure is not None:
+            self.on_failure(exception)
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.queue.put(None)
+
+
+class ThreadExecutor(QueueExecutor):
+    '''Runs plugin calls on a pool of threads (greenlets when gevent monkey patched)'''
+    pass
+
+
+class GeventExecutor(QueueExecutor):
+    '''Runs plugin calls on a pool of greenlets, the timeout kills overrunning calls'''
+    def make_queue(self, size):
+        import gevent.queue
+        return gevent.queue.Queue(size)
+
+    def spawn(self, function):
+        import gevent
+        return gevent.spawn(function)
+
+    def run(self, function, args):
+        import gevent
+        start = time.time()
+        failed = True
+        try:
+            with gevent.Timeout(self.timeout):
+                function(*args)
+            failed = False
+        except gevent.Timeout:
+            logging.warning('plugin {} call killed after its {}s timeout'.format(
+                self.name, self.timeout))
+        except Exception as e:
+            logging.exception('problem in plugin {} worker'.format(self.name))
+            self.failed(e)
+        self.observed(function, time.time() - start, failed)
+
+
+def _call_in_process(function, args, timeout):
+    '''
+        Runs in the worker process, returns the outputs the call appended so the parent
+        can hand them to its own copy of the plugin
+    '''
+    module = sys.modules[function.__module__]
+    outputs = getattr(module, 'outputs', None)
+    if outputs is None:
+        outputs = module.outputs = []
+    start = len(outputs)
+    if timeout:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        function(*args)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    produced = list(outputs[start:])
+    del outputs[start:]
+    outbox = getattr(module, 'outbox', None)
+    if outbox is not None:
+        produced.extend(outbox.drain())
+    return produced
+
+
+def _raise_timeout(signum, frame):
+    raise RuntimeError('plugin call timed out')
+
+
+def _init_process():
+    signal.signal(signal.SIGALRM, _raise_timeout)
+
+
+class ProcessExecutor(QueueExecutor):
+    '''
+        Runs plugin calls in a pool of forked worker processes. Each process has its own
+        copy of the plugin module, so only the outputs a call produces make it back to the
+        bot, other module state stays in the worker. Arguments must be picklable, event
+        keys starting with `__` are not passed on.
+        The processes are forked on the first call, from the bot's main loop, rather than
+        while the plugin is being loaded.
+    '''
+    remote = True
+
+    def __init__(self, name, workers=4, queue_size=100, policy='block', timeout=None,
+                 debug=False, module=None):
+        self.module = module
+        self.processes = workers
+        self.pool = None
+        # one feeding thread per process keeps the bounded queue semantics
+        super(ProcessExecutor, self).__init__(name, workers, queue_size, policy, timeout,
+                                              debug)
+
+    def start_pool(self):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(self.processes, _init_process)
+
+    def submit(self, function, *args):
+        if self.pool is None:
+            self.start_pool()
+        args = tuple(self.picklable(arg) for arg in args)
+        super(ProcessExecutor, self).submit(function, *args)
+
+    @staticmethod
+    def picklable(arg):
+        if isinstance(arg, dict):
+            return dict((k, v) for k, v in arg.items() if not k.startswith('__'))
+        if isinstance(arg, EventContext):
+            # the connection stays in the bot's process
+            return None
+        return arg
+
+    def run(self, function, args):
+        start = time.time()
+        try:
+            produced = self.pool.apply(_call_in_process, (function, args, self.timeout))
+        except Exception as e:
+            logging.exception('problem in plugin {} worker process'.format(self.name))
+            self.observed(function, time.time() - start, True)
+            self.failed(e)
+            return
+        self.observed(function, time.time() - start, False)
+        if produced and self.module is not None:
+            self.module.outputs.extend(produced)
+
+    def shutdown(self):
+        super(ProcessExecutor, self).shutdown()
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+EXECUTORS = {
+    'thread': ThreadExecutor,
+    'gevent': GeventExecutor,
+    'process': ProcessExecutor,
+}
+
+
+def make_executor(name, module, config):
+    '''
+        Builds the executor for a plugin from its config, None means calls run inline:
+            - EXECUTOR (optional: defaults to 'inline') inline, thread, gevent or process
+            - WORKERS (optional: defaults to 4) number of concurrent calls
+            - QUEUE_SIZE (optional: defaults to 100) calls waiting for a worker
+            - QUEUE_POLICY (optional: defaults to 'block') block, drop_new or drop_oldest
+            - TIMEOUT (optional) seconds a single call may take
+            - DEBUG (optional: defaults to False) hand the errors of calls to on_failure
+    '''
+    kind = config.get('EXECUTOR', 'inline')
+    if kind == 'inline':
+        return None
+    if kind not in EXECUTORS:
+        raise ValueError('unknown EXECUTOR for plugin {}: {}'.format(name, kind))
+    kwargs = dict(
+        workers=config.get('WORKERS', 4),
+        queue_size=config.get('QUEUE_SIZE', 100),
+        policy=config.get('QUEUE_POLICY', 'block'),
+        timeout=config.get('TIMEOUT'),
+        debug=config.get('DEBUG', False),
+    )
+    if kind == 'process':
+        kwargs['module'] = module
+    return EXECUTORS[kind](name, **kwargs)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import os
+import sys
+import glob
+import logging
+
+
+def plugin_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class PluginManifest(object):
+    '''
+        The plugin files matching the patterns, found once at startup. Plugins are
+        imported by module name, so two files with the same name can't both be loaded:
+        the first one found wins.
+    '''
+    def __init__(self, patterns):
+        self.plugins = []
+        names = {}
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)):
+                name = plugin_name(path)
+                if name in names:
+                    logging.warning('skipping plugin {}, {} has the same name'.format(
+                        path, names[name]))
+                    continue
+                names[name] = path
+                self.plugins.append((name, path))
+
+    def directories(self):
+        '''The directories holding the plugins, in the order they were found'''
+        directories = []
+        for _, path in self.plugins:
+            directory = os.path.dirname(path)
+            if directory not in directories:
+                directories.append(directory)
+        return directories
+
+    def install(self):
+        '''Puts the plugins' directories, and only those, at the front of sys.path'''
+        for directory in reversed(self.directories()):
+            if directory not in sys.path:
+                sys.path.insert(0, directory)
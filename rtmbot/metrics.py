@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import bisect
+import logging
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# seconds, good for handlers and sends which mostly take milliseconds
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metric(object):
+    '''
+        A metric with optional labels. Instead of being updated a metric can be given a
+        function, called when the metric is rendered, which returns the value or, for a
+        labeled metric, a dict of label value tuples to values.
+    '''
+    kind = None
+
+    def __init__(self, name, help='', labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        try:
+            key = tuple(labels[label] for label in self.labels)
+        except KeyError:
+            key = None
+        if key is None or len(labels) != len(self.labels):
+            raise ValueError('{} takes the labels {}, got {}'.format(
+                self.name, self.labels, sorted(labels)))
+        return key
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        '''Returns (suffix, label names, label values, value) tuples'''
+        values = self.function() if self.function is not None else self.values
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', self.labels, key, value) for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # a count per bucket (the last one is +Inf), the sum and the count
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, **labels):
+        '''Returns the (count, sum) observed'''
+        entry = self.values.get(self.key(labels))
+        if entry is None:
+            return 0, 0.0
+        return entry[2], entry[1]
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = sorted((key, (list(entry[0]), entry[1], entry[2]))
+                            for key, entry in self.values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', self.labels + ('le',),
+                                key + (format_value(bound),), cumulative))
+            samples.append(('_sum', self.labels, key, total))
+            samples.append(('_count', self.labels, key, count))
+        return samples
+
+
+class Registry(object):
+    '''
+        The bot's metrics, injected into every plugin as `metrics`. Asking for a metric
+        creates it the first time, so plugins can define their own where they use them:
+
+            metrics.counter('weather_lookups_total', 'Weather lookups', ['city']).inc(city=city)
+    '''
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(
+                        'metric {} is already registered as a {} with labels {}'.format(
+                            metric.name, existing.kind, existing.labels))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def counter(self, name, help='', labels=(), function=None):
+        return self.register(Counter(name, help, labels, function))
+
+    def gauge(self, name, help='', labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        '''Returns the metrics in the Prometheus text exposition format'''
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.exception('failed collecting metric {}'.format(name))
+                continue
+            lines.append('# HELP {} {}'.format(name, escape(metric.help, help=True)))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for suffix, label_names, label_values, value in samples:
+                labels = ''
+                if label_names:
+                    labels = '{{{}}}'.format(','.join(
+                        '{}="{}"'.format(label, escape(label_value))
+                        for label, label_value in zip(label_names, label_values)))
+                lines.append('{}{}{} {}'.format(name, suffix, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value, help=False):
+    value = '{}'.format(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value if help else value.replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return '{}'.format(value)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    '''Serves a registry on /metrics from a background thread'''
+    daemon_threads = True
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.registry = registry
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.thread = threading.Thread(target=self.serve_forever, name='metrics')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown the bot's log
+        pass
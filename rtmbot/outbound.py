@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import itertools
+from collections import deque
+
+from .scheduler import monotonic, string_types
+
+# outputs other than plain text messages, these are never coalesced
+SPECIAL_OUTPUTS = ('TYPING', 'DM', 'FILE')
+
+
+class Output(list):
+    '''An output which remembers the plugin it came from, so deliveries can be tracked'''
+    def __init__(self, items=(), origin=None):
+        super(Output, self).__init__(items)
+        self.origin = origin
+
+
+class TokenBucket(object):
+    '''Allows `rate` events per second on average, with bursts of up to `burst` events'''
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def ready_at(self, now):
+        '''Returns the monotonic time the next token becomes available'''
+        self.refill(now)
+        return now + max(0, 1 - self.tokens) / self.rate
+
+
+class OutboundQueue(object):
+    '''
+        Queues plugin outputs and releases them as fast as Slack allows: a global token
+        bucket limits the bot as a whole and one bucket per channel models Slack's
+        per-channel limit. Replies to events are sent before cron chatter, order within a
+        channel and lane is kept, and consecutive short messages to the same channel are
+        coalesced into one message.
+    '''
+    REPLY = 0
+    CRON = 1
+
+    def __init__(self, rate=10, burst=20, channel_rate=1, channel_burst=3,
+                 coalesce_limit=4000, clock=monotonic):
+        self.clock = clock
+        self.rate, self.burst = rate, burst
+        self.channel_rate, self.channel_burst = channel_rate, channel_burst
+        self.coalesce_limit = coalesce_limit
+        self.bucket = TokenBucket(rate, burst, clock())
+        self.channel_buckets = {}
+        # channel -> one deque per priority lane, of (seq, enqueued, output)
+        self.pending = {}
+        self.counter = itertools.count()
+        self.depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, output, priority=REPLY):
+        channel = output[0]
+        lanes = self.pending.get(channel)
+        if lanes is None:
+            lanes = self.pending[channel] = (deque(), deque())
+        lanes[priority].append((next(self.counter), self.clock(), output))
+        self.depth += 1
+
+    def _channel_bucket(self, channel, now):
+        bucket = self.channel_buckets.get(channel)
+        if bucket is None:
+            bucket = self.channel_buckets[channel] = TokenBucket(
+                self.channel_rate, self.channel_burst, now)
+        return bucket
+
+    def _next_lane(self, now):
+        '''Returns the lane holding the best output whose channel may send now'''
+        best = None
+        for channel, lanes in self.pending.items():
+            if not self._channel_bucket(channel, now).ready(now):
+                continue
+            for priority, lane in enumerate(lanes):
+                if lane:
+                    key = (priority, lane[0][0])
+                    if best is None or key < best[0]:
+                        best = (key, channel, lane)
+                    break
+        return best
+
+    def pop_ready(self):
+        '''Returns the outputs which may be sent now, in the order to send them'''
+        now = self.clock()
+        ready = []
+        while self.depth and self.bucket.ready(now):
+            best = self._next_lane(now)
+            if best is None:
+                break
+            _, channel, lane = best
+            self.bucket.take()
+            self.channel_buckets[channel].take()
+            _, enqueued, output = lane.popleft()
+            self.depth -= 1
+            output = self._coalesce(output, lane)
+            latency = now - enqueued
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            ready.append(output)
+            if not any(self.pending[channel]):
+                del self.pending[channel]
+        return ready
+
+    def _coalesce(self, output, lane):
+        if not self._plain(output):
+            return output
+        text = output[1]
+        while lane and self._plain(lane[0][2]):
+            following = lane[0][2][1]
+            if len(text) + 1 + len(following) > self.coalesce_limit:
+                break
+            text = '{}\n{}'.format(text, following)
+            lane.popleft()
+            self.depth -= 1
+            self.coalesced += 1
+        # the acks of a coalesced message count for the plugin of its first line
+        return Output([output[0], text], getattr(output, 'origin', None))
+
+    @staticmethod
+    def _plain(output):
+        return (len(output) == 2 and isinstance(output[1], string_types) and
+                output[1] not in SPECIAL_OUTPUTS)
+
+    def next_ready(self):
+        '''Returns the monotonic time an output may be sent next, or None when empty'''
+        if not self.depth:
+            return None
+        now = self.clock()
+        channel_ready = min(self._channel_bucket(channel, now).ready_at(now)
+                            for channel in self.pending)
+        return max(self.bucket.ready_at(now), channel_ready)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'latency_avg': self.latency_total / self.sent if self.sent else 0.0,
+            'latency_max': self.latency_max,
+        }
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import cProfile
+import gc
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+from collections import defaultdict
+
+# the CPU time of the OS thread: under gevent, a call which yields is also charged with
+# what the other greenlets ran on the thread meanwhile
+try:
+    from time import thread_time as cpu_time
+except ImportError:
+    # python 2, process wide but close enough for a blocked loop
+    from time import clock as cpu_time
+
+try:
+    import thread as _thread
+except ImportError:
+    import _thread
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+from .scheduler import monotonic
+
+
+def original(module, name, default):
+    '''Returns the function gevent's monkey patching replaced, or the default'''
+    # nothing is patched unless gevent.monkey was imported
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None:
+        return default
+    try:
+        return monkey.get_original(module, name)
+    except Exception:
+        return default
+
+# the watchdog must be an OS thread to see a loop which doesn't yield
+start_new_thread = original(_thread.__name__, 'start_new_thread', _thread.start_new_thread)
+get_ident = original(_thread.__name__, 'get_ident', _thread.get_ident)
+sleep = original('time', 'sleep', time.sleep)
+
+
+class CallStats(object):
+    __slots__ = ('calls', 'slow', 'wall', 'wall_max', 'cpu')
+
+    def __init__(self):
+        self.calls = self.slow = 0
+        self.wall = self.wall_max = self.cpu = 0.0
+
+    def __repr__(self):
+        return 'calls={} slow={} wall={:.3f}s max={:.3f}s cpu={:.3f}s'.format(
+            self.calls, self.slow, self.wall, self.wall_max, self.cpu)
+
+
+class Profiler(object):
+    '''
+        Times plugin handlers and jobs (wall and CPU time) and watches them from an OS
+        thread: a call running longer than `threshold` seconds is logged with the stack
+        it is stuck in, and with the stacks of all greenlets under gevent.
+
+        Sending the process `signal` starts a profiling session, sending it again writes
+        a cProfile dump (.pstats) of the main thread and a sampled flamegraph in the
+        collapsed stack format (.folded) to `directory`.
+    '''
+    def __init__(self, threshold=0.5, directory='.', signal_name='SIGUSR2',
+                 sample_interval=0.01):
+        self.threshold = threshold
+        self.directory = directory
+        self.signal_name = signal_name
+        self.sample_interval = sample_interval
+        self.stats = defaultdict(CallStats)
+        # the running calls, by greenlet (or thread): [label, start, thread, flagged]
+        self.active = {}
+        self.started = False
+        self.main_thread = get_ident()
+        self.profile = None
+        self.samples = None
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        if self.signal_name:
+            signal.signal(getattr(signal, self.signal_name), self.toggle)
+        start_new_thread(self.watch, ())
+
+    @staticmethod
+    def current():
+        return greenlet.getcurrent() if greenlet is not None else get_ident()
+
+    def run(self, label, function, *args):
+        key = self.current()
+        entry = [label, monotonic(), get_ident(), False]
+        outer = self.active.get(key)
+        self.active[key] = entry
+        cpu_start = cpu_time()
+        try:
+            return function(*args)
+        finally:
+            wall = monotonic() - entry[1]
+            cpu = cpu_time() - cpu_start
+            if outer is not None:
+                self.active[key] = outer
+            else:
+                self.active.pop(key, None)
+            stats = self.stats[label]
+            stats.calls += 1
+            stats.wall += wall
+            stats.wall_max = max(stats.wall_max, wall)
+            stats.cpu += cpu
+            if wall > self.threshold:
+                stats.slow += 1
+
+    def watch(self):
+        while True:
+            if self.samples is not None:
+                self.sample()
+                sleep(self.sample_interval)
+            else:
+                self.check()
+                sleep(self.threshold / 2.0)
+
+    def check(self, now=None):
+        '''Logs the calls which just went over the threshold, returns their labels'''
+        now = now or monotonic()
+        flagged = []
+        for key, entry in list(self.active.items()):
+            label, start, thread, already = entry
+            if already or now - start < self.threshold:
+                continue
+            entry[3] = True
+            flagged.append(label)
+            logging.warning('{} has been running for {:.2f}s:\n{}'.format(
+                label, now - start, self.format_stacks(key, thread)))
+        return flagged
+
+    def format_stacks(self, key, thread):
+        frame = None
+        if greenlet is not None:
+            frame = key.gr_frame
+        if frame is None:
+            # the greenlet is the one running, or there are no greenlets
+            frame = sys._current_frames().get(thread)
+        lines = ['  ' + line for line in traceback.format_stack(frame)] if frame else []
+        if greenlet is not None:
+            for other, other_frame in self.greenlet_frames():
+                if other is not key:
+                    lines.append('greenlet {!r}:\n'.format(other))
+                    lines.extend('  ' + line for line in traceback.format_stack(other_frame))
+        return ''.join(lines)
+
+    @staticmethod
+    def greenlet_frames():
+        for obj in gc.get_objects():
+            if isinstance(obj, greenlet.greenlet) and obj.gr_frame is not None:
+                yield obj, obj.gr_frame
+
+    def sample(self):
+        samples = self.samples
+        frame = sys._current_frames().get(self.main_thread)
+        if samples is None or frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                              code.co_firstlineno))
+            frame = frame.f_back
+        samples[';'.join(reversed(stack))] += 1
+
+    def toggle(self, signum=None, frame=None):
+        if self.profile is None:
+            logging.info('profiling started')
+            self.samples = defaultdict(int)
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return
+        self.profile.disable()
+        samples, self.samples = self.samples, None
+        prefix = os.path.join(self.directory, 'rtmbot-{}-{}'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.profile.dump_stats(prefix + '.pstats')
+        self.profile = None
+        with open(prefix + '.folded', 'w') as folded:
+            for stack, count in sorted(samples.items()):
+                folded.write('{} {}\n'.format(stack, count))
+        logging.info('profiling stopped, wrote {}.pstats and {}.folded\n{}'.format(
+            prefix, prefix, self.report()))
+
+    def report(self):
+        '''Returns the call statistics, slowest first'''
+        return '\n'.join('{} {!r}'.format(label, stats) for label, stats in
+                         sorted(self.stats.items(), key=lambda item: -item[1].wall))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import time
+import logging
+import random
+import heapq
+import itertools
+import threading
+import datetime
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # python 2 has no monotonic clock in the standard library
+    monotonic = time.time
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# how many missed runs a 'catchup' job may replay before it skips ahead instead
+MAX_CATCHUP = 10
+
+
+class CronExpression(object):
+    '''
+        A standard five field cron expression: minute hour day-of-month month day-of-week.
+        Fields support `*`, `a-b`, `a,b,c` and `/step`, day-of-week is 0-6 starting on
+        sunday (7 is also sunday). Times are matched against the local wall clock.
+    '''
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError('cron expression needs 5 fields: {}'.format(expression))
+        fields = [self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        self.weekdays = set(day % 7 for day in weekdays)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(x) for x in part.split('-')]
+            else:
+                start = end = int(part)
+            if start < low or end > high or step < 1:
+                raise ValueError('cron field out of range: {}'.format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, date):
+        day = date.day in self.days
+        # isoweekday is 1-7 starting monday, cron is 0-6 starting sunday
+        weekday = date.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        # like cron, when both are restricted either one matching is enough
+        return day or weekday
+
+    def next_after(self, timestamp):
+        '''Returns the first matching timestamp strictly after the given one'''
+        moment = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0)
+        moment += datetime.timedelta(minutes=1)
+        # bounded so an impossible expression (e.g. feb 31st) can't spin forever
+        for _ in range(366 * 24 * 60):
+            if moment.month not in self.months:
+                month = moment.month % 12 + 1
+                year = moment.year + (1 if month == 1 else 0)
+                moment = moment.replace(year=year, month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError('cron expression never matches: {}'.format(self.expression))
+
+
+class Job(object):
+    def __init__(self, interval, function, debug, jitter=0, policy='skip', background=False,
+                 every_shard=False):
+        '''
+            A job is created with:
+                - interval (number or str) - seconds between runs, or a cron expression
+                - function (callable)
+                - debug (bool) - with debug enabled exceptions in the job are raised
+                - jitter (number) - optional, random delay in seconds added to every run
+                - policy (str) - optional, what to do about runs missed while the bot was
+                    busy: 'skip' (default) moves on to the next slot, 'catchup' replays
+                    them (up to MAX_CATCHUP)
+                - background (bool) - optional, run the job in its own thread (a greenlet
+                    under gevent) so it doesn't block the main loop
+                - every_shard (bool) - optional, with SHARDS run the job in every worker,
+                    not just the first, for jobs looking after the worker's own state
+        '''
+        if policy not in ('skip', 'catchup'):
+            raise ValueError('unknown job policy: {}'.format(policy))
+        self.function = function
+        self.interval = interval
+        self.cron = CronExpression(interval) if isinstance(interval, string_types) else None
+        self.jitter = jitter
+        self.policy = policy
+        self.background = background
+        self.every_shard = every_shard
+        self.lastrun = time.time() if self.cron else 0
+        self.debug = debug
+        self.cancelled = False
+        # the unjittered monotonic time of the next run, owned by the Scheduler
+        self.scheduled = None
+        self.thread = None
+        # optional, called with the job, the seconds a run took and whether it failed
+        self.observe = None
+        # optional, a rtmbot.profiling.Profiler timing and watching the runs
+        self.profiler = None
+
+    def __str__(self):
+        return "{} {} {}".format(self.function, self.interval, self.lastrun)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def check(self):
+        if self.cron:
+            due = self.cron.next_after(self.lastrun) <= time.time()
+        else:
+            due = self.lastrun + self.interval < time.time()
+        if due:
+            self.execute()
+
+    def run(self):
+        '''Runs the job, in the background if it asked for it'''
+        if not self.background:
+            return self.execute()
+        if self.thread is not None and self.thread.is_alive():
+            logging.warning("Skipping job still running in background: {}".format(self.function))
+            return
+        self.thread = threading.Thread(target=self.execute, name='job-{}'.format(
+            getattr(self.function, '__name__', self.function)))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def execute(self):
+        start = monotonic()
+        failed = False
+        try:
+            if self.profiler is not None:
+                self.profiler.run('job {}'.format(
+                    getattr(self.function, '__name__', self.function)), self.function)
+            else:
+                self.function()
+        except Exception:
+            failed = True
+            if self.debug is True:
+                # this makes the plugin fail with stack trace in debug mode
+                raise
+            # otherwise we log the exception and carry on
+            logging.exception("Problem in job check: {}".format(self.function))
+        finally:
+            if self.observe is not None:
+                self.observe(self, monotonic() - start, failed)
+        self.lastrun = time.time()
+
+    def first_run(self, now):
+        '''Returns the monotonic time of the first run, interval jobs run right away'''
+        if self.cron:
+            return now + self.cron.next_after(time.time()) - time.time()
+        return now
+
+    def next_run(self, now):
+        '''Returns the monotonic time of the run following the one that just happened'''
+        if self.cron:
+            return now + self.cron.next_after(time.time()) - time.time()
+        if self.interval <= 0:
+            return now
+        scheduled = self.scheduled + self.interval
+        missed = (now - scheduled) // self.interval
+        if missed > 0 and (self.policy == 'skip' or missed > MAX_CATCHUP):
+            scheduled += (missed + 1) * self.interval
+        return scheduled
+
+
+class Scheduler(object):
+    '''
+        Runs jobs from a min-heap of deadlines on a monotonic clock, so each tick only
+        costs O(log n) per due job instead of a scan over every job.
+    '''
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, job):
+        job.cancelled = False
+        job.scheduled = job.first_run(self.clock())
+        self._push(job)
+
+    def remove(self, job):
+        # removed lazily, cancelled jobs are dropped when they reach the top of the heap
+        job.cancelled = True
+
+    def _push(self, job):
+        deadline = job.scheduled
+        if job.jitter:
+            deadline += random.uniform(0, job.jitter)
+        heapq.heappush(self.heap, (deadline, next(self.counter), job))
+
+    def next_deadline(self):
+        '''Returns the monotonic time the next job is due, or None without jobs'''
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def run_pending(self):
+        now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, job = heapq.heappop(self.heap)
+            if not job.cancelled:
+                due.append(job)
+        # every due job runs at most once per tick, catching up happens over the next ticks
+        for index, job in enumerate(due):
+            try:
+                job.run()
+            except Exception:
+                # raised in debug mode, the jobs which didn't get to run are still due
+                for pending in due[index + 1:]:
+                    self._push(pending)
+                raise
+            finally:
+                if not job.background:
+                    # inline jobs take time, don't schedule the next run in the past
+                    now = self.clock()
+                job.scheduled = job.next_run(now)
+                self._push(job)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import logging
+import multiprocessing
+import zlib
+
+try:
+    from queue import Empty
+except ImportError:
+    # python 2
+    from Queue import Empty
+
+from slackclient import SlackClient
+
+from .scheduler import monotonic, string_types
+
+# events every worker needs to see, not just the one owning the channel
+BROADCAST_EVENTS = ('user_info', 'hello')
+# the longest a worker waits for events before looking at its jobs and outputs again
+WORKER_MAX_WAIT = 0.1
+
+
+def shard_key(data):
+    '''Returns the channel an event belongs to, or None'''
+    channel = data.get('channel')
+    if isinstance(channel, string_types):
+        return channel
+    item = data.get('item')
+    if isinstance(item, dict) and isinstance(item.get('channel'), string_types):
+        return item['channel']
+    return None
+
+
+def shard_for(key, count):
+    # hash() is randomized per process, crc32 is stable
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+def run_worker(index, config, events, outputs):
+    '''
+        The main loop of a worker process: it loads the plugins, handles the events
+        the front-end sends it and sends the plugins' outputs back, along with the event
+        types the plugins handle whenever those change. Only worker 0 runs the plugins'
+        timed jobs, except those with the every_shard option.
+    '''
+    from .core import RtmBot
+    bot = RtmBot(dict(config, SHARDS=None, OUTPUT_QUEUE=False))
+    bot.run_jobs = index == 0
+    bot.shard = index
+    for connection in bot.connections:
+        # Web API only, the front-end owns the websocket
+        connection.slack_client = SlackClient(connection.token)
+        connection.directory.fetch_channel = connection.fetch_channel
+        connection.directory.fetch_user = connection.fetch_user
+    bot.load_plugins()
+    reported = None
+    while True:
+        if bot.dispatch_version != reported:
+            reported = bot.dispatch_version
+            outputs.send(('events', bot.wanted_events()))
+        timeout = WORKER_MAX_WAIT
+        deadline = bot.scheduler.next_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, deadline - monotonic()))
+        try:
+            message = events.get(timeout=timeout)
+        except Empty:
+            message = None
+        if message is not None:
+            kind, connection_index, team_id, data = message
+            connection = bot.connections[connection_index]
+            connection.team_id = team_id
+            if kind == 'event':
+                bot.input(data, connection)
+            else:
+                connection.directory.update(data)
+        bot.crons()
+        for batch in bot.pending_outputs():
+            if batch:
+                outputs.send(('outputs', batch))
+
+
+class ShardPool(object):
+    '''
+        Runs the plugins in `count` worker processes. Events are sharded by channel, so
+        the events of a channel are handled in order by the same worker, and the
+        workers' outputs come back to the front-end, which owns the websocket and sends
+        them. Directory changes reach every worker. Once every worker has told which
+        event types its plugins handle, the others are dropped instead of being sent.
+    '''
+    def __init__(self, count, config):
+        self.count = count
+        self.config = config
+        # the queues outlive the workers, a restarted worker picks up where it left off
+        self.queues = [multiprocessing.Queue() for _ in range(count)]
+        self.readers = [None] * count
+        self.processes = [None] * count
+        # worker index -> the event types its plugins handle, None for all of them
+        self.wanted = {}
+        # the event types sent to the workers, None for all of them
+        self.events = None
+
+    def start(self):
+        for index in range(self.count):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=run_worker, args=(index, self.config, self.queues[index], writer),
+            name='rtmbot-shard-{}'.format(index))
+        process.daemon = True
+        process.start()
+        # only the worker writes, its exit closes the pipe
+        writer.close()
+        self.readers[index] = reader
+        self.processes[index] = process
+        self.set_events(index, None)
+
+    def set_events(self, index, events):
+        '''Records the event types a worker's plugins handle, `events` None for all'''
+        self.wanted[index] = events
+        if len(self.wanted) < self.count or None in self.wanted.values():
+            self.events = None
+        else:
+            self.events = set().union(*self.wanted.values())
+
+    def dispatch(self, data, connection_index, team_id, directory_changed=False):
+        if data.get('type') in BROADCAST_EVENTS:
+            for queue in self.queues:
+                queue.put(('event', connection_index, team_id, data))
+            return
+        if self.events is not None and data.get('type') not in self.events:
+            # no plugin handles it, the workers only need what it changed
+            if directory_changed:
+                for queue in self.queues:
+                    queue.put(('directory', connection_index, team_id, data))
+            return
+        key = shard_key(data)
+        owner = shard_for(key, self.count) if key is not None else 0
+        for index, queue in enumerate(self.queues):
+            if index == owner:
+                queue.put(('event', connection_index, team_id, data))
+            elif directory_changed:
+                queue.put(('directory', connection_index, team_id, data))
+
+    def collect(self):
+        '''Returns the batches of outputs the workers sent, restarting dead workers'''
+        batches = []
+        for index, reader in enumerate(self.readers):
+            try:
+                while reader.poll():
+                    kind, message = reader.recv()
+                    if kind == 'events':
+                        self.set_events(index, message)
+                    else:
+                        batches.append(message)
+            except (EOFError, IOError):
+                reader.close()
+                self.processes[index].join()
+                logging.error('shard {} exited with {}, restarting it'.format(
+                    index, self.processes[index].exitcode))
+                self.start_worker(index)
+        return batches
+
+    def shutdown(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+import os
+import glob
+import logging
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class PluginWatcher(object):
+    '''
+        Tells which plugin files were added, changed or removed since the last check.
+        With the optional inotify_simple package installed a check only looks at the
+        files after the kernel reported a change in one of the directories, otherwise
+        it compares the mtimes of every plugin file. Every directory the patterns can
+        match files in is watched, including those created later on.
+    '''
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.mtimes = self.scan()
+        self.inotify = None
+        self.watched = set()
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.watch_directories()
+            except OSError as e:
+                logging.warning('inotify unavailable, polling plugins instead: {}'.format(e))
+                self.inotify = None
+
+    def directories(self):
+        '''The directories the patterns match files in, empty ones included'''
+        directories = set()
+        for pattern in self.patterns:
+            for directory in glob.glob(os.path.dirname(pattern)):
+                if os.path.isdir(directory):
+                    directories.add(directory)
+        return directories
+
+    def watch_directories(self):
+        mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                flags.CREATE | flags.DELETE)
+        directories = self.directories()
+        # the kernel drops the watches of removed directories
+        self.watched &= directories
+        for directory in directories - self.watched:
+            self.inotify.add_watch(directory, mask)
+            self.watched.add(directory)
+
+    def scan(self):
+        mtimes = {}
+        for pattern in self.patterns:
+            for path in glob.glob(pattern):
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    # removed between the glob and the stat
+                    pass
+        return mtimes
+
+    def check(self):
+        '''Returns the (added, changed, removed) plugin files'''
+        if self.inotify is not None:
+            if not self.inotify.read(timeout=0):
+                return [], [], []
+            # a new subdirectory of the plugins directory, its files are found below
+            try:
+                self.watch_directories()
+            except OSError as e:
+                logging.warning('could not watch new plugin directories: {}'.format(e))
+        current = self.scan()
+        added = [path for path in current if path not in self.mtimes]
+        removed = [path for path in self.mtimes if path not in current]
+        changed = [path for path in current
+                   if path in self.mtimes and current[path] != self.mtimes[path]]
+        self.mtimes = current
+        return added, changed, removed
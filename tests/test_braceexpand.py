@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from braceexpand import BraceTemplate, count_braces, expand_braces
+
+
+def test_plain_text():
+    assert list(expand_braces('no braces here')) == ['no braces here']
+
+
+def test_groups():
+    assert list(expand_braces('{a|b} to {c|d}')) == ['a to c', 'a to d', 'b to c', 'b to d']
+    assert count_braces('{a|b} to {c|d|e}') == 6
+
+
+def test_nesting_and_escaping():
+    assert list(expand_braces('{a|b{c|d}}!')) == ['a!', 'bc!', 'bd!']
+    assert list(expand_braces(r'\{a|b\} {x\|y|z}')) == ['{a|b} x|y', '{a|b} z']
+    assert list(expand_braces('{stray | brace} }')) == ['stray  }', ' brace }']
+    assert list(expand_braces('{open')) == ['{open']
+
+
+def test_large_expansions_stream():
+    template = BraceTemplate('{0|1|2|3|4|5|6|7|8|9}' * 30)
+    assert template.count == 10 ** 30
+    assert not hasattr(template, '__len__')
+    combinations = iter(template)
+    assert next(combinations) == '0' * 30
+    assert next(combinations) == '0' * 29 + '1'
+
+
+def test_backslashes_are_only_escapes_before_special_characters():
+    assert list(expand_braces(r'a\n{b|c}\\')) == ['a\\nb\\', 'a\\nc\\']
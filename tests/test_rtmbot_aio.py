@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5), reason='asyncio flavour, python 3.5+')
+
+# the plugin is exec'ed so this file still parses on python 2
+PLUGIN = '''
+import asyncio
+import threading
+
+outputs = []
+crontable = [[60, 'tick'], [60, 'sync_tick']]
+threads = set()
+
+
+async def process_message(data):
+    await asyncio.sleep(0.01)
+    outputs.append([data['channel'], 'async ' + data['text']])
+
+
+def process_reaction_added(data):
+    threads.add(threading.current_thread().name)
+    outputs.append([data['item']['channel'], 'sync'])
+
+
+async def tick():
+    outputs.append(['C1', 'tick'])
+
+
+def sync_tick():
+    threads.add(threading.current_thread().name)
+
+
+async def process_team_join(data):
+    raise ValueError('broken')
+'''
+
+
+def load_plugin(name, config=None):
+    from rtmbot.aio import AsyncPlugin
+
+    module = types.ModuleType(name)
+    exec(PLUGIN, module.__dict__)
+    sys.modules[name] = module
+    return AsyncPlugin(name, config or {})
+
+
+def test_async_plugin():
+    ''' Test that async and sync handlers and jobs all run, without blocking the loop '''
+    import asyncio
+    import threading
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        plugin = load_plugin('async_test_plugin')
+        plugin.do('process_message', {'channel': 'C1', 'text': 'hi'})
+        plugin.do('process_reaction_added', {'item': {'channel': 'C2'}})
+        for job in plugin.jobs:
+            job.run()
+        loop.run_until_complete(asyncio.sleep(0.1))
+
+        assert sorted(plugin.do_output()) == [['C1', 'async hi'], ['C1', 'tick'], ['C2', 'sync']]
+        # one thread of the plugin's own, off the loop
+        assert len(plugin.module.threads) == 1
+        assert threading.current_thread().name not in plugin.module.threads
+        assert plugin.handler_seconds.get(
+            plugin='async_test_plugin', handler='process_message')[0] == 1
+        assert not plugin.tasks
+    finally:
+        loop.close()
+        sys.modules.pop('async_test_plugin', None)
+
+
+def test_async_plugin_failure():
+    ''' Test that a failing async handler is logged, or reaches the bot in debug mode '''
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        plugin = load_plugin('async_failing_plugin')
+        failures = []
+        plugin.on_failure = failures.append
+        plugin.do('process_team_join', {})
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert failures == []
+        assert plugin.handler_errors.get(
+            plugin='async_failing_plugin', handler='process_team_join') == 1
+
+        plugin.debug = True
+        plugin.do('process_team_join', {})
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert len(failures) == 1 and isinstance(failures[0], ValueError)
+    finally:
+        loop.close()
+        sys.modules.pop('async_failing_plugin', None)
+
+
+def test_gevent_plugins_are_refused():
+    ''' Test that a plugin relying on gevent isn't loaded, instead of never answering '''
+    from rtmbot.aio import AsyncPlugin
+
+    module = types.ModuleType('async_gevent_plugin')
+    module.REQUIRES_GEVENT = True
+    module.setup = lambda: module.__dict__.setdefault('set_up', True)
+    sys.modules['async_gevent_plugin'] = module
+    try:
+        with pytest.raises(ValueError):
+            AsyncPlugin('async_gevent_plugin', {})
+        assert not hasattr(module, 'set_up')
+    finally:
+        sys.modules.pop('async_gevent_plugin', None)
+
+
+def test_async_bot_config():
+    from rtmbot.aio import AsyncRtmBot
+
+    bot = AsyncRtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': '/tmp/',
+                       'LOGFILE': '/tmp/rtmbot.log'})
+    assert bot.loop == 'event'
+    with pytest.raises(ValueError):
+        AsyncRtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': '/tmp/',
+                     'LOGFILE': '/tmp/rtmbot.log', 'SHARDS': 2})
+    with pytest.raises(ValueError):
+        bot.make_plugin('async_test_plugin', {'EXECUTOR': 'gevent'}, None)
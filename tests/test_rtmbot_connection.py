@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from rtmbot.connection import Backoff, Connection
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def connected(clock):
+    connection = Connection('test-12345', {'PING_TIMEOUT': 10}, clock=clock)
+    connection.slack_client = Mock()
+    connection.last_ping = clock()
+    return connection
+
+
+def test_backoff():
+    ''' Test that the delays grow exponentially up to the cap, with jitter '''
+    backoff = Backoff(base=1, cap=8)
+    delays = [backoff.next_delay() for _ in range(6)]
+    for delay, bound in zip(delays, [1, 2, 4, 8, 8, 8]):
+        assert 0 <= delay <= bound
+    backoff.reset()
+    assert backoff.next_delay() <= 1
+
+
+def test_ping_pong():
+    ''' Test that answered pings keep the connection alive and unanswered ones don't '''
+    clock = FakeClock()
+    connection = connected(clock)
+    websocket = connection.slack_client.server.websocket
+
+    clock.now += 3
+    assert connection.autoping()
+    assert websocket.send.call_count == 1
+    assert len(connection.pings) == 1
+    connection.pong(list(connection.pings)[0])
+    assert connection.pings == {}
+
+    clock.now += 3
+    assert connection.autoping()
+    clock.now += 3
+    assert connection.autoping()
+    assert len(connection.pings) == 2
+    clock.now += 7.5
+    assert not connection.autoping()
+
+
+def test_batched_send_and_acks():
+    ''' Test that messages written together go out in one write and acks are matched '''
+    import json
+    import threading
+
+    clock = FakeClock()
+    connection = connected(clock)
+    websocket = connection.slack_client.server.websocket
+    websocket.lock = threading.Lock()
+    # no masking, to read the frames back
+    websocket.get_mask_key = lambda length: b'\x00' * length
+    writes = []
+
+    def write(data):
+        writes.append(data)
+        return len(data)
+    websocket._send = write
+
+    first = connection.send_message('C1', 'hello "there"', origin='repeat')
+    second = connection.send_message('C1', 'ù hœø3ö', origin='todo')
+    assert first != second
+    assert connection.flush() == 2
+    assert len(writes) == 1
+    # a 2 byte header and the 4 byte mask
+    length = bytearray(writes[0])[1] & 0x7f
+    assert json.loads(writes[0][6:6 + length].decode('utf-8')) == {
+        'type': 'message', 'channel': 'C1', 'text': 'hello "there"', 'id': first}
+    assert connection.flush() == 0
+
+    clock.now += 0.25
+    assert connection.ack({'ok': True, 'reply_to': first}) == ('repeat', 0.25)
+    assert connection.ack({'ok': True, 'reply_to': first}) is None
+    assert connection.expire_acks() == []
+    clock.now += 30
+    assert connection.expire_acks() == ['todo']
+    assert not connection.unacked
+
+
+def test_failed_flush():
+    ''' Test that only the frames which got out before a failed write wait for an ack '''
+    import socket
+    import threading
+
+    connection = connected(FakeClock())
+    websocket = connection.slack_client.server.websocket
+    websocket.lock = threading.Lock()
+    websocket.get_mask_key = None
+    ids = [connection.send_message('C1', text) for text in ('one', 'two', 'three')]
+    frame = len(connection.encode_frame(websocket, connection.frames[0][0]))
+    writes = [frame + 3]
+
+    def write(data):
+        if not writes:
+            raise socket.error('broken pipe')
+        return writes.pop()
+    websocket._send = write
+
+    try:
+        connection.flush()
+    except socket.error:
+        pass
+    else:
+        assert False, 'the write error should be raised'
+    assert connection.flushed == 1
+    assert list(connection.unacked) == ids[:1]
+    assert connection.frames == []
+
+
+def test_reconnect_backoff():
+    ''' Test that a lost connection is retried later, not right away '''
+    clock = FakeClock()
+    connection = connected(clock)
+    connection.backoff = Backoff(base=1, cap=1)
+    connection.lost('test')
+    assert not connection.connected
+    assert connection.slack_client.server.websocket.close.called
+    assert 1000 <= connection.retry_at <= 1001
+
+    connection.retry_at = 1001
+    assert not connection.retry_due()
+    clock.now = 1001
+    assert connection.retry_due()
+
+    connection.slack_client.server.rtm_connect.side_effect = IOError('still down')
+    assert not connection.reconnect()
+    assert connection.retry_at is not None
+
+    connection.slack_client.server.rtm_connect.side_effect = None
+    connection.slack_client.server.login_data = {'channels': [{'id': 'C1', 'name': 'general'}]}
+    assert connection.reconnect()
+    assert connection.connected
+    assert connection.directory.channel_id('#general') == 'C1'
+
+
+def test_lightweight_connect():
+    ''' Test that rtm.connect is used and channels are fetched when first needed '''
+    from slackclient._channel import Channel
+    from slackclient._util import SearchList
+
+    connection = Connection('test-12345', {'RTM_CONNECT': True})
+    connection.slack_client = client = Mock()
+    client.server.channels = SearchList()
+    replies = {
+        'rtm.connect': {'ok': True, 'url': 'wss://example', 'team': {'domain': 'test'},
+                        'self': {'name': 'rtmbot'}},
+        'conversations.info': {'ok': True, 'channel': {'id': 'C1', 'name': 'general'}},
+    }
+    client.api_call.side_effect = lambda method, **kwargs: replies[method]
+    client.server.attach_channel.side_effect = (
+        lambda name, channel_id, members: client.server.channels.append(Channel(None, name, channel_id)))
+
+    connection.connect()
+    assert not client.server.rtm_connect.called
+    client.server.connect_slack_websocket.assert_called_with('wss://example')
+
+    assert connection.find_channel('C1').id == 'C1'
+    assert connection.find_channel('#general').id == 'C1'
+    assert [call[0][0] for call in client.api_call.call_args_list] == [
+        'rtm.connect', 'conversations.info']
@@ -72,4 +72,520 @@ def test_output():
     plugin_mock.do_output.return_value = [['C12345678', 'ù hœø3ö']]
     rtmbot.output()
 
-    channel_mock.send_message.assert_called_with('ù hœø3ö')
\ No newline at end of file
+    channel_mock.send_message.assert_called_with('ù hœø3ö')
+
+def test_event_loop_waker():
+    ''' Test that appending plugin output wakes up the event loop '''
+    import os
+    import select
+    from rtmbot.core import Waker, OutputList
+
+    waker = Waker()
+    outputs = OutputList([['C12345678', 'queued at import']], waker)
+    assert select.select([waker], [], [], 0)[0] == []
+
+    outputs.append(['C12345678', 'test message'])
+    outputs.append(['C12345678', 'another message'])
+    assert select.select([waker], [], [], 0)[0] == [waker]
+    assert len(outputs) == 3
+
+    waker.drain()
+    assert select.select([waker], [], [], 0)[0] == []
+
+    # a thread waking the loop while it drains the pipe doesn't leave it deaf
+    read = os.read
+
+    def racing_read(fd, size):
+        waker.wake()
+        return read(fd, size)
+    os.read = racing_read
+    try:
+        waker.drain()
+    finally:
+        os.read = read
+    waker.wake()
+    assert select.select([waker], [], [], 0)[0] == [waker]
+
+
+def test_event_loop_timeout():
+    ''' Test that the event loop sleeps until the next cron job or ping '''
+    from rtmbot.core import Job, monotonic
+
+    rtmbot = RtmBot({
+        'SLACK_TOKEN': 'test-12345',
+        'BASE_PATH': '/tmp/',
+        'LOGFILE': '/tmp/rtmbot.log',
+        'LOOP': 'event',
+        'LOOP_MAX_WAIT': 10,
+    })
+    rtmbot.slack_client = Mock()
+    rtmbot.connection.last_ping = monotonic()
+    assert 2 < rtmbot._next_timeout() <= 3
+
+    job = Job(1, lambda: None, False)
+    rtmbot.scheduler.add(job)
+    assert rtmbot._next_timeout() == 0
+    rtmbot.scheduler.run_pending()
+    assert 0 < rtmbot._next_timeout() <= 1
+
+
+def test_input_dispatch():
+    ''' Test that events only reach the plugins handling their type '''
+    import sys
+    import types
+
+    received = []
+    module = types.ModuleType('dispatch_test_plugin')
+    module.process_message = lambda data: received.append(('message', data['text']))
+    module.catch_all = lambda data: received.append(('catch_all', data['type']))
+    sys.modules['dispatch_test_plugin'] = module
+
+    rtmbot = init_rtmbot()
+    rtmbot.bot_plugins.append(Plugin('dispatch_test_plugin', {'DEBUG': True}))
+    rtmbot.rebuild_dispatch()
+
+    rtmbot.input({'type': 'message', 'text': 'hi'})
+    rtmbot.input({'type': 'presence_change'})
+    assert received == [
+        ('message', 'hi'), ('catch_all', 'message'), ('catch_all', 'presence_change')]
+    assert rtmbot.dispatch['process_presence_change'] == [
+        (rtmbot.bot_plugins[0], module.catch_all)]
+
+
+def test_malformed_directory_events():
+    ''' Test that events the directory can't make sense of are still dispatched '''
+    rtmbot = init_rtmbot()
+    plugin = Mock(handlers={}, catch_all=Mock(), event_keys=False)
+    plugin.accepts.return_value = True
+    rtmbot.bot_plugins.append(plugin)
+
+    rtmbot.input({'type': 'channel_created', 'channel': 'C1'})
+    rtmbot.input({'type': 'team_join'})
+    rtmbot.input({'type': 'im_created', 'channel': None, 'user': 'U1'})
+    assert plugin.call.call_count == 3
+    assert rtmbot.slack_directory.channel('C1') is None
+
+
+def test_event_filters_and_context():
+    ''' Test that plugins only get the event types they want, with their context '''
+    import sys
+    import types
+
+    received = []
+    module = types.ModuleType('filter_test_plugin')
+    module.process_message = lambda data, context: received.append(
+        ('message', context.workspace, sorted(key for key in data if key.startswith('__'))))
+    module.catch_all = lambda data: received.append(('catch_all', data['type']))
+    module.IGNORE_EVENTS = ['presence_change']
+    sys.modules['filter_test_plugin'] = module
+
+    rtmbot = init_rtmbot()
+    rtmbot.connection.team_id = 'T1'
+    rtmbot.bot_plugins.append(Plugin('filter_test_plugin', {'DEBUG': True, 'EVENT_KEYS': False}))
+    rtmbot.rebuild_dispatch()
+
+    rtmbot.input({'type': 'message', 'text': 'hi'})
+    rtmbot.input({'type': 'presence_change'})
+    rtmbot.input({'type': 'reaction_added'})
+    assert received == [('message', 'T1', []), ('catch_all', 'message'),
+                        ('catch_all', 'reaction_added')]
+    assert rtmbot.dispatch['process_presence_change'] == []
+
+    # an allow list, from the config
+    received[:] = []
+    rtmbot.bot_plugins[0] = Plugin('filter_test_plugin', {'DEBUG': True, 'EVENTS': ['message']})
+    rtmbot.rebuild_dispatch()
+    rtmbot.input({'type': 'message', 'text': 'hi'})
+    rtmbot.input({'type': 'reaction_added'})
+    assert received == [('message', 'T1', ['__directory', '__slack_client', '__workspace']),
+                        ('catch_all', 'message')]
+    assert rtmbot.wanted_events() == set(['message'])
+    rtmbot.lazy_plugins['team_join'] = ['/tmp/lazy_plugin.py']
+    assert rtmbot.wanted_events() == set(['message', 'team_join'])
+    rtmbot.bot_plugins[0] = Plugin('filter_test_plugin', {'DEBUG': True})
+    assert rtmbot.wanted_events() is None
+
+
+def test_do_output():
+    ''' Test that outputs are drained from both the outputs list and the outbox '''
+    import sys
+    import types
+
+    module = types.ModuleType('output_test_plugin')
+    module.outputs = [['C12345678', 'from import']]
+    sys.modules['output_test_plugin'] = module
+
+    plugin = Plugin('output_test_plugin', {})
+    module.outputs.append(['C12345678', 'from list'])
+    module.outbox.put('C12345678', 'from outbox')
+    module.outbox.put('C12345678', 'FILE', 'a,b', 'csv', 'test.csv')
+
+    assert plugin.do_output() == [
+        ['C12345678', 'from import'],
+        ['C12345678', 'from list'],
+        ['C12345678', 'from outbox'],
+        ['C12345678', 'FILE', 'a,b', 'csv', 'test.csv'],
+    ]
+    assert module.outputs == []
+    assert plugin.do_output() == []
+
+
+def test_plugin_reload(tmpdir):
+    ''' Test that plugins reload in place and roll back when the new code is broken '''
+    import sys
+
+    path = tmpdir.join('reload_test_plugin.py')
+    path.write('outputs = []\ncrontable = [[60, "tick"]]\n'
+               'def tick():\n    pass\n'
+               'def process_message(data):\n    outputs.append([data["channel"], "v1"])\n')
+    sys.path.insert(0, str(tmpdir))
+    try:
+        rtmbot = init_rtmbot()
+        plugin = rtmbot.load_plugin(str(path))
+        rtmbot.rebuild_dispatch()
+        job = plugin.jobs[0]
+        rtmbot.input({'type': 'message', 'channel': 'C12345678'})
+
+        path.write('outputs = []\ncrontable = [[60, "tick"], [5, "tock"]]\n'
+                   'def tick():\n    pass\ndef tock():\n    pass\n'
+                   'def process_message(data):\n    outputs.append([data["channel"], "v2"])\n')
+        rtmbot.reload_plugin(plugin)
+        rtmbot.rebuild_dispatch()
+        rtmbot.input({'type': 'message', 'channel': 'C12345678'})
+        assert plugin.do_output() == [['C12345678', 'v1'], ['C12345678', 'v2']]
+        # the job kept its schedule, the new one was added
+        assert plugin.jobs[0] is job
+        assert job.function is plugin.module.tick
+        assert len(rtmbot.scheduler) == 2
+
+        path.write('def process_message(data):\n    this is not python\n')
+        rtmbot.reload_plugin(plugin)
+        rtmbot.input({'type': 'message', 'channel': 'C12345678'})
+        assert plugin.do_output() == [['C12345678', 'v2']]
+        assert sys.modules['reload_test_plugin'] is plugin.module
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop('reload_test_plugin', None)
+
+
+def test_plugin_reload_teardown_and_job_options(tmpdir):
+    ''' Test that reloading tears the old module down and rebuilds jobs whose options changed '''
+    import sys
+
+    # the events are kept out of the plugin, reloading it resets its globals
+    tmpdir.join('teardown_test_events.py').write('events = []\n')
+    path = tmpdir.join('teardown_test_plugin.py')
+    source = ('from teardown_test_events import events\n'
+              'crontable = [[60, "tick", {{"jitter": {}}}]]\n'
+              'def tick():\n    pass\n'
+              'def setup():\n    events.append("setup")\n'
+              'def teardown():\n    events.append("teardown")\n')
+    path.write(source.format(0))
+    sys.path.insert(0, str(tmpdir))
+    try:
+        from teardown_test_events import events
+        rtmbot = init_rtmbot()
+        plugin = rtmbot.load_plugin(str(path))
+        job = plugin.jobs[0]
+
+        path.write(source.format(5))
+        rtmbot.reload_plugin(plugin)
+        assert events == ['setup', 'teardown', 'setup']
+        assert plugin.jobs[0] is not job
+        assert plugin.jobs[0].jitter == 5
+        assert job.cancelled and not plugin.jobs[0].cancelled
+
+        rtmbot.unload_plugin(plugin)
+        assert events[-1] == 'teardown'
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop('teardown_test_plugin', None)
+        sys.modules.pop('teardown_test_events', None)
+
+
+def test_output_buffered_while_disconnected():
+    ''' Test that outputs wait for the connection and are kept when a send fails '''
+    from websocket import WebSocketConnectionClosedException
+
+    rtmbot = init_rtmbot()
+    rtmbot.slack_client = Mock()
+    plugin_mock = create_autospec(Plugin)
+    plugin_mock.do_output.return_value = [['C1', 'first'], ['C2', 'second']]
+    rtmbot.bot_plugins.append(plugin_mock)
+    sent = []
+    failures = [WebSocketConnectionClosedException()]
+
+    def send_output(output, connection):
+        if output[1] == 'second' and failures:
+            raise failures.pop()
+        sent.append(output[1])
+        return True
+    rtmbot.send_output = send_output
+
+    rtmbot.connection.lost('test')
+    rtmbot.output()
+    assert sent == []
+    assert list(rtmbot.unsent) == [['C1', 'first'], ['C2', 'second']]
+
+    # first goes out, second fails and takes the connection down with it
+    rtmbot.connection.retry_at = None
+    plugin_mock.do_output.return_value = []
+    rtmbot.output()
+    assert sent == ['first']
+    assert list(rtmbot.unsent) == [['C2', 'second']]
+    assert not rtmbot.connection.connected
+
+    rtmbot.connection.retry_at = None
+    rtmbot.output()
+    assert sent == ['first', 'second']
+    assert not rtmbot.unsent
+
+
+def test_unsent_outputs_are_bounded():
+    ''' Test that outputs kept for a lost connection are capped, dropping the oldest '''
+    rtmbot = RtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': '/tmp/',
+                     'LOGFILE': '/tmp/rtmbot.log', 'UNSENT_LIMIT': 2})
+    rtmbot.slack_client = Mock()
+    rtmbot.connection.lost('test')
+    rtmbot.send_outputs([['C1', 'first'], ['C1', 'second'], ['C1', 'third']])
+    assert list(rtmbot.unsent) == [['C1', 'second'], ['C1', 'third']]
+    assert rtmbot.unsent_dropped.get() == 1
+
+
+def test_partially_flushed_outputs():
+    ''' Test that the outputs which went out before a failed flush aren't sent again '''
+    import errno
+    import socket
+
+    rtmbot = init_rtmbot()
+    rtmbot.slack_client = Mock()
+    rtmbot.connection.find_channel = Mock(return_value=Mock(id='C1'))
+
+    def flush():
+        rtmbot.connection.frames = []
+        rtmbot.connection.flushed = 1
+        raise socket.error(errno.EPIPE, 'broken pipe')
+    rtmbot.connection.flush = flush
+    rtmbot.send_outputs([['C1', 'first'], ['C1', 'second'], ['C1', 'third']])
+    assert list(rtmbot.unsent) == [['C1', 'second'], ['C1', 'third']]
+    assert not rtmbot.connection.connected
+
+
+def test_read_would_block():
+    ''' Test that a non-blocking socket with nothing to read isn't a lost connection '''
+    import errno
+    import socket
+
+    rtmbot = init_rtmbot()
+    rtmbot.slack_client = Mock()
+    rtmbot.slack_client.rtm_read.side_effect = socket.error(errno.EAGAIN, 'try again')
+    rtmbot.read(10)
+    assert rtmbot.connection.connected
+
+    rtmbot.slack_client.rtm_read.side_effect = socket.error(errno.ECONNRESET, 'reset')
+    rtmbot.read(10)
+    assert not rtmbot.connection.connected
+
+
+def test_dm_connection_errors_are_retried():
+    ''' Test that a DM failing with a connection error is kept, other errors are logged '''
+    import errno
+    import socket
+
+    rtmbot = init_rtmbot()
+    rtmbot.slack_client = Mock()
+    rtmbot.connection.find_channel = Mock(return_value=Mock(id='C1'))
+    rtmbot.open_dm_channel = Mock(side_effect=ValueError('user_not_found'))
+    rtmbot.send_outputs([['C1', 'DM', 'U1', 'hi']])
+    assert not rtmbot.unsent
+    assert rtmbot.connection.connected
+
+    rtmbot.open_dm_channel = Mock(side_effect=socket.error(errno.ECONNRESET, 'reset'))
+    rtmbot.send_outputs([['C1', 'DM', 'U1', 'hi']])
+    assert list(rtmbot.unsent) == [['C1', 'DM', 'U1', 'hi']]
+    assert not rtmbot.connection.connected
+
+
+def test_start_loads_plugins_once(tmpdir):
+    ''' Test that restarting the bot doesn't load the plugins again '''
+    tmpdir.mkdir('plugins').join('start_test_plugin.py').write('outputs = []\n')
+    rtmbot = RtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': str(tmpdir),
+                     'LOGFILE': str(tmpdir.join('rtmbot.log'))})
+    rtmbot.connect = Mock()
+    rtmbot.get_user_info = Mock()
+    rtmbot._poll_tick = Mock(side_effect=KeyboardInterrupt)
+    try:
+        for _ in range(2):
+            try:
+                rtmbot.start()
+            except KeyboardInterrupt:
+                pass
+        assert [plugin.name for plugin in rtmbot.bot_plugins] == ['start_test_plugin']
+    finally:
+        import sys
+        sys.modules.pop('start_test_plugin', None)
+
+
+def test_plugin_setup_and_lazy_activation(tmpdir):
+    ''' Test that slow setups don't hold up the bot and lazy plugins load on their event '''
+    import sys
+
+    plugins = tmpdir.mkdir('plugins')
+    plugins.join('fast_setup_plugin.py').write(
+        'ready = False\ndef setup():\n    global ready\n    ready = True\n')
+    plugins.mkdir('slow').join('slow_setup_plugin.py').write(
+        'import threading\nrelease = threading.Event()\n'
+        'def setup():\n    release.wait()\n')
+    plugins.join('lazy_plugin.py').write(
+        'import threading\n'
+        'outputs = []\n'
+        'release = threading.Event()\n'
+        'def setup():\n    release.wait()\n'
+        'def process_user_info(data):\n    outputs.append(["C1", data["user"]])\n'
+        'def process_message(data):\n    outputs.append([data["channel"], data["text"]])\n')
+    plugins.join('tasks.json').write('{}')
+    rtmbot = RtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': str(tmpdir),
+                     'LOGFILE': str(tmpdir.join('rtmbot.log')), 'PLUGIN_SETUP_TIMEOUT': 0.1,
+                     'lazy_plugin': {'ACTIVATE_ON': ['message']}})
+    path = list(sys.path)
+    try:
+        rtmbot.input({'type': 'user_info', 'user': 'bot'})
+        rtmbot.load_plugins()
+        # only the directories holding plugins are added
+        assert sys.path[:2] == [str(plugins), str(plugins.join('slow'))]
+        assert sys.path[2:] == path
+        assert [plugin.name for plugin in rtmbot.bot_plugins] == ['fast_setup_plugin']
+        assert sys.modules['fast_setup_plugin'].ready
+        assert 'lazy_plugin' not in sys.modules
+
+        sys.modules['slow_setup_plugin'].release.set()
+        wait_for_setups(rtmbot, 2)
+        assert [plugin.name for plugin in rtmbot.bot_plugins] == [
+            'fast_setup_plugin', 'slow_setup_plugin']
+
+        # the lazy plugin sets up off the loop, the events meanwhile wait for it
+        rtmbot.input({'type': 'message', 'channel': 'C2', 'text': 'hi'})
+        rtmbot.input({'type': 'message', 'channel': 'C3', 'text': 'there'})
+        assert rtmbot.lazy_plugins == {}
+        assert len(rtmbot.bot_plugins) == 2
+        sys.modules['lazy_plugin'].release.set()
+        wait_for_setups(rtmbot, 3)
+        lazy = rtmbot.bot_plugins[-1]
+        assert lazy.name == 'lazy_plugin'
+        assert lazy.do_output() == [['C1', 'bot'], ['C2', 'hi'], ['C3', 'there']]
+        assert rtmbot.activating == {}
+    finally:
+        sys.path[:] = path
+        for name in ('fast_setup_plugin', 'slow_setup_plugin', 'lazy_plugin'):
+            sys.modules.pop(name, None)
+
+
+def test_setup_spawns_under_gevent(tmpdir):
+    ''' Test that the greenlets a setup() spawns run on the bot's loop under gevent '''
+    import os
+    import subprocess
+    import sys
+
+    import pytest
+
+    pytest.importorskip('gevent')
+    tmpdir.mkdir('plugins').join('spawn_setup_plugin.py').write(
+        'import gevent\n'
+        'recovered = []\n'
+        'def setup():\n'
+        '    gevent.spawn(recovered.append, "task")\n')
+    script = (
+        'from gevent import monkey\n'
+        'monkey.patch_all()\n'
+        'import sys, gevent\n'
+        'from rtmbot.core import RtmBot\n'
+        'bot = RtmBot({{"SLACK_TOKEN": "test-12345", "BASE_PATH": {0!r}, "LOGFILE": {1!r}}})\n'
+        'bot.load_plugins()\n'
+        'gevent.sleep(0.1)\n'
+        'print(sys.modules["spawn_setup_plugin"].recovered)\n').format(
+            str(tmpdir), str(tmpdir.join('rtmbot.log')))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=root)
+    assert output.decode('utf-8').strip() == "['task']"
+
+
+def test_every_shard_jobs():
+    ''' Test that a worker not running the timed jobs still runs the every_shard ones '''
+    import sys
+    import types
+
+    module = types.ModuleType('shard_jobs_plugin')
+    module.report = module.sync = lambda: None
+    module.crontable = [[60, 'report'], [1, 'sync', {'every_shard': True}]]
+    sys.modules['shard_jobs_plugin'] = module
+    try:
+        rtmbot = init_rtmbot()
+        rtmbot.run_jobs = False
+        rtmbot.activate_plugin(Plugin('shard_jobs_plugin', {}))
+        assert [job.function for _, _, job in rtmbot.scheduler.heap] == [module.sync]
+    finally:
+        sys.modules.pop('shard_jobs_plugin', None)
+
+
+def wait_for_setups(rtmbot, count):
+    import time
+
+    deadline = time.time() + 10
+    while len(rtmbot.bot_plugins) < count and time.time() < deadline:
+        time.sleep(.01)
+        rtmbot.crons()
+
+
+def test_prefetch_dm_channels_is_bounded():
+    ''' Test that DM channels are opened concurrently, but at most DM_OPEN_CONCURRENCY '''
+    import threading
+    import time
+
+    rtmbot = init_rtmbot()
+    rtmbot.config['DM_OPEN_CONCURRENCY'] = 3
+    connection = Mock(connected=True)
+    connection.directory.ims.get.return_value = None
+    rtmbot.route = Mock(return_value=connection)
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+    opened = []
+
+    def open_dm_channel(user, connection):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+            opened.append(user)
+
+    rtmbot.open_dm_channel = open_dm_channel
+    rtmbot.prefetch_dm_channels([['C1', 'DM', 'U{}'.format(i), 'hi'] for i in range(10)])
+    assert sorted(opened) == sorted('U{}'.format(i) for i in range(10))
+    assert 1 < peak[0] <= 3
+
+
+def test_multiple_workspaces():
+    ''' Test that events carry their workspace and replies go back to it '''
+    rtmbot = RtmBot({'SLACK_TOKENS': ['token-a', 'token-b'], 'BASE_PATH': '/tmp/',
+                     'LOGFILE': '/tmp/rtmbot.log'})
+    assert rtmbot.token == 'token-a'
+    first, second = rtmbot.connections
+    for connection, team_id in ((first, 'T1'), (second, 'T2')):
+        connection.slack_client = Mock()
+        connection.team_id = team_id
+    second.directory.add_channel({'id': 'C2', 'name': 'general'})
+
+    events = []
+    rtmbot.input({'type': 'message', 'channel': 'C3'}, second)
+    assert rtmbot.route('C3') is second
+    assert rtmbot.route('C2') is second
+    assert rtmbot.route('C1') is first
+
+    plugin_mock = create_autospec(Plugin)
+    plugin_mock.do_output.return_value = [['C3', 'reply'], ['C1', 'other']]
+    rtmbot.bot_plugins.append(plugin_mock)
+    rtmbot.send_output = lambda output, connection: events.append((output[1], connection))
+    rtmbot.output()
+    assert events == [('reply', second), ('other', first)]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from slackclient._channel import Channel
+from slackclient._util import SearchList
+
+from rtmbot.directory import ChannelIndex, IMCache
+
+
+def test_channel_index():
+    channels = SearchList()
+    channels.append(Channel(None, 'general', 'C1'))
+    index = ChannelIndex(channels)
+    assert index.find('C1') is channels[0]
+    assert index.find('#general') is channels[0]
+
+    channels.append(Channel(None, 'random', 'C2'))
+    assert index.find('C2') is channels[1]
+    assert index.find('C3') is None
+
+    # Channel.__eq__ also matches a name stored with its '#'
+    channels.append(Channel(None, '#legacy', 'C4'))
+    assert index.find('legacy') is channels[2]
+
+
+def test_im_cache_expires():
+    now = [1000]
+    cache = IMCache(ttl=60, clock=lambda: now[0])
+    cache.load([{'id': 'D1', 'user': 'U1'}, {'id': 'D2', 'user': 'U2'}])
+    assert cache.get('U1') == 'D1'
+
+    cache.discard_channel('D2')
+    assert cache.get('U2') is None
+
+    now[0] = 1061
+    assert cache.get('U1') is None
+    assert len(cache) == 0
+
+
+def test_directory_follows_events():
+    from rtmbot.directory import Directory
+
+    directory = Directory()
+    directory.load({
+        'channels': [{'id': 'C1', 'name': 'general'}],
+        'groups': [],
+        'ims': [{'id': 'D1', 'user': 'U1'}],
+        'users': [{'id': 'U1', 'name': 'alice'}],
+    })
+    assert directory.channel_id('#general') == 'C1'
+    assert directory.user('alice')['id'] == 'U1'
+    assert directory.ims.get('U1') == 'D1'
+
+    directory.update({'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'lobby'}})
+    assert directory.channel_id('general') is None
+    assert directory.channel('lobby')['id'] == 'C1'
+
+    directory.update({'type': 'user_change', 'user': {'id': 'U1', 'name': 'alice2'}})
+    assert directory.user('alice') is None
+    assert directory.user('U1')['name'] == 'alice2'
+
+    directory.update({'type': 'team_join', 'user': {'id': 'U2', 'name': 'bob'}})
+    directory.update({'type': 'im_created', 'user': 'U2', 'channel': {'id': 'D2'}})
+    assert directory.ims.get('bob') is None
+    assert directory.ims.get('U2') == 'D2'
+
+    assert directory.update({'type': 'presence_change'}) is False
+
+
+def test_directory_fetches_unknown_ids():
+    from rtmbot.directory import Directory
+
+    fetched = []
+
+    def fetch_user(user_id):
+        fetched.append(user_id)
+        return {'id': user_id, 'name': 'alice'} if user_id == 'U1' else None
+
+    directory = Directory()
+    directory.fetch_user = fetch_user
+    assert directory.user('U1')['name'] == 'alice'
+    assert directory.user('alice')['id'] == 'U1'
+    assert directory.user('U2') is None
+    assert directory.user('U2') is None
+    # names can't be fetched, ids are fetched once
+    assert directory.user('bob') is None
+    assert fetched == ['U1', 'U2']
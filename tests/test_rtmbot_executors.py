@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from rtmbot.executors import ProcessExecutor, ThreadExecutor, make_executor
+
+
+def test_inline_by_default():
+    assert make_executor('plugin', None, {}) is None
+
+
+def test_thread_executor_runs_calls():
+    executor = make_executor('plugin', None, {'EXECUTOR': 'thread', 'WORKERS': 2})
+    done = threading.Event()
+    executor.submit(lambda data: done.set(), {'type': 'message'})
+    assert done.wait(5)
+    executor.shutdown()
+
+
+def test_full_queue_drops_calls():
+    release = threading.Event()
+    started = threading.Event()
+    ran = []
+
+    def slow(data):
+        started.set()
+        release.wait(5)
+        ran.append(data)
+
+    executor = ThreadExecutor('plugin', workers=1, queue_size=1, policy='drop_oldest')
+    executor.submit(slow, 'running')
+    assert started.wait(5)
+    executor.submit(slow, 'oldest')
+    executor.submit(slow, 'newest')
+    assert executor.dropped == 1
+
+    release.set()
+    executor.shutdown()
+    for worker in executor.workers:
+        worker.join(5)
+    assert ran == ['running', 'newest']
+
+
+def test_debug_failures_reach_the_bot():
+    failures = []
+    done = threading.Event()
+
+    def broken(data):
+        raise ValueError(data)
+
+    executor = make_executor('plugin', None, {'EXECUTOR': 'thread', 'DEBUG': True})
+    executor.on_failure = lambda e: (failures.append(e), done.set())
+    executor.submit(broken, 'boom')
+    assert done.wait(5)
+    assert isinstance(failures[0], ValueError)
+    executor.shutdown()
+
+
+def test_process_pool_starts_on_first_call():
+    executor = ProcessExecutor('plugin', workers=1)
+    assert executor.pool is None
+    executor.shutdown()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import pytest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from rtmbot.metrics import MetricsServer, Registry
+
+
+def test_render():
+    registry = Registry()
+    registry.counter('events_total', 'Events', ['type']).inc(type='message')
+    registry.counter('events_total', 'Events', ['type']).inc(2, type='message')
+    registry.gauge('depth', 'Depth', function=lambda: 3)
+    histogram = registry.histogram('seconds', 'Seconds', ['kind'], buckets=(.1, 1))
+    histogram.observe(.05, kind='a "quoted"\nkind')
+    histogram.observe(.5, kind='a "quoted"\nkind')
+
+    assert registry.render() == '\n'.join([
+        '# HELP depth Depth',
+        '# TYPE depth gauge',
+        'depth 3',
+        '# HELP events_total Events',
+        '# TYPE events_total counter',
+        'events_total{type="message"} 3',
+        '# HELP seconds Seconds',
+        '# TYPE seconds histogram',
+        'seconds_bucket{kind="a \\"quoted\\"\\nkind",le="0.1"} 1',
+        'seconds_bucket{kind="a \\"quoted\\"\\nkind",le="1"} 2',
+        'seconds_bucket{kind="a \\"quoted\\"\\nkind",le="+Inf"} 2',
+        'seconds_sum{kind="a \\"quoted\\"\\nkind"} 0.55',
+        'seconds_count{kind="a \\"quoted\\"\\nkind"} 2',
+    ]) + '\n'
+
+    with pytest.raises(ValueError):
+        registry.gauge('events_total', 'Events', ['type'])
+    with pytest.raises(ValueError):
+        registry.get('events_total').inc(channel='C1')
+
+
+def test_plugin_metrics():
+    ''' Test that handler calls and failures are recorded per plugin '''
+    from rtmbot.core import Plugin
+
+    module = types.ModuleType('metrics_test_plugin')
+    module.process_message = lambda data: data['text']
+    sys.modules['metrics_test_plugin'] = module
+    try:
+        plugin = Plugin('metrics_test_plugin', {})
+        plugin.call(module.process_message, {'text': 'hi'})
+        plugin.call(module.process_message, {})
+        assert plugin.handler_seconds.get(plugin='metrics_test_plugin', handler='<lambda>')[0] == 2
+        assert plugin.handler_errors.get(plugin='metrics_test_plugin', handler='<lambda>') == 1
+        assert module.metrics is plugin.metrics
+    finally:
+        sys.modules.pop('metrics_test_plugin', None)
+
+
+def test_delivery_metrics():
+    ''' Test that Slack's replies to messages are counted for the plugin which sent them '''
+    import threading
+    from slackclient._channel import Channel
+    from rtmbot.core import RtmBot
+    from rtmbot.outbound import Output
+
+    rtmbot = RtmBot({'SLACK_TOKEN': 'test-12345', 'BASE_PATH': '/tmp/',
+                     'LOGFILE': '/tmp/rtmbot.log'})
+    rtmbot.slack_client = Mock()
+    server = rtmbot.slack_client.server
+    server.channels = [Channel(server, 'general', 'C1')]
+    server.websocket.lock = threading.Lock()
+    server.websocket._send = len
+    server.websocket.get_mask_key = None
+    rtmbot.send_outputs([Output(['C1', 'one'], 'repeat'), Output(['C1', 'two'], 'todo')])
+    first, second = list(rtmbot.connection.unacked)
+    rtmbot.input({'ok': True, 'reply_to': first})
+    rtmbot.input({'ok': False, 'reply_to': second, 'error': {'code': 2, 'msg': 'no text'}})
+
+    assert rtmbot.deliveries.get(plugin='repeat', result='ok') == 1
+    assert rtmbot.deliveries.get(plugin='todo', result='error') == 1
+    assert rtmbot.ack_seconds.get(plugin='repeat')[0] == 1
+    assert not rtmbot.connection.unacked
+
+
+def test_metrics_server():
+    registry = Registry()
+    registry.counter('events_total', 'Events').inc()
+    server = MetricsServer(registry, port=0).start()
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        assert 'events_total 1' in urlopen(url).read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from rtmbot.outbound import OutboundQueue
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_queue(clock, **kwargs):
+    options = dict(rate=10, burst=10, channel_rate=1, channel_burst=1, coalesce_limit=20)
+    options.update(kwargs)
+    return OutboundQueue(clock=clock, **options)
+
+
+def test_channel_rate_limit():
+    clock = FakeClock()
+    outbound = make_queue(clock, coalesce_limit=0)
+    outbound.put(['C1', 'one'])
+    outbound.put(['C1', 'two'])
+    outbound.put(['C2', 'three'])
+
+    assert outbound.pop_ready() == [['C1', 'one'], ['C2', 'three']]
+    assert outbound.pop_ready() == []
+    assert outbound.next_ready() == 1001
+
+    clock.now = 1001
+    assert outbound.pop_ready() == [['C1', 'two']]
+    assert outbound.next_ready() is None
+    assert outbound.stats()['latency_max'] == 1
+
+
+def test_replies_before_cron_output():
+    clock = FakeClock()
+    outbound = make_queue(clock, rate=1, burst=1)
+    outbound.put(['C1', 'cron'], OutboundQueue.CRON)
+    outbound.put(['C2', 'reply'], OutboundQueue.REPLY)
+    assert outbound.pop_ready() == [['C2', 'reply']]
+    clock.now = 1001
+    assert outbound.pop_ready() == [['C1', 'cron']]
+
+
+def test_coalesce_short_messages():
+    clock = FakeClock()
+    outbound = make_queue(clock)
+    outbound.put(['C1', 'hello'])
+    outbound.put(['C1', 'there'])
+    outbound.put(['C1', 'TYPING'])
+    outbound.put(['C1', 'too long to be merged'])
+    assert outbound.pop_ready() == [['C1', 'hello\nthere']]
+    assert len(outbound) == 2
+    assert outbound.stats()['coalesced'] == 1
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from testfixtures import LogCapture
+
+from rtmbot.profiling import Profiler
+
+
+def slow_handler(started, release):
+    started.set()
+    release.wait(5)
+
+
+def test_watchdog_flags_slow_calls():
+    ''' Test that a call over the threshold is logged once, with its stack '''
+    profiler = Profiler(threshold=0.05, signal_name=None)
+    started, release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=profiler.run,
+                              args=('plugin.slow_handler', slow_handler, started, release))
+    thread.start()
+    try:
+        started.wait(5)
+        assert profiler.check() == []
+        time.sleep(.1)
+        with LogCapture() as logs:
+            assert profiler.check() == ['plugin.slow_handler']
+            assert profiler.check() == []
+    finally:
+        release.set()
+        thread.join()
+    message = logs.records[0].getMessage()
+    assert message.startswith('plugin.slow_handler has been running for')
+    assert 'slow_handler' in message.split('\n', 1)[1]
+
+    stats = profiler.stats['plugin.slow_handler']
+    assert stats.calls == 1
+    assert stats.slow == 1
+    assert stats.wall >= .1
+    assert profiler.active == {}
+
+
+def test_profiling_session(tmpdir):
+    ''' Test that toggling twice writes a cProfile dump and collapsed stacks '''
+    profiler = Profiler(directory=str(tmpdir), signal_name=None)
+    profiler.toggle()
+    profiler.run('plugin.handler', sum, range(1000))
+    profiler.sample()
+    profiler.toggle()
+    files = sorted(path.basename for path in tmpdir.listdir())
+    assert [name.rsplit('.', 1)[1] for name in files] == ['folded', 'pstats']
+    folded = tmpdir.join(files[0]).read()
+    assert 'test_profiling_session' in folded
+    assert folded.strip().split(' ')[-1] == '1'
+
+
+def test_executor_calls_are_profiled():
+    ''' Test that handlers a plugin's executor runs are timed like inline ones '''
+    import sys
+    import types
+    from rtmbot.core import Plugin
+
+    done = threading.Event()
+    module = types.ModuleType('executor_profile_plugin')
+
+    def process_message(data):
+        done.set()
+    module.process_message = process_message
+    sys.modules['executor_profile_plugin'] = module
+    profiler = Profiler(signal_name=None)
+    try:
+        plugin = Plugin('executor_profile_plugin', {'EXECUTOR': 'thread'}, profiler=profiler)
+        plugin.call(process_message, {'text': 'hi'})
+        assert done.wait(5)
+        plugin.executor.shutdown()
+        for worker in plugin.executor.workers:
+            worker.join(5)
+    finally:
+        sys.modules.pop('executor_profile_plugin', None)
+    assert profiler.stats['executor_profile_plugin.process_message'].calls == 1
+    assert plugin.handler_seconds.get(
+        plugin='executor_profile_plugin', handler='process_message')[0] == 1
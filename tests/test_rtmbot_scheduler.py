@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+
+from rtmbot.scheduler import CronExpression, Job, Scheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_interval_jobs_run_in_deadline_order():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+    scheduler.add(Job(10, lambda: ran.append('slow'), True))
+    scheduler.add(Job(3, lambda: ran.append('fast'), True))
+
+    # interval jobs run right away, like they always have
+    scheduler.run_pending()
+    assert sorted(ran) == ['fast', 'slow']
+    assert scheduler.next_deadline() == 1003
+
+    del ran[:]
+    clock.now = 1005
+    scheduler.run_pending()
+    assert ran == ['fast']
+    # runs are anchored to the schedule, not to the end of the last run
+    assert scheduler.next_deadline() == 1006
+
+
+def test_missed_runs_policy():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+    skip = Job(10, lambda: ran.append('skip'), True)
+    catchup = Job(10, lambda: ran.append('catchup'), True, policy='catchup')
+    scheduler.add(skip)
+    scheduler.add(catchup)
+    scheduler.run_pending()
+
+    # the bot was stuck for three intervals
+    del ran[:]
+    clock.now = 1035
+    scheduler.run_pending()
+    assert skip.scheduled == 1040
+    assert catchup.scheduled == 1020
+    scheduler.run_pending()
+    scheduler.run_pending()
+    assert ran.count('catchup') == 3
+    assert ran.count('skip') == 1
+
+
+def test_cancelled_jobs_are_dropped():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+    job = Job(10, lambda: ran.append(1), True)
+    scheduler.add(job)
+    scheduler.remove(job)
+    assert scheduler.next_deadline() is None
+    scheduler.run_pending()
+    assert ran == []
+
+
+def test_failing_job_keeps_the_schedule():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+
+    def fail():
+        raise ValueError('broken')
+    failing = Job(10, fail, True)
+    other = Job(10, lambda: ran.append('other'), True)
+    scheduler.add(failing)
+    scheduler.add(other)
+
+    # in debug mode the error reaches the bot, which restarts without adding the jobs again
+    try:
+        scheduler.run_pending()
+    except ValueError:
+        pass
+    else:
+        assert False, 'the job error should be raised'
+    assert len(scheduler) == 2
+    assert failing.scheduled == 1010
+    scheduler.run_pending()
+    assert ran == ['other']
+    assert scheduler.next_deadline() == 1010
+
+
+def test_cron_expression():
+    cron = CronExpression('*/15 9-17 * * 1-5')
+    # saturday 2016-04-02 10:07 -> monday 2016-04-04 09:00
+    saturday = time.mktime(datetime.datetime(2016, 4, 2, 10, 7).timetuple())
+    assert datetime.datetime.fromtimestamp(cron.next_after(saturday)) == \
+        datetime.datetime(2016, 4, 4, 9, 0)
+    monday = time.mktime(datetime.datetime(2016, 4, 4, 9, 0).timetuple())
+    assert datetime.datetime.fromtimestamp(cron.next_after(monday)) == \
+        datetime.datetime(2016, 4, 4, 9, 15)
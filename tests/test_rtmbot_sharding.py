@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import time
+
+from rtmbot.sharding import ShardPool, shard_for, shard_key
+
+
+def test_shard_key():
+    assert shard_key({'type': 'message', 'channel': 'C1'}) == 'C1'
+    assert shard_key({'type': 'reaction_added', 'item': {'channel': 'C2'}}) == 'C2'
+    assert shard_key({'type': 'channel_created', 'channel': {'id': 'C3'}}) is None
+    assert shard_key({'type': 'presence_change'}) is None
+    assert shard_for('C1', 4) == shard_for('C1', 4)
+    assert set(shard_for('C{}'.format(i), 4) for i in range(100)) == set(range(4))
+
+
+def test_shard_pool_drops_unwanted_events():
+    ''' Test that events no worker's plugins handle are dropped, not their directory changes '''
+    class Queue(list):
+        put = list.append
+
+    pool = ShardPool(2, {})
+    pool.queues = [Queue(), Queue()]
+    pool.dispatch({'type': 'user_typing', 'channel': 'C1'}, 0, 'T1')
+    # until every worker has told which events it wants, they all go out
+    pool.set_events(0, set(['message']))
+    pool.dispatch({'type': 'user_typing', 'channel': 'C1'}, 0, 'T1')
+    assert sum(len(queue) for queue in pool.queues) == 2
+
+    pool.set_events(1, set(['message', 'reaction_added']))
+    for queue in pool.queues:
+        del queue[:]
+    pool.dispatch({'type': 'user_typing', 'channel': 'C1'}, 0, 'T1')
+    pool.dispatch({'type': 'channel_rename', 'channel': {'id': 'C1'}}, 0, 'T1', True)
+    pool.dispatch({'type': 'reaction_added', 'item': {'channel': 'C1'}}, 0, 'T1')
+    pool.dispatch({'type': 'user_info'}, 0, 'T1')
+    owner = pool.queues[shard_for('C1', 2)]
+    assert [(kind, data['type']) for kind, _, _, data in owner] == [
+        ('directory', 'channel_rename'), ('event', 'reaction_added'), ('event', 'user_info')]
+
+    # a catch_all without EVENTS takes them all
+    pool.set_events(1, None)
+    pool.dispatch({'type': 'user_typing', 'channel': 'C1'}, 0, 'T1')
+    assert owner[-1][3]['type'] == 'user_typing'
+
+
+def test_shard_pool(tmpdir):
+    ''' Test that events reach one worker per channel and outputs come back '''
+    tmpdir.mkdir('plugins').join('shard_test_plugin.py').write(
+        'import os\n'
+        'outputs = []\n'
+        'def process_message(data):\n'
+        '    outputs.append([data["channel"], "{} {}".format(data["text"], os.getpid())])\n'
+        'def process_user_info(data):\n'
+        '    outputs.append(["CREADY", "ready {}".format(os.getpid())])\n')
+    pool = ShardPool(2, {'SLACK_TOKEN': 'test-12345', 'BASE_PATH': str(tmpdir),
+                         'LOGFILE': str(tmpdir.join('rtmbot.log'))})
+    pool.start()
+    try:
+        pool.dispatch({'type': 'user_info'}, 0, 'T1')
+        channels = ['C{}'.format(i) for i in range(10)]
+        for i in range(3):
+            for channel in channels:
+                pool.dispatch({'type': 'message', 'channel': channel, 'text': str(i)}, 0, 'T1')
+        outputs = []
+        deadline = time.time() + 30
+        while len(outputs) < 32 and time.time() < deadline:
+            for batch in pool.collect():
+                outputs.extend(batch)
+            time.sleep(.05)
+    finally:
+        pool.shutdown()
+
+    ready = set(text.split()[1] for channel, text in outputs if text.startswith('ready'))
+    assert len(ready) == 2
+    for channel in channels:
+        replies = [text.split() for target, text in outputs if target == channel]
+        # in order, and all from the worker owning the channel
+        assert [reply[0] for reply in replies] == ['0', '1', '2']
+        assert len(set(reply[1] for reply in replies)) == 1
+
+
+def test_shard_state_recovered_once(tmpdir):
+    ''' Test that workers tell their copies of a plugin apart, so state is recovered once '''
+    state = tmpdir.mkdir('state')
+    state.join('pending.json').write('["a"]')
+    state.join('pending.json.1').write('["b"]')
+    # the way crunchablebot picks its journal
+    tmpdir.mkdir('plugins').join('shard_state_plugin.py').write(
+        'import json\n'
+        'outputs = []\n'
+        'def setup():\n'
+        '    shard = config.get("SHARD")\n'
+        '    path = {!r}\n'
+        '    if shard:\n'
+        '        path = "{{}}.{{}}".format(path, shard)\n'
+        '    for task in json.load(open(path)):\n'
+        '        outputs.append(["C1", "recovered {{}} by {{}}".format(task, shard)])\n'.format(
+            str(state.join('pending.json'))))
+    pool = ShardPool(2, {'SLACK_TOKEN': 'test-12345', 'BASE_PATH': str(tmpdir),
+                         'LOGFILE': str(tmpdir.join('rtmbot.log'))})
+    pool.start()
+    try:
+        outputs = []
+        deadline = time.time() + 30
+        while len(outputs) < 2 and time.time() < deadline:
+            for batch in pool.collect():
+                outputs.extend(batch)
+            time.sleep(.05)
+        # any duplicate would come right after
+        time.sleep(.5)
+        for batch in pool.collect():
+            outputs.extend(batch)
+    finally:
+        pool.shutdown()
+
+    assert sorted(text for _, text in outputs) == ['recovered a by 0', 'recovered b by 1']